@@ -0,0 +1,389 @@
+import os
+import gc
+import sys
+import gzip
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from core import registry  # noqa: E402
+from core import filtering  # noqa: E402
+from core import codec  # noqa: E402
+from core import recording  # noqa: E402
+from core import websocket  # noqa: E402
+
+
+def make_emojis(n, nusers=200, seed=0):
+    rnd = random.Random(seed)
+    categories = [f'カテゴリー{i}' for i in range(30)]
+    licenses = ['', 'CC0', 'CC BY 4.0', '自作', 'https://example.com/license']
+    tags = [f'タグ{i}' for i in range(300)]
+    ls = []
+    for i in range(n):
+        ls.append({
+            'id': f'e{i:08d}',
+            'misskey_id': f'9x{i:010d}',
+            'name': f'emoji_{i}_{rnd.randrange(1 << 30):x}',
+            'category': rnd.choice(categories),
+            'tags': rnd.sample(tags, rnd.randrange(0, 5)),
+            'url': f'https://media.example.com/emoji/{i:08d}.webp',
+            'is_self_made': rnd.random() < 0.5,
+            'license': rnd.choice(licenses),
+            'owner_id': f'u{rnd.randrange(nusers):06d}',
+            'risk_id': f'r{i:08d}',
+            'created_at': '2024-01-01T00:00:00.000Z',
+            'updated_at': '2024-01-01T00:00:00.000Z',
+        })
+    # サーバーから受け取ったデータと同じく、値ごとに別々の文字列オブジェクトにする
+    return json.loads(json.dumps(ls))
+
+
+def load_registry(n, nusers=200, nreasons=8, seed=0):
+    """絵文字・ユーザー・リスク・理由区分を合成してregistryに読み込みます"""
+    rnd = random.Random(seed)
+    for i in range(nusers):
+        registry.put_user(f'u{i:06d}', f'9u{i:010d}', f'user_{i}_{rnd.randrange(1 << 20):x}')
+    reason_ids = [f'rs{i:04d}' for i in range(nreasons)]
+    for i, rsid in enumerate(reason_ids):
+        registry.put_reason(rsid, f'理由{i}', '2024-01-01T00:00:00.000Z', '2024-01-01T00:00:00.000Z')
+    remarks = ['', '', '要確認', '権利者に問い合わせ中', 'ロゴ', '似た絵文字あり']
+    data = make_emojis(n, nusers, seed)
+    for i in data:
+        registry.put_risk(
+            i['risk_id'], rnd.choice([0, 0, 1, 2]), rnd.choice([None, 0, 0, 1, 2, 3]),
+            rnd.choice([None, '', *reason_ids]), rnd.choice(remarks),
+            '2024-01-01T00:00:00.000Z', '2024-01-01T00:00:00.000Z',
+        )
+        registry.put_emoji(i['id'], i['misskey_id'], i['name'], i['category'], i['tags'], i['url'], i['is_self_made'], i['license'], i['owner_id'], i['risk_id'], i['created_at'], i['updated_at'])
+    registry.flush_changes()
+
+def clear_registry():
+    for records in [registry.emojis, registry.deleted, registry.users, registry.risks, registry.reasons,
+                    registry.emojis_by_risk, registry.emojis_by_owner, registry.deleted_by_risk, registry.deleted_by_owner, registry.risks_by_reason,
+                    *registry.emoji_texts.values(), *registry.deleted_texts.values(), registry.username_index, registry.remark_index]:
+        records.clear()
+    registry.flush_changes()
+
+
+class _DictEmojiData():
+    """__slots__導入前と同じ__dict__ベースのレコード(比較用)"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def bench_memory(args):
+    for n in args.sizes:
+        data = make_emojis(n)
+
+        before = [_DictEmojiData(**i) for i in data]
+        report_before = registry.measure_records(before)
+        del before
+
+        registry.emojis.clear()
+        for i in data:
+            registry.put_emoji(i['id'], i['misskey_id'], i['name'], i['category'], i['tags'], i['url'], i['is_self_made'], i['license'], i['owner_id'], i['risk_id'], i['created_at'], i['updated_at'])
+        del data
+        report_after = registry.memory_report()['emojis']
+        registry.emojis.clear()
+
+        print(f'emojis: {n:,}')
+        print(f"  before: {report_before['bytes']:>14,} bytes ({report_before['bytes_per_record']:,.1f} bytes/emoji)")
+        print(f"  after:  {report_after['bytes']:>14,} bytes ({report_after['bytes_per_record']:,.1f} bytes/emoji)")
+
+
+def _legacy_filter_str(target, filtering):
+    if filtering is not None:
+        if filtering == '':
+            return True
+        if target is None:
+            return False
+        return all([i in target for i in filtering.split()])
+    else:
+        return target in ['', None]
+
+def legacy_filter(f: filtering.EmojiFilter, eid) -> bool:
+    """事前コンパイル導入前のEmojiFilter.filterと同じ処理(比較用)"""
+    emoji = registry.get_emoji(eid)
+    if emoji is None:
+        return False
+
+    tags = ' '.join(emoji.tags)
+    user = registry.get_user(emoji.owner_id)
+    username = user.username if user is not None else ''
+    risk = registry.get_risk(emoji.risk_id)
+    if risk is not None:
+        risk_level, remark, status, rsid = risk.level, risk.remark, risk.checked, risk.reason_genre
+    else:
+        risk_level, remark, status, rsid = None, None, 0, None
+
+    return (
+        (not (f.enabled and f.enabled_name) or _legacy_filter_str(emoji.name, f.name))
+        and (not (f.enabled and f.enabled_category) or _legacy_filter_str(emoji.category, f.category))
+        and (not (f.enabled and f.enabled_tags) or _legacy_filter_str(tags, f.tags))
+        and (not (f.enabled and f.enabled_is_self_made) or f.is_self_made._filter(emoji.is_self_made))
+        and (not (f.enabled and f.enabled_licence) or _legacy_filter_str(emoji.license, f.licence))
+        and (not (f.enabled and f.enabled_username) or _legacy_filter_str(username, f.username))
+        and (not (f.enabled and f.enabled_risk_level) or f.risk_level._filter(risk_level))
+        and (not (f.enabled and f.enabled_remark) or _legacy_filter_str(remark, f.remark))
+        and (not (f.enabled and f.enabled_status) or f.status._filter(status))
+        and (not (f.enabled and f.enabled_reason_genre) or f.reason_genre._filter(rsid))
+    )
+
+def make_filter(**kwargs) -> filtering.EmojiFilter:
+    params = {
+        'enabled': True,
+        'enabled_name': False, 'enabled_category': False, 'enabled_tags': False, 'enabled_is_self_made': False, 'enabled_licence': False,
+        'enabled_username': False, 'enabled_risk_level': False, 'enabled_reason_genre': False, 'enabled_remark': False, 'enabled_status': False,
+        'name': '', 'category': '', 'tags': '', 'is_self_made': filtering.SelectionIsSelfMade(True, True), 'licence': '', 'username': '',
+        'risk_level': filtering.SelectionRiskLevel(True, True, True, True, True), 'reason_genre': filtering.SelectionReasonGenre({}),
+        'remark': '', 'status': filtering.SelectionCheckStatus(True, True, True),
+        'empty_category': False, 'empty_tags': False, 'empty_licence': False, 'empty_username': False, 'empty_remark': False,
+    }
+    params.update(kwargs)
+    return filtering.EmojiFilter(**params)
+
+FILTER_SCENARIOS = {
+    'disabled': lambda: filtering.EmojiFilter.no_filter(),
+    'need_check+level': lambda: make_filter(
+        enabled_status=True, status=filtering.SelectionCheckStatus(True, False, True),
+        enabled_risk_level=True, risk_level=filtering.SelectionRiskLevel(False, False, False, True, True),
+    ),
+    'name+tags': lambda: make_filter(enabled_name=True, name='emoji_1', enabled_tags=True, tags='タグ1'),
+    'username+remark': lambda: make_filter(enabled_username=True, username='user_1', enabled_remark=True, remark='確認'),
+    'empty_licence+self_made': lambda: make_filter(
+        enabled_licence=True, empty_licence=True,
+        enabled_is_self_made=True, is_self_made=filtering.SelectionIsSelfMade(False, True),
+    ),
+}
+
+def _timeit(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def _filter_before(make, eids):
+    f = make()
+    return [eid for eid in eids if legacy_filter(f, eid)]
+
+def _filter_after(make, eids):
+    return make().filter_all(eids)
+
+def bench_filter(args):
+    for n in args.sizes:
+        clear_registry()
+        load_registry(n)
+        eids = list(registry.emojis)
+        print(f'emojis: {n:,}')
+        for name, make in FILTER_SCENARIOS.items():
+            t_before, before = _timeit(args.repeat, _filter_before, make, eids)
+            t_after, after = _timeit(args.repeat, _filter_after, make, eids)
+            assert before == after, name
+            print(f'  {name:<24} {len(after):>8,} hits  before: {t_before * 1000:>9.2f} ms  after: {t_after * 1000:>9.2f} ms  ({t_before / t_after:.1f}x)')
+        clear_registry()
+
+
+def make_frames(n, seed=0) -> list[str]:
+    """fetch_all_*の応答に近いフレームを合成します"""
+    rnd = random.Random(seed)
+    emojis = make_emojis(n, seed=seed)
+    deleted = []
+    for i in emojis[:max(1, n // 20)]:
+        i = dict(i)
+        del i['created_at'], i['updated_at']
+        i['image_backup'] = base64.b64encode(rnd.randbytes(rnd.randrange(2000, 30000))).decode('ascii')
+        i['info'] = '権利者からの申し立てにより削除'
+        i['deleted_at'] = '2024-02-01T00:00:00.000Z'
+        deleted.append(i)
+    risks = [
+        {'id': i['risk_id'], 'checked': rnd.choice([0, 1, 2]), 'level': rnd.choice([None, 0, 1, 2, 3]),
+         'reason_genre': None, 'remark': rnd.choice(['', '要確認']),
+         'created_at': '2024-01-01T00:00:00.000Z', 'updated_at': '2024-01-01T00:00:00.000Z'}
+        for i in emojis
+    ]
+    frames = [
+        {'op': 'emojis_update', 'body': emojis},
+        {'op': 'deleted_emojis_update', 'body': deleted},
+        {'op': 'risks_update', 'body': risks},
+    ]
+    # 操作の応答のような小さいフレーム
+    for i in range(1000):
+        frames.append({'op': 'ok', 'reqid': f'{i:032x}', 'body': {'op': 'set_risk_prop'}})
+    return [json.dumps(frame, ensure_ascii=False) for frame in frames]
+
+def load_frames(path) -> list[str]:
+    """1行に1フレームずつ書かれたファイルを読み込みます (.gzは展開して読む)
+    COTONESTRUM_RECORDで記録したファイルなら、受信したフレームだけを読み込みます"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip() != '']
+    if len(lines) > 0:
+        first = json.loads(lines[0])
+        if isinstance(first, dict) and 'dir' in first and 'frame' in first:
+            return [frame for _, direction, frame in recording.load_recording(path) if direction == 'in']
+    return lines
+
+def _decode_all(c, frames):
+    return [c.decode_message(frame) for frame in frames]
+
+def _encode_all(c, messages):
+    return [c.dumps(message.to_dict()) for message in messages]
+
+def bench_codec(args):
+    frames = load_frames(args.payloads) if args.payloads is not None else make_frames(args.size)
+    size = sum(len(frame) for frame in frames)
+    print(f'frames: {len(frames):,} ({size / 1024 / 1024:.1f} MiB), selected codec: {codec.codec.name}')
+    codecs = codec.available_codecs()
+    # 標準のjsonを基準にする
+    names = ['json', *[name for name in codecs if name != 'json']]
+    base = None
+    for name in names:
+        c = codecs[name]
+        t_decode, messages = _timeit(args.repeat, _decode_all, c, frames)
+        t_encode, _ = _timeit(args.repeat, _encode_all, c, messages)
+        if base is None:
+            base = (t_decode, t_encode)
+            ratio = ''
+        else:
+            ratio = f'  ({base[0] / t_decode:.1f}x / {base[1] / t_encode:.1f}x)'
+        print(f'  {name:<8} decode: {t_decode * 1000:>9.2f} ms  encode: {t_encode * 1000:>9.2f} ms{ratio}')
+
+    # 全件取得の応答のような大きなフレームは、受信処理と同じく少しずつ解析する
+    frame = json.dumps({'op': 'emojis_update', 'body': make_emojis(args.large)}, ensure_ascii=False)
+    print(f'large frame: {len(frame) / 1024 / 1024:.1f} MiB ({args.large:,} emojis, incremental)')
+    selected = codec.codec
+    element_ends = websocket._element_ends
+    try:
+        # 区切らずに、標準のjsonで1要素ずつ解析する場合を基準にする
+        websocket._element_ends = {}
+        codec.codec = codecs['json']
+        base, _ = _timeit(args.repeat, _decode_large, frame)
+        print(f"  {'json (1要素ずつ)':<16} decode: {base * 1000:>9.2f} ms")
+        websocket._element_ends = element_ends
+        for name in names:
+            codec.codec = codecs[name]
+            t, message = _timeit(args.repeat, _decode_large, frame)
+            body = message['body']
+            kind = type(body[0]).__name__ if len(body) > 0 else '-'
+            print(f'  {name:<20} decode: {t * 1000:>9.2f} ms  ({base / t:.1f}x, {kind})')
+    finally:
+        codec.codec = selected
+        websocket._element_ends = element_ends
+
+def _decode_large(frame):
+    return asyncio.run(websocket._decode_large(frame))
+
+
+def bench_gc(args):
+    """大きなフレームの解析にかかる時間と、その間のGCによる停止を、GCを止めた場合と比較します"""
+    frame = json.dumps({'op': 'emojis_update', 'body': make_emojis(args.size)}, ensure_ascii=False)
+    print(f'frame: {len(frame) / 1024 / 1024:.1f} MiB ({args.size:,} emojis)')
+    pauses = []
+    started = [0.]
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            pauses.append(time.perf_counter() - started[0])
+
+    gc.callbacks.append(on_gc)
+    try:
+        for name, pause_gc in [('gc', False), ('no gc', True)]:
+            times = []
+            max_pause = 0.
+            total_pause = 0.
+            count = 0
+            for _ in range(args.repeat):
+                gc.collect()
+                pauses.clear()
+                start = time.perf_counter()
+                data = asyncio.run(websocket._decode_large(frame, pause_gc))
+                times.append(time.perf_counter() - start)
+                max_pause = max(max_pause, *pauses, 0.)
+                total_pause += sum(pauses)
+                count += len(pauses)
+                del data
+            print(f'  {name:<6} decode: {min(times) * 1000:>8.1f} ms  gc: {count // args.repeat:>4} times {total_pause / args.repeat * 1000:>8.1f} ms  max pause: {max_pause * 1000:>7.1f} ms')
+    finally:
+        gc.callbacks.remove(on_gc)
+
+
+class _StubLogs():
+    def write_log(self, subject, text, data=None, error=False):
+        pass
+
+class _StubSettings():
+    def set_connect_state(self, state):
+        pass
+
+class _StubPage():
+    """画面無しで受信処理を動かすためのpage"""
+
+    def __init__(self):
+        self.data = {'logs': _StubLogs(), 'settings': _StubSettings()}
+
+def bench_replay(args):
+    clear_registry()
+    speed = args.speed if args.speed > 0 else None
+    page = _StubPage()
+    start = time.perf_counter()
+    asyncio.run(websocket.replay(args.path, page, speed))
+    registry.flush_changes()
+    elapsed = time.perf_counter() - start
+    print(f'replayed in {elapsed:.2f} s')
+    print(f'  emojis: {len(registry.emojis):,}  deleted: {len(registry.deleted):,}  users: {len(registry.users):,}  risks: {len(registry.risks):,}  reasons: {len(registry.reasons):,}')
+    stats = websocket.get_pipeline_stats()
+    print(f"  max queue depth: frames {stats['frames_max']}, messages {stats['messages_max']}")
+    for name, stage in stats['stages'].items():
+        if stage['count'] > 0:
+            print(f"  {name:<7} count: {stage['count']:>7,}  avg: {stage['avg_ms']:>9.3f} ms  max: {stage['max_ms']:>9.3f} ms")
+    clear_registry()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cotonestrum benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('memory', help='registry memory usage per emoji')
+    p.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser('filter', help='EmojiFilter evaluation time')
+    p.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_filter)
+
+    p = sub.add_parser('codec', help='JSON encode/decode time per codec')
+    p.add_argument('--size', type=int, default=20000, help='emojis in the synthesized frames')
+    p.add_argument('--payloads', help='file with one recorded frame per line (.gz allowed)')
+    p.add_argument('--large', type=int, default=100000, help='emojis in the large frame decoded incrementally')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser('gc', help='GC pauses while decoding a large frame')
+    p.add_argument('--size', type=int, default=100000, help='emojis in the synthesized frame')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_gc)
+
+    p = sub.add_parser('replay', help='feed a COTONESTRUM_RECORD recording through the receive pipeline')
+    p.add_argument('path')
+    p.add_argument('--speed', type=float, default=0, help='1 = original timing, 0 = as fast as possible')
+    p.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
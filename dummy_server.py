@@ -0,0 +1,372 @@
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import asyncio
+import argparse
+import datetime
+
+import websockets
+
+# 負荷試験用の、Recipiens Cotonestrumの代わりになるサーバー
+#
+# core/wsmsg.pyの操作に応答し、合成した絵文字・ユーザー・リスク・理由区分を返す
+# --storm-rateを指定すると、接続中のクライアントに更新を送り続ける
+#
+#   python dummy_server.py --emojis 100000
+#   (クライアントの接続先は 127.0.0.1:3005、トークンは何でもよい)
+
+
+NAME_WORDS = [
+    'neko', 'inu', 'usagi', 'kuma', 'pengin', 'kitsune', 'tanuki', 'hiyoko', 'sakana', 'tako',
+    'ohayou', 'oyasumi', 'otsukare', 'arigatou', 'omedetou', 'yoroshiku', 'sugoi', 'kawaii', 'tensai', 'yatta',
+    'ramen', 'sushi', 'onigiri', 'dango', 'pudding', 'mochi', 'curry', 'takoyaki', 'matcha', 'tempura',
+    'ame', 'yuki', 'hare', 'kaminari', 'sakura', 'momiji', 'hoshi', 'tsuki', 'taiyou', 'niji',
+    'kusa', 'wakaru', 'naruhodo', 'shinpai', 'bikkuri', 'nemui', 'hara_heta', 'ureshii', 'kanashii', 'okoru',
+]
+NAME_SUFFIXES = ['', '', '', '_2', '_big', '_mini', '_anim', '_blue', '_red', '_gaming', '_party', '_smile', '_cry']
+CATEGORIES = [
+    '動物', '食べ物', 'あいさつ', '顔', '記号', 'ミーム', 'ゲーム', '天気', '季節', '乗り物',
+    '文字', '手', '音楽', 'スポーツ', '旗', 'サーバー内ネタ', 'キャラクター', None,
+]
+TAGS = [
+    'ねこ', 'いぬ', 'うさぎ', 'かわいい', 'おはよう', 'おやすみ', 'おつかれ', 'ありがとう', 'ごはん', 'ラーメン',
+    'すし', 'あめ', 'ゆき', 'はれ', 'さくら', 'ほし', 'くさ', 'わかる', 'びっくり', 'ねむい',
+    'うれしい', 'かなしい', 'おこる', 'わらう', 'なく', 'はくしゅ', 'いいね', 'だめ', 'まる', 'ばつ',
+    '文字', '顔文字', '動く', 'gif', 'ドット絵', '手描き', 'ロゴ', '公式', '非公式', 'コラボ',
+]
+LICENSES = ['', '', 'CC0', 'CC BY 4.0', 'CC BY-SA 4.0', '自作', '作者の許可済み', 'https://example.com/license', None]
+USER_WORDS = [
+    'sakura', 'hinata', 'yuki', 'sora', 'haru', 'aoi', 'ren', 'mio', 'kaede', 'riku',
+    'nemu', 'tsumugi', 'kohaku', 'shiro', 'kuro', 'mugi', 'kinako', 'azuki', 'tofu', 'nori',
+]
+REASONS = ['権利者不明', '商標の可能性', '公序良俗', '重複', '画質が低い', 'センシティブ', '実在の人物', 'その他']
+REMARKS = ['', '', '', '要確認', '作者に問い合わせ中', '似た絵文字あり', 'ロゴに注意', '差し替え予定']
+DELETE_INFOS = ['権利者からの申し立てにより削除', '重複のため削除', '投稿者の依頼により削除', 'ガイドライン違反']
+
+ROLES = {
+    'user': "You logged in as 'User'.",
+    'emoji_moderator': "You logged in as 'Emoji moderator'.",
+    'moderator': "You logged in as 'Moderator'.",
+    'administrator': "You logged in as 'Administrator'.",
+}
+
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def _timestamp(rnd: random.Random) -> str:
+    t = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=rnd.randrange(60 * 60 * 24 * 365))
+    return t.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def _png(r, g, b, size=32) -> bytes:
+    """単色のPNG画像を作ります"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    raw = b''.join(b'\x00' + bytes([r, g, b]) * size for _ in range(size))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+class Dataset():
+    """合成したデータ"""
+
+    def __init__(self, nemojis: int, nusers: int, ndeleted: int, seed: int = 0):
+        self.rnd = random.Random(seed)
+        self.users: dict[str, dict] = {}
+        self.reasons: dict[str, dict] = {}
+        self.risks: dict[str, dict] = {}
+        self.emojis: dict[str, dict] = {}
+        self.deleted: dict[str, dict] = {}
+        self._next_id = 0
+
+        for _ in range(nusers):
+            uid = self.new_id('u')
+            self.users[uid] = {
+                'id': uid,
+                'misskey_id': self.new_id('9u'),
+                'username': f'{self.rnd.choice(USER_WORDS)}_{self.rnd.choice(USER_WORDS)}{self.rnd.randrange(100)}',
+            }
+        self._user_ids = list(self.users)
+        for text in REASONS:
+            self.add_reason(text)
+        for _ in range(nemojis):
+            self.add_emoji()
+        for _ in range(ndeleted):
+            self.add_deleted()
+
+    def new_id(self, prefix: str) -> str:
+        self._next_id += 1
+        return f'{prefix}{self._next_id:010d}'
+
+    def add_reason(self, text: str) -> dict:
+        rsid = self.new_id('rs')
+        t = now()
+        reason = {'id': rsid, 'text': text, 'created_at': t, 'updated_at': t}
+        self.reasons[rsid] = reason
+        return reason
+
+    def _add_risk(self) -> str:
+        rnd = self.rnd
+        rid = self.new_id('r')
+        t = _timestamp(rnd)
+        self.risks[rid] = {
+            'id': rid,
+            'checked': rnd.choice([0, 0, 0, 1, 1, 2]),
+            'level': rnd.choice([None, None, 0, 0, 1, 2, 3]),
+            'reason_genre': rnd.choice([None, None, None, *self.reasons]),
+            'remark': rnd.choice(REMARKS),
+            'created_at': t,
+            'updated_at': t,
+        }
+        return rid
+
+    def _emoji_fields(self) -> dict:
+        rnd = self.rnd
+        eid = self.new_id('e')
+        name = f'{rnd.choice(NAME_WORDS)}{rnd.choice(NAME_SUFFIXES)}'
+        if rnd.random() < 0.5:
+            name = f'{name}_{rnd.choice(NAME_WORDS)}'
+        return {
+            'id': eid,
+            'misskey_id': self.new_id('9x'),
+            'name': name,
+            'category': rnd.choice(CATEGORIES),
+            'tags': rnd.sample(TAGS, rnd.randrange(0, 6)),
+            'url': f'https://media.example.com/emoji/{eid}.webp',
+            'is_self_made': rnd.random() < 0.4,
+            'license': rnd.choice(LICENSES),
+            'owner_id': rnd.choice(self._user_ids) if len(self._user_ids) > 0 and rnd.random() < 0.95 else None,
+            'risk_id': self._add_risk(),
+        }
+
+    def add_emoji(self) -> dict:
+        emoji = self._emoji_fields()
+        t = _timestamp(self.rnd)
+        emoji['created_at'] = t
+        emoji['updated_at'] = t
+        self.emojis[emoji['id']] = emoji
+        return emoji
+
+    def add_deleted(self) -> dict:
+        rnd = self.rnd
+        emoji = self._emoji_fields()
+        emoji['image_backup'] = base64.b64encode(_png(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))).decode('ascii')
+        emoji['info'] = rnd.choice(DELETE_INFOS)
+        emoji['deleted_at'] = _timestamp(rnd)
+        self.deleted[emoji['id']] = emoji
+        return emoji
+
+    def set_risk_props(self, rid: str, props: dict) -> dict | None:
+        risk = self.risks.get(rid)
+        if risk is None:
+            return None
+        if 'checked' in props:
+            risk['checked'] = props['checked']
+        if 'level' in props:
+            risk['level'] = props['level']
+        if 'reason_id' in props:
+            risk['reason_genre'] = props['reason_id']
+        if 'remark' in props:
+            risk['remark'] = props['remark']
+        risk['updated_at'] = now()
+        return risk
+
+
+def _since(records, field, since):
+    if since is None:
+        return list(records)
+    return [i for i in records if i[field] is not None and i[field] > since]
+
+
+class Server():
+    def __init__(self, data: Dataset, args):
+        self.data = data
+        self.args = args
+        self.clients = set()
+
+    async def send(self, ws, op, body, reqid=None):
+        msg = {'op': op}
+        if reqid is not None:
+            msg['reqid'] = reqid
+        msg['body'] = body
+        frame = json.dumps(msg, ensure_ascii=False)
+        await ws.send(frame)
+        return len(frame.encode('utf-8'))
+
+    def broadcast(self, op, body):
+        frame = json.dumps({'op': op, 'body': body}, ensure_ascii=False)
+        websockets.broadcast(self.clients, frame)
+
+    async def handler(self, ws):
+        connected = time.perf_counter()
+        fetched = set()
+        sent = 0
+        authed = False
+        print(f'client connected: {ws.remote_address}')
+        try:
+            async for frame in ws:
+                try:
+                    msg = json.loads(frame)
+                    op = msg['op']
+                    reqid = msg.get('reqid')
+                    body = msg.get('body') or {}
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                if op == 'auth':
+                    authed = True
+                    self.clients.add(ws)
+                    message = f"{ROLES[self.args.role]} (Username: {self.args.username})"
+                    await self.send(ws, 'ok', {'op': op, 'message': message}, reqid)
+                    continue
+                if not authed:
+                    await self.send(ws, 'denied', {'op': op, 'message': 'You are not authenticated.'}, reqid)
+                    continue
+
+                try:
+                    n = await self.handle(ws, op, body, reqid)
+                except Exception as e:
+                    await self.send(ws, 'internal_error', {'op': op, 'message': repr(e)}, reqid)
+                    continue
+                if n is None:
+                    continue
+                sent += n
+                if op.startswith('fetch_all_'):
+                    fetched.add(op)
+                    if len(fetched) == 5:
+                        elapsed = time.perf_counter() - connected
+                        print(f'initial fetch served in {elapsed:.2f} s ({sent / 1024 / 1024:.1f} MiB)')
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(ws)
+            print(f'client disconnected: {ws.remote_address}')
+
+    async def handle(self, ws, op, body, reqid) -> int | None:
+        """操作に応答し、送ったバイト数を返します"""
+        data = self.data
+        sent = 0
+        match op:
+            case 'fetch_all_emojis':
+                sent += await self._send_list(ws, 'emojis_update', _since(data.emojis.values(), 'updated_at', body.get('since')))
+            case 'fetch_all_deleted_emojis':
+                sent += await self._send_list(ws, 'deleted_emojis_update', _since(data.deleted.values(), 'deleted_at', body.get('since')))
+            case 'fetch_all_users':
+                sent += await self._send_list(ws, 'users_update', list(data.users.values()))
+            case 'fetch_all_risks':
+                sent += await self._send_list(ws, 'risks_update', _since(data.risks.values(), 'updated_at', body.get('since')))
+            case 'fetch_all_reasons':
+                sent += await self._send_list(ws, 'reasons_update', _since(data.reasons.values(), 'updated_at', body.get('since')))
+            case 'fetch_emoji' | 'fetch_user' | 'fetch_risk' | 'fetch_reason':
+                kind = op[len('fetch_'):]
+                records = {'emoji': data.emojis, 'user': data.users, 'risk': data.risks, 'reason': data.reasons}[kind]
+                record = records.get(body.get('id'))
+                if record is None:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Not found.'}, reqid)
+                sent += await self.send(ws, f'{kind}_update', record)
+            case 'set_risk_prop':
+                risk = data.set_risk_props(body.get('id'), body.get('props', {}))
+                if risk is None:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Risk not found.'}, reqid)
+                self.broadcast('risk_update', risk)
+            case 'set_risk_props_bulk':
+                if self.args.no_bulk:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Unknown operation.'}, reqid)
+                risks = [data.set_risk_props(rid, body.get('props', {})) for rid in body.get('ids', [])]
+                self.broadcast('risks_update', [i for i in risks if i is not None])
+            case 'set_deleted_reason':
+                emoji = data.deleted.get(body.get('id'))
+                if emoji is None:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Emoji not found.'}, reqid)
+                emoji['info'] = body.get('info')
+                self.broadcast('deleted_emoji_update', emoji)
+            case 'create_reason':
+                self.broadcast('reason_update', data.add_reason(body.get('text')))
+            case 'set_reason_text':
+                reason = data.reasons.get(body.get('id'))
+                if reason is None:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Reason not found.'}, reqid)
+                reason['text'] = body.get('text')
+                reason['updated_at'] = now()
+                self.broadcast('reason_update', reason)
+            case 'delete_reason':
+                if data.reasons.pop(body.get('id'), None) is None:
+                    return await self.send(ws, 'error', {'op': op, 'message': 'Reason not found.'}, reqid)
+                self.broadcast('reason_delete', {'id': body.get('id')})
+            case _:
+                return await self.send(ws, 'error', {'op': op, 'message': 'Unknown operation.'}, reqid)
+        sent += await self.send(ws, 'ok', {'op': op}, reqid)
+        return sent
+
+    async def _send_list(self, ws, op, records) -> int:
+        chunk = self.args.chunk if self.args.chunk > 0 else max(1, len(records))
+        sent = 0
+        for i in range(0, len(records), chunk):
+            sent += await self.send(ws, op, records[i:i + chunk])
+        if len(records) == 0:
+            sent += await self.send(ws, op, [])
+        return sent
+
+    async def storm(self):
+        """接続中のクライアントに更新を送り続けます"""
+        args = self.args
+        data = self.data
+        rnd = random.Random(args.seed + 1)
+        interval = 1 / args.storm_rate
+        ticks = 0
+        while True:
+            await asyncio.sleep(interval)
+            if len(self.clients) == 0:
+                continue
+            ticks += 1
+            rids = rnd.sample(list(data.risks), min(args.storm_batch, len(data.risks)))
+            risks = [data.set_risk_props(rid, {'level': rnd.choice([None, 0, 1, 2, 3]), 'checked': rnd.choice([0, 1])}) for rid in rids]
+            self.broadcast('risks_update', risks)
+            if ticks % 10 == 0:
+                # 時々、絵文字の追加・変更・削除も混ぜる
+                emojis = [data.add_emoji() for _ in range(max(1, args.storm_batch // 10))]
+                self.broadcast('emojis_update', emojis)
+                for risk_id in [i['risk_id'] for i in emojis]:
+                    self.broadcast('risk_update', data.risks[risk_id])
+                eid = rnd.choice(list(data.emojis))
+                data.emojis.pop(eid)
+                self.broadcast('emoji_delete', {'id': eid})
+
+
+async def serve(args):
+    started = time.perf_counter()
+    data = Dataset(args.emojis, args.users, args.deleted, args.seed)
+    print(f'generated {len(data.emojis):,} emojis, {len(data.deleted):,} deleted emojis, {len(data.users):,} users in {time.perf_counter() - started:.2f} s')
+    server = Server(data, args)
+    async with websockets.serve(server.handler, args.host, args.port, max_size=None):
+        print(f'listening on ws://{args.host}:{args.port}/')
+        if args.storm_rate > 0:
+            await server.storm()
+        else:
+            await asyncio.Future()
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in Recipiens Cotonestrum server for load testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3005)
+    parser.add_argument('--emojis', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--deleted', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--role', choices=list(ROLES), default='moderator')
+    parser.add_argument('--username', default='dummy')
+    parser.add_argument('--chunk', type=int, default=0, help='records per *_update frame (0 = one frame)')
+    parser.add_argument('--no-bulk', action='store_true', help='reject set_risk_props_bulk like an older server')
+    parser.add_argument('--storm-rate', type=float, default=0, help='update pushes per second (0 = off)')
+    parser.add_argument('--storm-batch', type=int, default=100, help='risks changed per push')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@ class LoadingRing(ft.Container):
         super().__init__()
 
         self.counter = 0
-
+        # 進み具合の表示 (表示していない場合はNone)
+        self.progress: str | None = None
 
         self.bgcolor='#40000000'
 
@@ -27,6 +28,14 @@ class LoadingRing(ft.Container):
             style=ft.TextStyle(weight=ft.FontWeight.BOLD),
         )
 
+        self.text_box = ft.Container(
+            content=self.text,
+            width=20,
+            height=40,
+            alignment=ft.alignment.center,
+            offset=ft.Offset(-0.25, 0.0),
+        )
+
         self.content = ft.Row(
             controls=[
                 ft.Container(
@@ -41,26 +50,58 @@ class LoadingRing(ft.Container):
                     height=40,
                     alignment=ft.alignment.center,
                 ),
-                ft.Container(
-                    content=self.text,
-                    width=20,
-                    height=40,
-                    alignment=ft.alignment.center,
-                    offset=ft.Offset(-0.25, 0.0),
-                ),
+                self.text_box,
             ],
             alignment=ft.alignment.center_left,
             spacing=0,
         )
 
 
+    def _layout(self):
+        if self.progress is not None:
+            self.text_box.width = max(60, len(self.progress) * 9)
+            self.width = 40 + self.text_box.width
+            self.text.value = self.progress
+        else:
+            self.width = 60 if self.counter > 1 else 40
+            self.text_box.width = 20
+            self.text.value = str(self.counter) if self.counter > 1 else ''
+
+    def set_progress(self, done: int, total: int, note: str | None = None):
+        """時間のかかる処理の進み具合を表示します noteは割合の後ろに添えます (残り時間など)"""
+        if total <= 0:
+            return
+        self.progress = f'{done * 100 // total}%'
+        if note is not None:
+            self.progress += f' {note}'
+        if self.counter >= 1:
+            self._layout()
+            self.update()
+
+    def clear_progress(self):
+        if self.progress is None:
+            return
+        self.progress = None
+        if self.counter >= 1:
+            self._layout()
+            self.update()
+
+    def set_cancel(self, on_cancel=None):
+        """クリックで処理を中止できるようにします Noneで元に戻します"""
+        if on_cancel is not None:
+            self.on_click = lambda e: on_cancel()
+            self.tooltip = 'クリックで中止'
+        else:
+            self.on_click = None
+            self.tooltip = None
+        self.update()
+
     def hide(self, enforce=False):
         if not enforce:
             self.counter -= 1
             if self.counter >= 1:
-                self.width = 60 if self.counter > 1 else 40
-                self.text.value = str(self.counter) if self.counter > 1 else ''
-                self.text.update()
+                self._layout()
+                self.update()
             if self.counter == 0:
                 self.width = 0
                 self.offset = ft.Offset(1.0, 0.0)
@@ -69,6 +110,7 @@ class LoadingRing(ft.Container):
                 self.counter = 0
         else:
             self.counter = 0
+            self.progress = None
             self.text.value = ''
             self.width = 0
             self.offset = ft.Offset(1.0, 0.0)
@@ -76,10 +118,7 @@ class LoadingRing(ft.Container):
 
     def show(self):
         self.counter += 1
-        self.width = 60 if self.counter > 1 else 40
-        if self.counter > 1:
-            self.text.value = str(self.counter)
-            self.text.update()
+        self._layout()
         self.offset = ft.Offset(0.0, 0.0)
         self.update()
 
@@ -3,6 +3,8 @@ from typing import Union
 import flet as ft
 
 from core import registry
+from core import aggregates
+from core.changes import ChangeSet
 
 # ほしいのは以下の通り
 # ようこそメッセージ
@@ -28,6 +30,26 @@ class PanelDashboard(ft.Container):
         """ダッシュボードのメインフレーム"""
         return self._main_frame
 
+    def did_mount(self):
+        registry.subscribe(self.on_registry_changes)
+
+    def will_unmount(self):
+        registry.unsubscribe(self.on_registry_changes)
+
+    def on_registry_changes(self, changes: ChangeSet):
+        # 表示されていないときは、ダッシュボードに移動した際にreload_allされる
+        if not self.visible:
+            return
+        if not changes.emojis.is_empty() or not changes.deleted.is_empty():
+            self.reload_all()
+            return
+        if not changes.risks.is_empty():
+            self.reload_risks()
+        if not changes.users.is_empty():
+            self.reload_users()
+        if not changes.risks.is_empty() or not changes.reasons.is_empty():
+            self.reload_reasons()
+
     def reload_all(self):
         self._main_frame.reload_emojis()
         self._main_frame.reload_risks()
@@ -106,35 +128,19 @@ class DashboardMainFrame(ft.Column):
         return self._reason_pie_chart
 
     def reload_emojis(self):
-        count = len(registry.emojis)
+        count = aggregates.emoji_count
         self._emoji_status._emoji_count.change_count(count)
 
     def reload_risks(self):
-        nchecked, nnochecked = 0, 0
-        nrisku, nrisk0, nrisk1, nrisk2, nrisk3 = 0, 0, 0, 0, 0
-        for emoji in registry.emojis.values():
-            rid = emoji.risk_id
-            risk = registry.get_risk(rid)
-            if risk is None:
-                nrisku += 1
-                nnochecked += 1
-            else:
-                match risk.level:
-                    case 0:
-                        nrisk0 += 1
-                    case 1:
-                        nrisk1 += 1
-                    case 2:
-                        nrisk2 += 1
-                    case 3:
-                        nrisk3 += 1
-                    case _:
-                        nrisku += 1
-                match risk.checked:
-                    case 1:
-                        nchecked += 1
-                    case _:
-                        nnochecked += 1
+        snapshot = aggregates.snapshot()
+        levels = snapshot.risk_levels
+        nrisku = levels.get(None, 0)
+        nrisk0 = levels.get(0, 0)
+        nrisk1 = levels.get(1, 0)
+        nrisk2 = levels.get(2, 0)
+        nrisk3 = levels.get(3, 0)
+        nchecked = snapshot.check_statuses.get(1, 0)
+        nnochecked = snapshot.emoji_count - nchecked
 
         labels = ['危険度: 低', '危険度: 中', '危険度: 高', '危険度: 重大', '未設定']
         values = [nrisk0, nrisk1, nrisk2, nrisk3, nrisku]
@@ -151,8 +157,7 @@ class DashboardMainFrame(ft.Column):
 
     def reload_users(self):
         users = {}
-        for emoji in registry.emojis.values():
-            uid = emoji.owner_id
+        for uid, count in aggregates.snapshot().owners.items():
             user = registry.get_user(uid)
             if user is not None:
                 name = user.username
@@ -162,7 +167,7 @@ class DashboardMainFrame(ft.Column):
                 name = '<Unknown>'
             if name not in users:
                 users[name] = 0
-            users[name] += 1
+            users[name] += count
 
         labels = list(users.keys())
         values = list(users.values())
@@ -170,17 +175,7 @@ class DashboardMainFrame(ft.Column):
         self._user_pie_chart.update_chart(labels, values, colors)
 
     def reload_reasons(self):
-        reasons = {}
-        for emoji in registry.emojis.values():
-            rid = emoji.risk_id
-            risk = registry.get_risk(rid)
-            if risk is None:
-                rsid = None
-            else:
-                rsid = risk.reason_genre
-            if rsid not in reasons:
-                reasons[rsid] = 0
-            reasons[rsid] += 1
+        reasons = aggregates.snapshot().reasons
 
         labels = list(reasons.keys())
         for i in range(len(labels)):
@@ -1,7 +1,7 @@
 import re
 import csv
+import math
 import traceback
-import asyncio
 
 import flet as ft
 
@@ -9,6 +9,9 @@ from app.panels.logs import PanelLogs
 from app.utils.data import KeyboardBehaviorData
 from core import registry
 from core import websocket
+from core import imageproxy
+from core.changes import ChangeSet
+from core.selection import Selection
 from core.filtering import DeletedEmojiFilter
 from core.filtering import SelectionIsSelfMade, SelectionRiskLevel, SelectionReasonGenre, SelectionCheckStatus
 
@@ -20,6 +23,13 @@ from app.sidebar import Sidebar
 
 TEXTS = TEXT_FIELDS.DELETED_EMOJIS
 
+# 一覧の行の高さ
+ITEM_EXTENT = 50
+# 表示範囲の大きさが分かるまでに想定する、画面に収まる行数
+VISIBLE_ROWS = 30
+# 画面外に余分に用意しておく行数
+OVERSCAN_ROWS = 10
+
 class PanelDeletedEmojis(ft.Row):
 
     def __init__(self):
@@ -32,8 +42,10 @@ class PanelDeletedEmojis(ft.Row):
         self.filter = DeletedEmojiFilter.no_filter()
         self.filtered_emojis = {}
 
-        self.selected: set[DeletedEmojiItem] = set()
-        self.multiselect_origin: DeletedEmojiItem | None = None
+        # 選択状態は行ではなく絵文字IDで持つ (行はスクロールに合わせて使い回されるため)
+        # 画面外の絵文字も含めた、一覧全体での選択
+        self.selected = Selection(self.filtered_emojis)
+        self.multiselect_origin: str | None = None
 
         self.count_emojis = 0
 
@@ -66,38 +78,78 @@ class PanelDeletedEmojis(ft.Row):
 
     def add_emoji(self, eid: str):
         self.all_emojis[eid] = None
-        if self.filter.filter(eid):
-            self.filtered_emojis[eid] = None
-            if eid in self.list_emoji.emojis:
-                self.list_emoji.update_emoji(eid)
+        self.recheck_emojis([eid], True)
 
     def remove_emoji(self, eid: str):
-        if eid in self.all_emojis:
-            self.list_emoji.delete_emoji(eid)
-            del self.all_emojis[eid]
-            if eid in self.filtered_emojis:
-                del self.filtered_emojis[eid]
+        self.remove_emojis([eid])
 
     def add_emojis(self, eids: list[str]):
-        need_update = []
         for eid in eids:
             self.all_emojis[eid] = None
+        self.recheck_emojis(eids, True)
+
+    def recheck_emojis(self, eids, _update_items=False):
+        """指定した絵文字だけフィルターで再判定します
+        一致しなくなった絵文字は一覧から取り除かれます"""
+        need_update = []
+        need_delete = []
+        need_refresh = False
+        for eid in eids:
+            if eid not in self.all_emojis:
+                continue
             if self.filter.filter(eid):
-                self.filtered_emojis[eid] = None
-                if eid in self.list_emoji.emojis:
+                if eid not in self.filtered_emojis:
+                    self.filtered_emojis[eid] = None
+                    # 全選択の後から一覧に加わった絵文字は選択しない
+                    self.selected.discard(eid)
+                    need_refresh = True
+                elif _update_items and eid in self.list_emoji.emojis:
                     need_update.append(eid)
-        self.list_emoji.update_emojis(need_update)
+            elif eid in self.filtered_emojis:
+                del self.filtered_emojis[eid]
+                need_delete.append(eid)
+        self.deselect(need_delete)
+        if need_refresh or len(need_delete) > 0:
+            self.list_emoji.refresh()
+        elif _update_items:
+            self.list_emoji.update_emojis(need_update)
 
     def remove_emojis(self, eids: list[str]):
         eeids = []
         for eid in eids:
             if eid in self.all_emojis:
                 eeids.append(eid)
-        self.list_emoji.delete_emojis(eeids)
+        removed = []
         for eid in eeids:
             del self.all_emojis[eid]
             if eid in self.filtered_emojis:
                 del self.filtered_emojis[eid]
+                removed.append(eid)
+        if len(eeids) > 0:
+            self.deselect(removed)
+            self.list_emoji.refresh()
+
+    def did_mount(self):
+        registry.subscribe(self.on_registry_changes)
+
+    def will_unmount(self):
+        registry.unsubscribe(self.on_registry_changes)
+
+    def on_registry_changes(self, changes: ChangeSet):
+        eids = changes.deleted.changed()
+        if len(eids) > 0:
+            self.add_emojis(eids)
+        if len(changes.deleted.removed) > 0:
+            self.remove_emojis(list(changes.deleted.removed))
+        # 参照しているリスクやユーザーが変わった絵文字だけを再判定する
+        affected = self.filter.affected_by(changes)
+        if len(affected) > 0:
+            self.recheck_emojis(affected.difference(eids))
+        if len(self.selected) > 0 and not (changes.risks.is_empty() and changes.deleted.is_empty()):
+            # 画面外の選択中の絵文字は行が無いので、一括変更欄を直接更新する
+            self.bulk.update_values()
+        if not changes.reasons.is_empty():
+            self.reload_reasons()
 
     def lock(self):
         lr: LoadingRing = self.page.data['loading']
@@ -116,22 +168,13 @@ class PanelDeletedEmojis(ft.Row):
 
     def unload_all(self):
         self.bulk.all_deselect(None)
-        self.list_emoji.delete_all_emojis()
-        self.list_emoji.update()
+        self.list_emoji.unload()
 
-    def load_next(self, count=50):
+    def load_list(self):
         if self.loading: return
         self.loading = True
         self.lock()
-        if len(self.list_emoji.controls) > 0:
-            if isinstance(self.list_emoji.controls[-1], MoreLoad):
-                del self.list_emoji.controls[-1]
-        eids = [eid for eid in self.filtered_emojis if eid not in self.list_emoji.emojis.keys()]
-        if len(eids) > count:
-            eids = eids[:count]
-        self.list_emoji.update_emojis(eids, False)
-        self.list_emoji.controls.append(MoreLoad(self))
-        self.list_emoji.update()
+        self.list_emoji.load()
         self.unlock()
         self.loading = False
 
@@ -139,10 +182,28 @@ class PanelDeletedEmojis(ft.Row):
         self.bulk.update_selected()
 
     def all_deselect(self):
-        for e in self.selected:
-            e.checkbox.value = False
-        self.list_emoji.update()
         self.selected.clear()
+        self.multiselect_origin = None
+        self.list_emoji.reload_selected()
+
+    def select_all(self):
+        self.selected.select_all()
+        self.multiselect_origin = None
+        self.list_emoji.reload_selected()
+        self.update_selected()
+
+    def invert_selection(self):
+        self.selected.invert()
+        self.multiselect_origin = None
+        self.list_emoji.reload_selected()
+        self.update_selected()
+
+    def deselect(self, eids):
+        """一覧から外れた絵文字を選択から取り除きます"""
+        if self.multiselect_origin in eids:
+            self.multiselect_origin = None
+        if self.selected.forget(eids):
+            self.update_selected()
 
     def reload_reasons(self):
         self.list_emoji.reload_dropdown()
@@ -156,8 +217,9 @@ class PanelDeletedEmojis(ft.Row):
         self.header.set_filtering_status(filter.get_filter_status())
         eids = list(self.all_emojis.keys())
         self.filtered_emojis = {eid: None for eid in filter.filter_all(eids)}
+        self.selected.reset(self.filtered_emojis)
         self.unload_all()
-        self.load_next()
+        self.load_list()
 
     def write_csv(self, eids, filename) -> int | None:
         panel_logs: PanelLogs = self.page.data['logs']
@@ -260,7 +322,7 @@ class PanelDeletedEmojis(ft.Row):
         self.loading = True
         self.lock()
 
-        eids = [eid for eid, emoji in self.list_emoji.emojis.items() if emoji.checkbox.value]
+        eids = self.selected.ordered()
         if len(eids) > 0:
             if self.write_csv(eids, 'out_deleted_emojis.csv'):
                 ret = len(eids)
@@ -395,56 +457,132 @@ class DeletedEmojiList(ft.ListView):
 
         self.main = main
 
+        # 表示中の行 (スクロールに合わせて行と絵文字IDの対応が変わる)
         self.emojis: dict[str, DeletedEmojiItem] = {}
+        # 一覧に並ぶすべての絵文字ID (filtered_emojisと同じ並び)
+        self.eids: list[str] = []
+        # eidsでの位置 範囲選択のときに作る
+        self._positions: dict[str, int] | None = None
+        # 使い回す行 画面に収まる数+前後の余裕分だけ作る
+        self.rows: list[DeletedEmojiItem] = []
+        self.start = 0
+        self.visible_rows = VISIBLE_ROWS
+        self.active = False
 
         self.expand = True
 
-        self.item_extent = 50
+        # 行の高さは固定(ITEM_EXTENT)なので、画面外の行は高さだけを持つ余白で置き換える
+        # item_extentは余白にも適用されてしまうため指定しない
+        self.top_spacer = ft.Container(height=0)
+        self.bottom_spacer = ft.Container(height=0)
+
+        self.on_scroll = self.scroll_list
 
         self.controls = []
 
-    def update_emoji(self, eid: str, _update=True):
-        emoji_data = registry.get_deleted_emoji(eid)
-        if emoji_data is None:
-            print(f"Deleted emoji '{eid}' couldn't found in registry.")
+    def load(self):
+        self.active = True
+        self.start = 0
+        self.refresh()
+
+    def unload(self):
+        self.active = False
+        self.eids = []
+        self._positions = None
+        self.emojis = {}
+        self.rows = []
+        self.start = 0
+        self.main.count_emojis = 0
+        self.controls = []
+        self.update()
+
+    def refresh(self, _update=True):
+        """filtered_emojisの変更を一覧に反映します"""
+        if not self.active:
             return
+        self.eids = list(self.main.filtered_emojis)
+        self._positions = None
+        self.main.count_emojis = len(self.eids)
+        self._render()
+        if _update:
+            self.update()
+
+    def position(self, eid: str) -> int:
+        """一覧全体での絵文字の位置を返します"""
+        if self._positions is None:
+            self._positions = {eid: i for i, eid in enumerate(self.eids)}
+        return self._positions[eid]
+
+    def scroll_list(self, e: ft.OnScrollEvent):
+        if not self.active or e.pixels is None:
+            return
+        visible_rows = VISIBLE_ROWS
+        if e.viewport_dimension is not None:
+            visible_rows = max(VISIBLE_ROWS, math.ceil(e.viewport_dimension / ITEM_EXTENT))
+        # 表示範囲はOVERSCAN_ROWS単位で動かし、少しのスクロールでは行を割り当て直さない
+        first = int(e.pixels // ITEM_EXTENT)
+        start = max(0, (first // OVERSCAN_ROWS - 1) * OVERSCAN_ROWS)
+        if start != self.start or visible_rows != self.visible_rows:
+            self.start = start
+            self.visible_rows = visible_rows
+            self._render()
+            self.update()
 
-        eid = emoji_data.id
-        name = emoji_data.name
-        category = emoji_data.category
-        tags = emoji_data.tags
-        url = emoji_data.url
-        image_backup = emoji_data.image_backup
-        sm = emoji_data.is_self_made
-        license = emoji_data.license
+    def _render(self):
+        n = len(self.eids)
+        nrows = min(n, self.visible_rows + OVERSCAN_ROWS * 3)
+        self.start = max(0, min(self.start, n - nrows))
+
+        emojis = {}
+        for i, eid in enumerate(self.eids[self.start:self.start + nrows]):
+            if i < len(self.rows):
+                e = self.rows[i]
+                if e.eid != eid:
+                    self._bind(e, eid)
+                e.visible = True
+            else:
+                e = self._create(eid)
+                self.rows.append(e)
+            emojis[eid] = e
+        for e in self.rows[nrows:]:
+            e.eid = None
+            e.visible = False
+        self.emojis = emojis
+
+        self.top_spacer.height = self.start * ITEM_EXTENT
+        self.bottom_spacer.height = (n - self.start - nrows) * ITEM_EXTENT
+        self.controls = [self.top_spacer, *self.rows, self.bottom_spacer]
+
+    def _item_args(self, emoji_data) -> tuple:
+        if emoji_data is None:
+            return ('', '', [], '', None, False, '', None, None, '')
         owner = emoji_data.owner_id
-        risk_id = emoji_data.risk_id
-        info = emoji_data.info
         if owner is not None:
-            owner = f'<{owner}>'
-
-        if eid in self.emojis:
-            e: DeletedEmojiItem = self.emojis[eid]
-            e.update_name(name)
-            e.update_category(category)
-            e.update_tags(tags)
-            e.update_url(url)
-            e.update_image_backup(image_backup)
-            e.update_self_made(sm)
-            e.update_license(license)
-            e.update_username(owner)
-            e.update_info(info)
-            if e.risk_id != risk_id:
-                e.change_risk_id(risk_id)
+            user = registry.get_user(owner)
+            username = user.username if user is not None else f'<{owner}>'
         else:
-            e = DeletedEmojiItem(self.main, eid, name, category, tags, url, image_backup, sm, license, owner, risk_id, info)
+            username = None
+        return (emoji_data.name, emoji_data.category, emoji_data.tags, emoji_data.url, emoji_data.image_backup, emoji_data.is_self_made, emoji_data.license, username, emoji_data.risk_id, emoji_data.info)
+
+    def _create(self, eid: str):
+        emoji_data = registry.get_deleted_emoji(eid)
+        if emoji_data is None:
+            print(f"Deleted emoji '{eid}' couldn't found in registry.")
+        e = DeletedEmojiItem(self.main, eid, *self._item_args(emoji_data))
+        e.checkbox.value = eid in self.main.selected
+        return e
 
-            self.emojis[eid] = e
+    def _bind(self, e, eid: str):
+        emoji_data = registry.get_deleted_emoji(eid)
+        if emoji_data is None:
+            print(f"Deleted emoji '{eid}' couldn't found in registry.")
+        e.bind(eid, *self._item_args(emoji_data))
 
-            self.controls.append(e)
+    def update_emoji(self, eid: str, _update=True):
+        if eid in self.emojis:
+            self._bind(self.emojis[eid], eid)
             if _update:
                 self.update()
-            self.main.count_emojis += 1
 
     def update_emojis(self, eids: list[str], _update=True):
         for eid in eids:
@@ -452,29 +590,11 @@ class DeletedEmojiList(ft.ListView):
         if _update:
             self.update()
 
-    def delete_emoji(self, eid: str, _update=True):
-        if eid in self.emojis:
-            e = self.emojis[eid]
-            if e.checkbox.value:
-                e.toggle_selected(None)
-            if e == self.main.multiselect_origin:
-                self.main.multiselect_origin = None
-
-            self.controls.remove(e)
-            if _update:
-                self.update()
-            del self.emojis[eid]
-            self.main.count_emojis -= 1
-
-    def delete_emojis(self, eids: list[str]):
-        for eid in eids:
-            self.delete_emoji(eid, False)
-        self.update()
-
-    def delete_all_emojis(self):
-        for eid in list(self.emojis.keys()):
-            self.delete_emoji(eid, False)
-        self.update()
+    def reload_selected(self):
+        for eid, e in self.emojis.items():
+            e.checkbox.value = eid in self.main.selected
+        if self.active:
+            self.update()
 
     def reload_risk(self, rid: str):
         for e in self.emojis.values():
@@ -487,9 +607,30 @@ class DeletedEmojiList(ft.ListView):
                 e.update_risk(level, reason, remark, status)
 
     def reload_dropdown(self):
-        for e in self.emojis.values():
+        for e in self.rows:
             e.reload_dropdown()
 
+    def get_values(self, eid: str) -> tuple:
+        """一括変更欄の表示に使う値 (危険度, 理由区分, 備考, 状態, 削除要因) を返します
+        表示中の行があれば行の値を、無ければregistryの値を使います"""
+        if eid in self.emojis:
+            e = self.emojis[eid]
+            return e.risk_level.value, e.reason.content.value, e.remark.content.value, e.status_value, e.delete_info.content.value
+        emoji = registry.get_deleted_emoji(eid)
+        if emoji is None:
+            return None, None, None, 0, None
+        risk = registry.get_risk(emoji.risk_id)
+        if risk is None:
+            return None, None, None, 0, emoji.info
+        level = f'risk_{risk.level}' if risk.level in [0, 1, 2, 3] else None
+        return level, risk.reason_genre, risk.remark, risk.checked, emoji.info
+
+    def change_info(self, eid: str, text):
+        if eid in self.emojis:
+            self.emojis[eid].change_info(text, False)
+        else:
+            websocket.change_info(eid, text, self.page)
+
 class DeletedEmojiItem(ft.Container):
     def __init__(self, main: PanelDeletedEmojis, eid: str, name: str, category: str, tags: list[str], url: str, image_backup: str | None, is_self_made: bool, license: str, username: str | None, risk_id: str, info: str):
         super().__init__()
@@ -499,6 +640,9 @@ class DeletedEmojiItem(ft.Container):
         self.eid = eid
 
         self.username_resolved = False
+        # registryに届くのを待っているユーザーID・リスクID
+        self.waiting_user: str | None = None
+        self.waiting_risk: str | None = None
         self.dropdown_keys = []
 
         self.name = name
@@ -509,6 +653,7 @@ class DeletedEmojiItem(ft.Container):
         self.license = license
         if username is not None:
             self.username = username
+            self.username_resolved = not (username.startswith('<') and username.endswith('>'))
         else:
             self.username_resolved = True
             self.username = TEXTS.USERNAME_UNRESOLVED
@@ -517,12 +662,7 @@ class DeletedEmojiItem(ft.Container):
 
         self.info = info
 
-        # 上書き用urlが存在するなら絵文字の画像urlを上書きする
-        override_image_url = main.page.data['settings'].override_image_url
-        if override_image_url is not None:
-            override_emoji_url: str = override_image_url.value
-            if override_emoji_url is not None and len(override_emoji_url.strip()) > 0:
-                self.emoji_url = re.sub(r'(https?://)[a-zA-Z0-9\-\.:]+(/.*)$', r'\g<1>' + override_emoji_url + r'\g<2>', self.emoji_url)
+        self.emoji_url = self.override_url(self.emoji_url)
 
         self.status_value = 0
 
@@ -533,34 +673,37 @@ class DeletedEmojiItem(ft.Container):
         )
 
         if self.image_backup is not None:
-            error_content = ft.Image(
-                src_base64=self.image_backup,
-                error_content=ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030'),
-            )
             error_content46 = ft.Image(
-                src_base64=self.image_backup,
+                src=imageproxy.blob_url(self.image_backup, thumbnail=True),
                 width=46,
                 height=46,
                 fit=ft.ImageFit.CONTAIN,
                 error_content=ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030'),
             )
         else:
-            error_content = ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030')
             error_content46 = ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030')
         def show_image(e):
+            # 行は別の絵文字に割り当て直されるので、表示する時点の画像を使う
+            if self.image_backup is not None:
+                error_content = ft.Image(
+                    src=imageproxy.blob_url(self.image_backup),
+                    error_content=ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030'),
+                )
+            else:
+                error_content = ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030')
             self.page.show_dialog(
                 ft.AlertDialog(
                     title=ft.Text(TEXTS.IMAGE_DIALOG_TITLE),
                     title_padding=10,
                     content=ft.Image(
-                        src=self.emoji_url,
+                        src=imageproxy.proxy_url(self.emoji_url),
                         error_content=error_content,
                     )
                 )
             )
         self.emoji_image = ft.Container(
             content=ft.Image(
-                src=self.emoji_url,
+                src=imageproxy.thumbnail_url(self.emoji_url),
                 width=46,
                 height=46,
                 fit=ft.ImageFit.CONTAIN,
@@ -846,8 +989,57 @@ class DeletedEmojiItem(ft.Container):
 
     def did_mount(self):
         self.reload_dropdown()
-        self.page.run_task(self.get_username)
-        self.page.run_task(self.get_risk)
+        if not self.username_resolved:
+            self.wait_username(self.username[1:-1])
+        self.load_risk()
+        self.update()
+
+    def will_unmount(self):
+        self.cancel_waits()
+
+    def override_url(self, url: str) -> str:
+        # 上書き用urlが存在するなら絵文字の画像urlを上書きする
+        override_image_url = self.main.page.data['settings'].override_image_url
+        if override_image_url is not None:
+            override_emoji_url: str = override_image_url.value
+            if override_emoji_url is not None and len(override_emoji_url.strip()) > 0:
+                url = re.sub(r'(https?://)[a-zA-Z0-9\-\.:]+(/.*)$', r'\g<1>' + override_emoji_url + r'\g<2>', url)
+        return url
+
+    def bind(self, eid, name, category, tags, url, image_backup, is_self_made, license, username, risk_id, info):
+        """行を別の絵文字に割り当て直します 画面への反映は呼び出し側で行います"""
+        self.eid = eid
+        self.checkbox.value = eid in self.main.selected
+        if self.name != name:
+            self.update_name(name, False)
+        if self.category != category:
+            self.update_category(category, False)
+        if self.tags != tags:
+            self.update_tags(tags, False)
+        self.update_url(url, False)
+        if self.image_backup != image_backup:
+            self.update_image_backup(image_backup, False)
+        if self.is_self_made != is_self_made:
+            self.update_self_made(is_self_made, False)
+        if self.license != license:
+            self.update_license(license, False)
+        if self.username != username:
+            self.update_username(username, False)
+        self.update_info(info, False)
+        if self.risk_id != risk_id:
+            self.risk_id = risk_id
+            self.load_risk()
+
+    def load_risk(self):
+        risk = registry.get_risk(self.risk_id)
+        if risk is not None:
+            self.update_risk_level(risk.level, False)
+            self.update_reason(risk.reason_genre, False)
+            self.update_remark(risk.remark, False)
+            self.update_status(risk.checked, False)
+            self.cancel_wait_risk()
+        else:
+            self.wait_risk(self.risk_id)
 
 
     def create_checker_need_tooltip(self, threshold_width, message):
@@ -866,27 +1058,42 @@ class DeletedEmojiItem(ft.Container):
         return check_need_tooltip
 
 
-    async def get_username(self):
-        while not self.username_resolved:
-            user = registry.get_user(self.username[1:-1])
-            if user is not None:
-                username = user.username
-                self.update_username(username)
-                self.username_resolved = True
-                break
-            await asyncio.sleep(1)
-
-    async def get_risk(self):
-        while True:
-            risk = registry.get_risk(self.risk_id)
-            if risk is not None:
-                risk_level = risk.level
-                reason = risk.reason_genre
-                remark = risk.remark
-                status = risk.checked
-                self.update_risk(risk_level, reason, remark, status)
-                break
-            await asyncio.sleep(1)
+    def wait_username(self, uid: str):
+        if self.waiting_user == uid:
+            return
+        self.cancel_wait_username()
+        self.waiting_user = uid
+        registry.wait_user(uid, self.resolve_username)
+
+    def cancel_wait_username(self):
+        if self.waiting_user is not None:
+            registry.cancel_wait_user(self.waiting_user, self.resolve_username)
+            self.waiting_user = None
+
+    def resolve_username(self, user):
+        self.waiting_user = None
+        self.update_username(user.username, self.page is not None)
+
+    def wait_risk(self, rid: str):
+        if self.waiting_risk == rid:
+            return
+        self.cancel_wait_risk()
+        self.waiting_risk = rid
+        registry.wait_risk(rid, self.resolve_risk)
+
+    def cancel_wait_risk(self):
+        if self.waiting_risk is not None:
+            registry.cancel_wait_risk(self.waiting_risk, self.resolve_risk)
+            self.waiting_risk = None
+
+    def resolve_risk(self, risk):
+        self.waiting_risk = None
+        if self.page is not None:
+            self.update_risk(risk.level, risk.reason_genre, risk.remark, risk.checked)
+
+    def cancel_waits(self):
+        self.cancel_wait_username()
+        self.cancel_wait_risk()
 
     def toggle_selected(self, e: ft.ControlEvent):
         checked = self.checkbox.value if self.checkbox.value is not None else False
@@ -896,10 +1103,10 @@ class DeletedEmojiItem(ft.Container):
         if not keyboard_behavior.shift or self.main.multiselect_origin is None:
             # shiftが押されていない or 選択の開始位置がない場合(絵文字削除に起因) -> 単純な一項目のトグル
             if checked:
-                self.main.selected.add(self)
+                self.main.selected.add(self.eid)
             else:
-                self.main.selected.discard(self)
-            self.main.multiselect_origin = self
+                self.main.selected.discard(self.eid)
+            self.main.multiselect_origin = self.eid
         else:
             if not keyboard_behavior.ctrl:
                 # shiftが押されていてctrlは押されていない場合 -> 排他的な範囲選択
@@ -907,73 +1114,47 @@ class DeletedEmojiItem(ft.Container):
             else:
                 # shiftが押されていてctrlも押されている場合 -> 範囲選択
                 self._toggle_selected_multiple()
+            self.main.list_emoji.reload_selected()
         self.main.update_selected()
 
-    def _toggle_selected_multiple_exclusive(self):
-        """排他的な複数選択の処理 (範囲外の項目は選択解除)"""
-
-        # そのEmojiItemがListの何番目に属しているかわからないので調べる
-        # 全てのEmojiItemがEmojiListにあることが前提
-        emojis = list(self.main.list_emoji.emojis.values())
-        current_item_index = emojis.index(self)
-        origin_item_index = emojis.index(self.main.multiselect_origin)
+    def _selection_range(self) -> list[str]:
+        # 画面外の絵文字も含めた、一覧全体での並びで範囲を求める
+        eids = self.main.list_emoji.eids
+        current_item_index = self.main.list_emoji.position(self.eid)
+        origin_item_index = self.main.list_emoji.position(self.main.multiselect_origin)
 
         start_index = min(current_item_index, origin_item_index)
         end_index = max(current_item_index, origin_item_index)
+        return eids[start_index:end_index + 1]
 
-        for index, emoji in enumerate(emojis):
-            if index >= start_index and index <= end_index:
-                target = True
-            else:
-                target = False
-            if emoji.checkbox.value != target or emoji == self:
-                emoji.checkbox.value = target
-                emoji.checkbox.update()
-                if target:
-                    self.main.selected.add(emoji)
-                else:
-                    self.main.selected.discard(emoji)
+    def _toggle_selected_multiple_exclusive(self):
+        """排他的な複数選択の処理 (範囲外の項目は選択解除)"""
+        self.main.selected.clear()
+        self.main.selected.update(self._selection_range())
 
     def _toggle_selected_multiple(self):
         """複数選択の処理 (範囲外の項目は選択維持)"""
+        self.main.selected.update(self._selection_range())
 
-        emojis = list(self.main.list_emoji.emojis.values())
-        current_item_index = emojis.index(self)
-        origin_item_index = emojis.index(self.main.multiselect_origin)
-
-        start_index = min(current_item_index, origin_item_index)
-        end_index = max(current_item_index, origin_item_index)
-
-        for index, emoji in enumerate(emojis):
-            if index >= start_index and index <= end_index:
-                target = True
-            else:
-                continue
-            if emoji.checkbox.value != target or emoji == self:
-                emoji.checkbox.value = target
-                emoji.checkbox.update()
-                if target:
-                    self.main.selected.add(emoji)
-                else:
-                    self.main.selected.discard(emoji)
-
-    def update_name(self, name):
+    def update_name(self, name, _update=True):
         self.name = name
         self.emoji_name.content = SizeAwareControl(
             on_resize=self.create_checker_need_tooltip(140, self.name),
             content=ft.Container(ft.Text(self.name, no_wrap=True),)
         )
-        self.emoji_name.update()
+        if _update:
+            self.emoji_name.update()
 
-    def update_category(self, category):
+    def update_category(self, category, _update=True):
         self.category = category
         self.emoji_category.content = SizeAwareControl(
             on_resize=self.create_checker_need_tooltip(120, self.category),
             content=ft.Container(ft.Text(self.category, no_wrap=True)),
         )
-        self.emoji_category.update()
+        if _update:
+            self.emoji_category.update()
 
-    def update_tags(self, tags):
+    def update_tags(self, tags, _update=True):
         self.tags = tags
         self.emoji_tags.content = SizeAwareControl(
             on_resize=self.create_checker_need_tooltip(200, ' '.join(self.tags)),
@@ -992,18 +1173,20 @@ class DeletedEmojiItem(ft.Container):
                 ]
             )),
         )
-        self.emoji_tags.update()
+        if _update:
+            self.emoji_tags.update()
 
-    def update_url(self, url):
-        self.url = url
-        self.emoji_image.content.src = url
-        self.emoji_image.content.update()
+    def update_url(self, url, _update=True):
+        self.emoji_url = self.override_url(url)
+        self.emoji_image.content.src = imageproxy.thumbnail_url(self.emoji_url)
+        if _update:
+            self.emoji_image.content.update()
 
-    def update_image_backup(self, image_backup):
+    def update_image_backup(self, image_backup, _update=True):
         self.image_backup = image_backup
         if self.image_backup is not None:
             error_content = ft.Image(
-                src_base64=self.image_backup,
+                src=imageproxy.blob_url(self.image_backup, thumbnail=True),
                 width=46,
                 height=46,
                 fit=ft.ImageFit.CONTAIN,
@@ -1012,15 +1195,17 @@ class DeletedEmojiItem(ft.Container):
         else:
             error_content = ft.Icon(ft.icons.BROKEN_IMAGE, color='#303030')
         self.emoji_image.content.error_content = error_content
-        self.emoji_image.content.update()
+        if _update:
+            self.emoji_image.content.update()
 
-    def update_self_made(self, is_self_made):
+    def update_self_made(self, is_self_made, _update=True):
         self.is_self_made = is_self_made
         self.emoji_self_made.name = ft.icons.CHECK_ROUNDED if self.is_self_made else ft.icons.CLOSE_ROUNDED
         self.emoji_self_made.color = '#d0d0d0' if self.is_self_made else '#303030'
-        self.emoji_self_made.update()
+        if _update:
+            self.emoji_self_made.update()
 
-    def update_license(self, license):
+    def update_license(self, license, _update=True):
         self.license = license
         spans = []
         for is_url, text in func.detect_url(self.license):
@@ -1045,15 +1230,21 @@ class DeletedEmojiItem(ft.Container):
                 )
             ),
         )
-        self.emoji_license.update()
+        if _update:
+            self.emoji_license.update()
 
-    def update_username(self, username):
-        if username.startswith('<') and username.endswith('>'):
-            if self.username_resolved:
-                self.page.run_task(self.get_username)
+    def update_username(self, username, _update=True):
+        if username is None:
+            self.username_resolved = True
+            username = TEXTS.USERNAME_UNRESOLVED
+        elif username.startswith('<') and username.endswith('>'):
             self.username_resolved = False
         else:
             self.username_resolved = True
+        if self.username_resolved:
+            self.cancel_wait_username()
+        elif self.page is not None:
+            self.wait_username(username[1:-1])
 
         self.username = username
         self.emoji_username.content = SizeAwareControl(
@@ -1067,16 +1258,8 @@ class DeletedEmojiItem(ft.Container):
                 ),
             )),
         )
-        self.emoji_username.update()
-
-    def change_risk_id(self, risk_id):
-        if self.risk_id != risk_id:
-            self.risk_level.disabled = True
-            self.reason.disabled = True
-            self.remark.disabled = True
-            self.risk_id = risk_id
-            self.page.run_task(self.get_risk)
-        self.update()
+        if _update:
+            self.emoji_username.update()
 
     def update_risk(self, level, reason, remark, status):
         self.update_risk_level(level, False)
@@ -1166,40 +1349,6 @@ class DeletedEmojiItem(ft.Container):
         self.update_info(text, _update)
         websocket.change_info(self.eid, text, self.page)
 
-class MoreLoad(ft.Container):
-    def __init__(self, main: PanelDeletedEmojis):
-        super().__init__()
-
-        self.main = main
-
-        self.ink = True
-
-        def on_click(e):
-            self.load()
-
-        self.on_click = on_click
-
-        self.height = 50
-        self.expand = True
-
-        self.content = ft.Row(
-            expand=True,
-            spacing=0,
-            controls=[
-                ft.Container(
-                    expand=True,
-                    content=ft.Text(
-                        value=TEXTS.LOAD_MORE,
-                        text_align=ft.TextAlign.CENTER,
-                    ),
-                ),
-            ],
-        )
-
-    def load(self):
-        self.main.load_next()
-
-
 class DeletedEmojiBulkChanger(ft.Container):
     def __init__(self, main: PanelDeletedEmojis):
         super().__init__()
@@ -1210,7 +1359,7 @@ class DeletedEmojiBulkChanger(ft.Container):
 
         # -2: none (no emoji selected)
         # -1: bar (mixed)
-        # 0 - 2: same EmojiItem
+        # 0 - 2: same DeletedEmojiItem
         self._status_value = -2
 
         self.checkbox = ft.Checkbox(
@@ -1235,8 +1384,8 @@ class DeletedEmojiBulkChanger(ft.Container):
             if self._info != self.delete_info.content.value:
                 self._info = self.delete_info.content.value
                 text = self.delete_info.content.value
-                for i in self.main.selected:
-                    i.change_info(text, False)
+                for eid in self.main.selected:
+                    self.main.list_emoji.change_info(eid, text)
                 self.main.update()
                 self.update_values()
             self.main.unlock()
@@ -1465,12 +1614,8 @@ class DeletedEmojiBulkChanger(ft.Container):
             self.delete_info.content.value = ''
             self._update_status(-2)
         elif nsel == 1:
-            e = list(self.main.selected)[0]
-            common_risk_level = e.risk_level.value
-            common_reason = e.reason.content.value
-            common_remark = e.remark.content.value
-            common_status = e.status_value
-            common_info = e.delete_info.content.value
+            eid = next(iter(self.main.selected))
+            common_risk_level, common_reason, common_remark, common_status, common_info = self.main.list_emoji.get_values(eid)
             if common_reason == '': common_reason = None
             if common_remark == '': common_remark = None
 
@@ -1498,11 +1643,8 @@ class DeletedEmojiBulkChanger(ft.Container):
             is_common_info = True
 
             contains_risk = [False, False, False, False]
-            common_risk_level = list(self.main.selected)[0].risk_level.value
-            common_reason = list(self.main.selected)[0].reason.content.value
-            common_remark = list(self.main.selected)[0].remark.content.value
-            common_status = list(self.main.selected)[0].status_value
-            common_info = list(self.main.selected)[0].delete_info.content.value
+            values = [self.main.list_emoji.get_values(eid) for eid in self.main.selected]
+            common_risk_level, common_reason, common_remark, common_status, common_info = values[0]
             if common_reason == '': common_reason = None
             if common_remark == '': common_remark = None
 
@@ -1516,12 +1658,7 @@ class DeletedEmojiBulkChanger(ft.Container):
                 case 'risk_3':
                     contains_risk[3] = True
 
-            for e in list(self.main.selected)[1:]:
-                risk_level = e.risk_level.value
-                reason = e.reason.content.value
-                remark = e.remark.content.value
-                status = e.status_value
-                delete_info = e.delete_info.content.value
+            for risk_level, reason, remark, status, delete_info in values[1:]:
                 if reason == '': reason = None
                 if remark == '': remark = None
 
@@ -1622,6 +1759,14 @@ class ActionsDialog(ft.AlertDialog):
         def open_filtering_menu(e):
             self.main.open_filtering_menu()
 
+        def select_all(e):
+            self.page.close_dialog()
+            self.main.select_all()
+
+        def invert_selection(e):
+            self.page.close_dialog()
+            self.main.invert_selection()
+
         def export_csv(e):
             ret = self.main.export_csv()
             if ret is not None:
@@ -1711,6 +1856,56 @@ class ActionsDialog(ft.AlertDialog):
             on_click=open_filtering_menu,
             disabled=False,
         )
+        self.select_all_container = ft.Container(
+            content=ft.Column(
+                controls=[
+                    ft.Container(
+                        content=ft.Icon(
+                            name=ft.icons.SELECT_ALL_ROUNDED,
+                            color='#c0c0c0',
+                        ),
+                        width=50,
+                        height=50,
+                    ),
+                    ft.Text('フィルターに合致する\n全ての項目を選択', text_align=ft.TextAlign.CENTER)
+                ],
+                horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+                tight=True,
+            ),
+            width=150,
+            height=150,
+            border_radius=8,
+            alignment=ft.alignment.center,
+            margin=4,
+            ink=True,
+            on_click=select_all,
+            disabled=False,
+        )
+        self.invert_selection_container = ft.Container(
+            content=ft.Column(
+                controls=[
+                    ft.Container(
+                        content=ft.Icon(
+                            name=ft.icons.FLIP_ROUNDED,
+                            color='#c0c0c0',
+                        ),
+                        width=50,
+                        height=50,
+                    ),
+                    ft.Text('選択を反転', text_align=ft.TextAlign.CENTER)
+                ],
+                horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+                tight=True,
+            ),
+            width=150,
+            height=150,
+            border_radius=8,
+            alignment=ft.alignment.center,
+            margin=4,
+            ink=True,
+            on_click=invert_selection,
+            disabled=False,
+        )
         self.export_selected_container = ft.Container(
             content=ft.Column(
                 controls=[
@@ -1766,11 +1961,15 @@ class ActionsDialog(ft.AlertDialog):
             content=ft.Row(
                 controls=[
                     self.filtering_container,
+                    self.select_all_container,
+                    self.invert_selection_container,
                     self.export_selected_container,
                     self.export_container,
                 ],
                 alignment=ft.MainAxisAlignment.CENTER,
                 spacing=20,
+                wrap=True,
+                run_spacing=20,
             ),
             margin=ft.Margin(10, 20, 10, 0)
         )
@@ -1,8 +1,14 @@
 import json
+import asyncio
+import traceback
 
 import flet as ft
 
 from app.utils.control import IOSAlignment
+from core import metrics
+
+# 通信の計測を表示し直す間隔(秒)
+METRICS_REFRESH_INTERVAL = 1.
 
 
 class PanelLogs(ft.Container):
@@ -24,6 +30,15 @@ class PanelLogs(ft.Container):
             on_click=navigate_to_bottom,
         )
 
+        self.metrics_text = ft.Text(
+            value='',
+            color='#a0a0a0',
+            font_family='M PLUS 1 Code',
+            size=12,
+            no_wrap=True,
+        )
+        self.metrics_task = None
+
         self.expand = True
         self.margin = 15
 
@@ -34,6 +49,18 @@ class PanelLogs(ft.Container):
                     size=30,
                     weight=ft.FontWeight.BOLD,
                 ),
+                ft.Container(
+                    content=ft.Column(
+                        controls=[
+                            self.metrics_text,
+                        ],
+                        scroll=ft.ScrollMode.AUTO,
+                    ),
+                    height=180,
+                    padding=ft.padding.symmetric(horizontal=5),
+                    border=ft.border.all(2, '#80d0e0f0'),
+                    border_radius=5,
+                ),
                 ft.Container(
                     content=ft.Stack(
                         controls=[
@@ -51,6 +78,33 @@ class PanelLogs(ft.Container):
             ],
         )
 
+    def start_metrics(self):
+        """通信の計測の表示を定期的に更新し始めます パネルを表示したときに呼ばれます"""
+        if self.metrics_task is None:
+            self.metrics_task = self.page.run_task(self.refresh_metrics_periodically)
+
+    def stop_metrics(self):
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            self.metrics_task = None
+
+    async def refresh_metrics_periodically(self):
+        try:
+            while True:
+                self.refresh_metrics()
+                await asyncio.sleep(METRICS_REFRESH_INTERVAL)
+        except asyncio.exceptions.CancelledError:
+            pass
+
+    def refresh_metrics(self, _update=True):
+        try:
+            self.metrics_text.value = format_metrics(metrics.snapshot())
+        except Exception:
+            traceback.print_exc()
+            return
+        if _update:
+            self.metrics_text.update()
+
     def write_log(self, subject: str, text: str, data: dict = None, error: bool = False):
         if not error:
             # More items will take too long to processing.
@@ -140,3 +194,18 @@ class PanelLogs(ft.Container):
             self.page.data['sidebar'].button_logs.increment_badge_value()
         self.log_view.update()
 
+
+
+def format_metrics(snapshot: dict) -> str:
+    """metrics.snapshot()の内容を表にします
+    全角文字は2文字分の幅で表示されるので、見出しの幅はその分少なくしてある"""
+    lines = [f"{'送信した操作':<24}{'送信':>8}{'完了':>8}{'失敗':>8}{'p50':>9}{'p95':>9}{'最大':>7} (ms)"]
+    for op, m in sorted(snapshot['requests'].items()):
+        lat = m['latency']
+        lines.append(f"{op:<30}{m['sent']:>10}{m['completed']:>10}{m['failed']:>10}{lat['p50_ms']:>9.1f}{lat['p95_ms']:>9.1f}{lat['max_ms']:>9.1f}")
+    lines.append('')
+    lines.append(f"{'受信したメッセージ':<21}{'件数':>8}{'件/秒':>8}{'KiB':>10}{'p50':>9}{'p95':>9}{'最大':>7} (ms)")
+    for op, m in sorted(snapshot['inbound'].items()):
+        h = m['handler']
+        lines.append(f"{op:<30}{m['received']:>10}{m['rate']:>10.1f}{m['bytes'] / 1024:>10.1f}{h['p50_ms']:>9.1f}{h['p95_ms']:>9.1f}{h['max_ms']:>9.1f}")
+    return '\n'.join(lines)
@@ -1,6 +1,8 @@
 import flet as ft
 
+from core import registry
 from core import websocket
+from core.changes import ChangeSet
 
 class PanelReasons(ft.Container):
 
@@ -107,6 +109,20 @@ class PanelReasons(ft.Container):
             expand=True,
         )
 
+    def did_mount(self):
+        registry.subscribe(self.on_registry_changes)
+
+    def will_unmount(self):
+        registry.unsubscribe(self.on_registry_changes)
+
+    def on_registry_changes(self, changes: ChangeSet):
+        for rsid in changes.reasons.changed():
+            reason = registry.get_reason(rsid)
+            if reason is not None:
+                self.update_reason(rsid, reason.text)
+        for rsid in changes.reasons.removed:
+            self.remove_reason(rsid)
+
     def set_locked(self, locked):
         self.locked = locked
         self.main_container.disabled = locked
@@ -282,7 +282,8 @@ OFFにすると動作が軽くなりますが、長い文字列に遭遇した
         self.save()
         if self.connect_state == 0:
             await websocket.connect(self.addr.value, self.page)
-        elif self.connect_state == 2:
+        elif self.connect_state == 2 or websocket.reconnecting:
+            # 再接続を待っている間も切断できる
             await websocket.disconnect(self.page)
 
     def auth(self, e):
@@ -348,8 +349,8 @@ OFFにすると動作が軽くなりますが、長い文字列に遭遇した
             case 1:
                 self.addr.disabled = True
 
-                self.button_connect.content.value = '接続'
-                self.status_connection.text = '接続中'
+                self.button_connect.content.value = '切断' if websocket.reconnecting else '接続'
+                self.status_connection.text = '再接続中' if websocket.reconnecting else '接続中'
                 self.status_connection.style.color = '#ffff40'
 
                 self.button_auth.disabled = True
@@ -54,8 +54,6 @@ class TextFieldsEmojis:
     CHECKED = 'チェック済'
     NEED_RECHECK = '要再チェック\n(絵文字更新済)'
 
-    LOAD_MORE = '更に読み込む'
-
     USERNAME_UNRESOLVED = '<不明>'
 
     MISC_MIXED = '<混在>'
@@ -13,6 +13,7 @@ from app.panels.logs import PanelLogs
 from app.utils.control import IOSAlignment
 from app.views import Views
 from app.misc.loadingring import LoadingRing
+from core import websocket
 
 
 class Root(ft.Container):
@@ -48,20 +49,26 @@ class Root(ft.Container):
             target = self.get_panel(value)
             before = self.get_panel(bvalue)
 
+            # 画面を移動するときは、まとめている途中の変更をすぐに送る
+            websocket.flush_risk_changes(self.page)
+
             if value == Views.DASHBOARD:
                 self.panel_dashboard.reload_all()
             if value == Views.EMOJIS:
-                self.panel_emojis.load_next()
+                self.panel_emojis.load_list()
             if value == Views.DELETED:
-                self.panel_deleted.load_next()
+                self.panel_deleted.load_list()
             if value == Views.LOGS:
                 self.sidebar.button_logs.reset_badge_value()
                 self.panel_logs.log_view.scroll_to(offset=-1, duration=0)
+                self.panel_logs.start_metrics()
 
             if bvalue == Views.EMOJIS:
                 self.panel_emojis.unload_all()
             if bvalue == Views.DELETED:
                 self.panel_deleted.unload_all()
+            if bvalue == Views.LOGS:
+                self.panel_logs.stop_metrics()
 
             if before is not None:
                 before.visible = False
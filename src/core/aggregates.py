@@ -0,0 +1,55 @@
+from core.datatypes import RiskData
+
+# 絵文字の集計値
+# registryのput/popのたびに差分で更新されるので、参照時に全件を走査する必要がない
+
+emoji_count = 0
+risk_levels: dict[int | None, int] = {}
+check_statuses: dict[int | None, int] = {}
+owners: dict[str | None, int] = {}
+reasons: dict[str | None, int] = {}
+
+
+class AggregateSnapshot():
+    __slots__ = ('emoji_count', 'risk_levels', 'check_statuses', 'owners', 'reasons')
+
+    def __init__(self, emoji_count, risk_levels, check_statuses, owners, reasons):
+        self.emoji_count = emoji_count
+        self.risk_levels = risk_levels
+        self.check_statuses = check_statuses
+        self.owners = owners
+        self.reasons = reasons
+
+
+def _add(counter: dict, key, n: int):
+    value = counter.get(key, 0) + n
+    if value == 0:
+        counter.pop(key, None)
+    else:
+        counter[key] = value
+
+def _risk_keys(risk: RiskData | None):
+    # リスクのデータが無い絵文字は危険度・状態・理由区分すべて未設定(None)として数える
+    if risk is None:
+        return None, None, None
+    level = risk.level if risk.level in [0, 1, 2, 3] else None
+    return level, risk.checked, risk.reason_genre
+
+def apply_risk(risk: RiskData | None, n: int):
+    """リスクを参照しているn個の絵文字分だけ集計値を加算(減算)します"""
+    if n == 0:
+        return
+    level, status, reason = _risk_keys(risk)
+    _add(risk_levels, level, n)
+    _add(check_statuses, status, n)
+    _add(reasons, reason, n)
+
+def apply_emoji(owner_id: str | None, risk: RiskData | None, n: int):
+    """絵文字1件分の集計値を加算(n=1)または減算(n=-1)します"""
+    global emoji_count
+    emoji_count += n
+    _add(owners, owner_id, n)
+    apply_risk(risk, n)
+
+def snapshot() -> AggregateSnapshot:
+    return AggregateSnapshot(emoji_count, dict(risk_levels), dict(check_statuses), dict(owners), dict(reasons))
@@ -0,0 +1,213 @@
+import os
+import os.path as osp
+import re
+import base64
+import binascii
+import asyncio
+import hashlib
+import itertools
+import threading
+import traceback
+import concurrent.futures
+
+from core import cache
+from core import registry
+from core.imaging import guess_content_type, make_thumbnail, THUMBNAIL_SIZE, THUMBNAIL_SCALE
+
+# 削除された絵文字のバックアップ画像の保存先
+#
+# サーバーからはbase64の文字列で届くが、registryにはキー(base64の文字列のSHA-256)だけを持たせる
+# 画像はワーカースレッドで1回だけデコードし、キーをファイル名にしてBLOB_DIRに書き出す
+# INLINE_HASH_LIMIT文字より大きな画像は、キーを求めるのもワーカースレッドで行い、求まったらregistryのキーを差し替える
+# 同じ画像は同じキーになるので、何度届いても書き出すのは1回だけ
+# 削除された絵文字がregistryから取り除かれたら、他から参照されていない画像は消す
+# Pillowがあれば一覧用の縮小画像(キー.thumb)も一緒に作る
+#
+# 画面には画像の中継サーバー(imageproxy)からURLで渡す
+
+BLOB_DIR = osp.join(cache.CACHE_DIR, 'blobs')
+WORKERS = 2
+# これより小さなbase64(文字数)は、呼び出したスレッドでキーを求める (64KBでおよそ0.1ms)
+INLINE_HASH_LIMIT = 64 * 1024
+
+_KEY = re.compile(r'[0-9a-f]{64}')
+_DATA_URI = re.compile(r'data:[^;,]*;base64,')
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='blobstore')
+_lock = threading.Lock()
+# 書き出し中のキー -> Future
+_pending: dict[str, concurrent.futures.Future] = {}
+# 書き出し済みと分かっているキー
+_stored: set[str] = set()
+# eid -> キーを求めている最中の、最後に頼んだ画像の番号
+_backup_serials: dict[str, int] = {}
+_serials = itertools.count()
+
+def is_key(value) -> bool:
+    return type(value) is str and _KEY.fullmatch(value) is not None
+
+def path(key: str, thumbnail: bool = False) -> str:
+    """画像のファイルのパスを返します 縮小画像が無い場合は元の画像のパスを返します"""
+    p = osp.join(BLOB_DIR, key[:2], key)
+    if thumbnail and osp.isfile(f'{p}.thumb'):
+        return f'{p}.thumb'
+    return p
+
+def put_base64(value: str | None) -> str | None:
+    """base64の画像を保存し、キーを返します 書き出しはワーカースレッドで行います
+    既にキーになっている値はそのまま返します"""
+    if value is None or value == '':
+        return None
+    if is_key(value):
+        return value
+    value = _strip(value)
+    key = _hash(value)
+    with _lock:
+        if _is_stored(key):
+            return key
+        _pending[key] = _executor.submit(_write, key, value)
+    return key
+
+def put_deleted_backup(eid: str, value: str | None) -> str | None:
+    """削除された絵文字eidのバックアップ画像を保存し、registryに入れるキーを返します イベントループから呼びます
+    大きな画像はキーを求めるのもワーカースレッドで行い、それまではregistryにある今のキーを返す
+    キーが求まったら、イベントループでregistryの絵文字のキーを差し替える"""
+    if value is None or len(value) <= INLINE_HASH_LIMIT or is_key(value):
+        # 先に頼んだ大きな画像のキーが後から求まっても、差し替えない
+        _backup_serials.pop(eid, None)
+        return put_base64(value)
+    loop = asyncio.get_running_loop()
+    serial = _backup_serials[eid] = next(_serials)
+
+    def done(future: concurrent.futures.Future):
+        try:
+            key = future.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        loop.call_soon_threadsafe(_set_backup, eid, serial, key)
+
+    _executor.submit(_hash_and_write, value).add_done_callback(done)
+    old = registry.get_deleted_emoji(eid)
+    return old.image_backup if old is not None else None
+
+def _set_backup(eid: str, serial: int, key: str):
+    if _backup_serials.get(eid) != serial:
+        return
+    del _backup_serials[eid]
+    if registry.get_deleted_emoji(eid) is None:
+        # 待っている間に取り除かれた
+        remove([key])
+        return
+    registry.set_deleted_image_backup(eid, key)
+
+def _strip(value: str) -> str:
+    m = _DATA_URI.match(value)
+    if m is not None:
+        value = value[m.end():]
+    return value
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode('ascii', errors='replace')).hexdigest()
+
+def _is_stored(key: str) -> bool:
+    """書き出し済みか書き出し中ならTrueを返します _lockを持って呼びます"""
+    if key in _stored or key in _pending:
+        return True
+    if osp.isfile(path(key)):
+        _stored.add(key)
+        return True
+    return False
+
+def _hash_and_write(value: str) -> str:
+    """ワーカースレッドでキーを求めて書き出し、キーを返します"""
+    value = _strip(value)
+    key = _hash(value)
+    with _lock:
+        if _is_stored(key):
+            return key
+        future = concurrent.futures.Future()
+        _pending[key] = future
+    try:
+        _write(key, value)
+    finally:
+        future.set_result(None)
+    return key
+
+def _write(key: str, value: str):
+    stored = False
+    try:
+        data = base64.b64decode(value)
+        p = path(key)
+        os.makedirs(osp.dirname(p), exist_ok=True)
+        thumbnail = make_thumbnail(data, THUMBNAIL_SIZE * THUMBNAIL_SCALE)
+        if thumbnail is not None:
+            _write_file(f'{p}.thumb', thumbnail)
+        # 元の画像を最後に書き出し、これがあれば揃っているものとして扱う
+        _write_file(p, data)
+        stored = True
+    except (OSError, binascii.Error, ValueError):
+        traceback.print_exc()
+        print(f'image backup could not stored ({key})')
+    finally:
+        with _lock:
+            _pending.pop(key, None)
+            # 失敗した場合は、次に同じ画像が届いたときに書き出し直す
+            if stored:
+                _stored.add(key)
+
+def _write_file(p: str, data: bytes):
+    with open(f'{p}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{p}.tmp', p)
+
+def remove(keys):
+    """registryの削除された絵文字から参照されなくなった画像を消します 消すのはワーカースレッドで行います"""
+    keys = {key for key in keys if is_key(key)}
+    if len(keys) == 0:
+        return
+    # 同じ画像を持つ削除された絵文字が残っていれば消さない
+    keys.difference_update(emoji.image_backup for emoji in registry.deleted.values())
+    with _lock:
+        for key in keys:
+            _stored.discard(key)
+            future = _pending.get(key)
+            if future is not None:
+                # 書き出し中なら終わってから消す
+                future.add_done_callback(lambda _, key=key: _executor.submit(_remove, key))
+            else:
+                _executor.submit(_remove, key)
+
+def _remove(key: str):
+    p = path(key)
+    with _lock:
+        # 消すまでの間にまた届いた場合は残す
+        if key in _stored or key in _pending:
+            return
+        for name in [f'{p}.thumb', p]:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                traceback.print_exc()
+
+def wait(key: str, timeout: float | None = None):
+    """キーの画像が書き出されるまで待ちます"""
+    with _lock:
+        future = _pending.get(key)
+    if future is not None:
+        future.result(timeout)
+
+def read(key: str, thumbnail: bool = False, timeout: float | None = None) -> tuple[str, bytes] | None:
+    """画像を (Content-Type, 内容) で返します 書き出し中なら終わるまで待ちます"""
+    try:
+        wait(key, timeout)
+    except concurrent.futures.TimeoutError:
+        return None
+    try:
+        with open(path(key, thumbnail), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return guess_content_type(data), data
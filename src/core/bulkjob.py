@@ -0,0 +1,169 @@
+import time
+import asyncio
+import traceback
+import collections
+
+from core import wsmsg
+from core import registry
+from core import websocket
+
+# 一括変更
+#
+# 選択した絵文字のリスクに同じ変更を行う処理を、イベントループで少しずつ進める
+#   1. 全件を送信中としてregistryへ反映する (一覧にはすぐに新しい値が薄く表示される)
+#   2. BULK_CHUNK_SIZE件ずつ送信し、応答が来た分から確定する (失敗した分は元に戻す)
+# 接続が切れている間は止まり、認証し直して操作を送れるようになったら続きから再開する
+# 中止すると、まだ送っていない分は元の値に戻す
+# 複数の一括変更は、始めた順に1つずつ進める
+
+# 送信中としてregistryへ反映するとき、この件数ごとにイベントループへ処理を返す
+APPLY_SLICE = 1000
+# 接続を待っている間、中止されていないか確認する間隔(秒)
+WAIT_INTERVAL = 1.
+
+
+class BulkJob():
+    """1回の一括変更"""
+
+    __slots__ = ('eids', 'rids', 'props', 'page', 'on_progress', 'on_finish', 'done', 'failed', 'state', 'cancelled', 'elapsed', '_serials')
+
+    def __init__(self, eids, props: dict, page, on_progress=None, on_finish=None):
+        self.eids = list(eids)
+        # 送信するリスクID (始めるときに絵文字IDから求める)
+        self.rids: list[str] = []
+        # change_risks_chunkに渡す変更内容 値が-1の項目は変更しない
+        if props.get('rsid') == '':
+            props['rsid'] = None
+        self.props = props
+        self.page = page
+        # on_progress(job), on_finish(job) イベントループで呼ばれる
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        # 送信し終えたリスクの数
+        self.done = 0
+        self.failed: list[str] = []
+        # 'queued', 'running', 'waiting'(接続待ち), 'cancelled', 'finished'
+        self.state = 'queued'
+        self.cancelled = False
+        # 送信にかかった時間(秒) 接続を待っていた時間は含めない
+        self.elapsed = 0.
+        # rid -> registryに反映した送信中の変更の番号
+        self._serials: dict[str, int | None] = {}
+
+    @property
+    def total(self) -> int:
+        return len(self.rids) if self.state != 'queued' else len(self.eids)
+
+    def eta(self) -> float | None:
+        """残りの時間(秒)の見込みを返します まだ見込めない場合はNone"""
+        if self.done == 0 or self.elapsed <= 0:
+            return None
+        return (len(self.rids) - self.done) * self.elapsed / self.done
+
+    def cancel(self):
+        """中止します 送信中の分は応答を待ってから止まります 画面のスレッドからも呼べます"""
+        self.cancelled = True
+
+_jobs: collections.deque = collections.deque()
+_runner: asyncio.Task | None = None
+# 進めている一括変更
+current: BulkJob | None = None
+
+def submit(eids, page, on_progress=None, on_finish=None, **props) -> BulkJob:
+    """一括変更を始めます 先に始めたものがあれば、それが終わってから進めます
+    propsはchange_risks_chunkと同じ (checked, level, rsid, remark) 画面のスレッドからも呼べます"""
+    job = BulkJob(eids, props, page, on_progress, on_finish)
+    page.run_task(_enqueue, job)
+    return job
+
+def is_running() -> bool:
+    return current is not None or len(_jobs) > 0
+
+def cancel_all():
+    """進めているものと、待っているものをすべて中止します"""
+    for job in list(_jobs):
+        job.cancel()
+    job = current
+    if job is not None:
+        job.cancel()
+
+async def _enqueue(job: BulkJob):
+    global _runner
+    _jobs.append(job)
+    if _runner is None or _runner.done():
+        _runner = asyncio.create_task(_run_jobs())
+
+async def _run_jobs():
+    global current
+    while len(_jobs) > 0:
+        job = _jobs.popleft()
+        current = job
+        try:
+            await _run(job)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            # 送らなかった分は元に戻す
+            _end(job, list(job._serials), set(job._serials))
+            current = None
+            job.state = 'cancelled' if job.cancelled else 'finished'
+            _notify(job.on_finish, job)
+
+async def _run(job: BulkJob):
+    if job.cancelled:
+        return
+    job.state = 'running'
+    props = wsmsg.build_risk_props(**job.props)
+    for i, eid in enumerate(job.eids):
+        emoji = registry.get_emoji(eid)
+        if emoji is not None and emoji.risk_id not in job._serials:
+            job._serials[emoji.risk_id] = registry.change_risk_local(emoji.risk_id, props)
+        if i % APPLY_SLICE == APPLY_SLICE - 1:
+            await asyncio.sleep(0)
+    job.rids = list(job._serials)
+    _notify(job.on_progress, job)
+
+    while job.done < len(job.rids) and not job.cancelled:
+        if not websocket.ready.is_set():
+            job.state = 'waiting'
+            _notify(job.on_progress, job)
+            try:
+                await asyncio.wait_for(websocket.ready.wait(), WAIT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job.state = 'running'
+        chunk = job.rids[job.done:job.done + websocket.BULK_CHUNK_SIZE]
+        started = time.perf_counter()
+        try:
+            failed = await websocket.change_risks_chunk(chunk, job.page, **job.props)
+        except websocket.RequestError:
+            # 送信中に接続が切れたので、つながり直してから同じ分を送り直す
+            job.state = 'waiting'
+            _notify(job.on_progress, job)
+            await asyncio.sleep(WAIT_INTERVAL)
+            continue
+        job.elapsed += time.perf_counter() - started
+        _end(job, chunk, set(failed))
+        job.failed.extend(failed)
+        job.done += len(chunk)
+        _notify(job.on_progress, job)
+
+def _end(job: BulkJob, rids, failed: set):
+    """送信中として反映した変更を、failedに含まれるものは取り消し、それ以外は確定します"""
+    for rid in rids:
+        serial = job._serials.pop(rid, None)
+        if serial is None:
+            continue
+        if rid in failed:
+            registry.rollback_risk_change(rid, serial)
+        else:
+            registry.confirm_risk_change(rid, serial)
+
+def _notify(callback, job: BulkJob):
+    if callback is None:
+        return
+    try:
+        callback(job)
+    except Exception:
+        traceback.print_exc()
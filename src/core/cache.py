@@ -0,0 +1,265 @@
+import os
+import os.path as osp
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import traceback
+import concurrent.futures
+
+from core import registry
+from core.changes import ChangeSet
+
+
+CACHE_DIR = osp.join(osp.abspath('.'), 'cache')
+
+TABLES = ['users', 'risks', 'reasons', 'emojis', 'deleted']
+
+# 差分取得に使う、各データの更新日時を表すフィールド
+WATERMARK_FIELDS = {
+    'emojis': 'updated_at',
+    'deleted': 'deleted_at',
+    'risks': 'updated_at',
+    'reasons': 'updated_at',
+}
+
+# 差分取得ではサーバー側で削除されたデータが分からないので、この間隔(秒)で全件を取り直し、
+# 届かなかったデータを取り除く
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+# キャッシュから読み込んだデータをregistryへ入れるとき、1回に使う時間(秒)
+# 超えたらイベントループに処理を返す
+LOAD_BUDGET = 0.016
+LOAD_CHECK_EVERY = 64
+
+# SQLiteの読み書きとJSONへの変換は、すべてこのスレッドで順に行う
+# イベントループでは変更されたレコードを集めて渡すだけにする
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache')
+# _executorのスレッドだけが触る
+_db: sqlite3.Connection | None = None
+
+_server_host: str | None = None
+# table -> 差分取得に使う最新の更新日時
+_since: dict[str, str] = {}
+# table -> 最後に全件を取得した時刻 (time.time())
+_synced: dict[str, float] = {}
+# table -> 全件取得の間に届いたID
+_sweeps: dict[str, set[str]] = {}
+
+
+def get_cache_path(server_host: str) -> str:
+    name = re.sub(r'[^0-9A-Za-z\-\.]', '_', server_host)
+    return osp.join(CACHE_DIR, f'{name}.db')
+
+async def open_server(server_host: str):
+    """サーバーごとのキャッシュを開きます
+    レジストリが空ならキャッシュの内容を読み込み、以降の変更はキャッシュへ書き込まれます"""
+    global _server_host
+    if _server_host is not None:
+        if _server_host == server_host:
+            return
+        close()
+
+    try:
+        meta = await asyncio.wrap_future(_executor.submit(_open, get_cache_path(server_host)))
+    except (OSError, sqlite3.Error):
+        traceback.print_exc()
+        print('cache could not opened')
+        return
+
+    _server_host = server_host
+    _since.clear()
+    _synced.clear()
+    _sweeps.clear()
+    for key, value in meta.items():
+        if key.startswith('since_'):
+            _since[key[len('since_'):]] = value
+        elif key.startswith('synced_'):
+            _synced[key[len('synced_'):]] = value
+
+    if len(registry.emojis) == 0 and len(registry.deleted) == 0:
+        await load()
+        # 読み込んだ分をすぐに画面へ反映し、キャッシュへの書き戻しは行わない
+        registry.flush_changes()
+    registry.subscribe(_on_changes)
+
+def close():
+    global _server_host
+    if _server_host is None:
+        return
+    registry.unsubscribe(_on_changes)
+    _server_host = None
+    _sweeps.clear()
+    _executor.submit(_close)
+
+async def drain():
+    """それまでに渡した書き込みが終わるまで待ちます"""
+    await asyncio.wrap_future(_executor.submit(lambda: None))
+
+def _open(path: str) -> dict:
+    global _db
+    _close()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    try:
+        for table in TABLES:
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, body TEXT NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        db.commit()
+        meta = {key: json.loads(value) for key, value in db.execute('SELECT key, value FROM meta')}
+    except sqlite3.Error:
+        db.close()
+        raise
+    _db = db
+    return meta
+
+def _close():
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+async def load():
+    from core import blobstore
+    try:
+        tables = await asyncio.wrap_future(_executor.submit(_read_all))
+    except sqlite3.Error:
+        traceback.print_exc()
+        return
+    await _put_each(tables['users'], lambda body: registry.put_user(body['id'], body['misskey_id'], body['username']))
+    await _put_each(tables['risks'], lambda body: registry.put_risk(body['id'], body['checked'], body['level'], body['reason_genre'], body['remark'], body['created_at'], body['updated_at']))
+    await _put_each(tables['reasons'], lambda body: registry.put_reason(body['id'], body['text'], body['created_at'], body['updated_at']))
+    await _put_each(tables['emojis'], lambda body: registry.put_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['created_at'], body['updated_at']))
+    # 以前のキャッシュにはバックアップ画像がbase64のまま入っているので、その場合はここで保存し直す
+    await _put_each(tables['deleted'], lambda body: registry.put_deleted_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], blobstore.put_deleted_backup(body['id'], body['image_backup']), body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['info'], body['deleted_at']))
+
+async def _put_each(bodies: list, put):
+    """bodiesを1件ずつregistryへ入れます LOAD_BUDGET秒を超えたらイベントループに処理を返します"""
+    deadline = time.perf_counter() + LOAD_BUDGET
+    for n, body in enumerate(bodies, 1):
+        put(body)
+        if n % LOAD_CHECK_EVERY == 0 and time.perf_counter() > deadline:
+            await asyncio.sleep(0)
+            deadline = time.perf_counter() + LOAD_BUDGET
+
+def _read_all() -> dict[str, list]:
+    return {table: [json.loads(row[0]) for row in _db.execute(f'SELECT body FROM {table} ORDER BY rowid')] for table in TABLES}
+
+def get_since(table: str):
+    """差分取得のための、キャッシュ済みデータの最新の更新日時を返します
+    キャッシュが無い場合や、全件を取り直す時期になった場合はNone"""
+    if _server_host is None or table not in WATERMARK_FIELDS:
+        return None
+    synced = _synced.get(table)
+    if synced is None or time.time() - synced > FULL_SYNC_INTERVAL:
+        return None
+    return _since.get(table)
+
+def begin_sweep(table: str):
+    """全件取得を始めるときに呼びます 終わるまでに届いたデータのIDを記録します"""
+    if _server_host is None:
+        return
+    _sweeps[table] = set()
+
+def end_sweep(table: str):
+    """全件取得が終わったときに呼びます 届かなかったデータはサーバー側で削除されたものとして取り除きます"""
+    if table not in _sweeps:
+        return
+    # 受け取ったがまだ通知されていない分も記録してから比べる
+    registry.flush_changes()
+    seen = _sweeps.pop(table)
+    match table:
+        case 'emojis':
+            for eid in [eid for eid in registry.emojis if eid not in seen]:
+                registry.pop_emoji(eid)
+        case 'deleted':
+            from core import blobstore
+            popped = [registry.pop_deleted_emoji(eid) for eid in [eid for eid in registry.deleted if eid not in seen]]
+            # バックアップ画像も消す
+            blobstore.remove(emoji.image_backup for emoji in popped)
+        case 'reasons':
+            for rsid in [rsid for rsid in registry.reasons if rsid not in seen]:
+                registry.pop_reason(rsid)
+        case _:
+            # ユーザーとリスクはregistryから取り除けないので、キャッシュからだけ取り除く
+            # (参照していた絵文字が無くなれば画面には出てこない)
+            _executor.submit(_delete, table, [key for key in getattr(registry, table) if key not in seen])
+    synced = time.time()
+    _synced[table] = synced
+    _executor.submit(_put_meta, f'synced_{table}', synced)
+
+def cancel_sweep(table: str):
+    """全件取得が失敗したときに呼びます 何も取り除かず、次の接続で全件を取り直します"""
+    _sweeps.pop(table, None)
+
+def _to_body(record) -> dict:
+    return {name: getattr(record, name) for name in record.__slots__}
+
+def _on_changes(changes: ChangeSet):
+    if _server_host is None:
+        return
+    batch = []
+    for table, entity_changes, get_record in [
+        ('users', changes.users, registry.users.get),
+        # 送信中の変更はまだ確定していないので、サーバーが確定した値を保存する
+        ('risks', changes.risks, registry.get_confirmed_risk),
+        ('reasons', changes.reasons, registry.reasons.get),
+        ('emojis', changes.emojis, registry.emojis.get),
+        ('deleted', changes.deleted, registry.deleted.get),
+    ]:
+        keys = entity_changes.changed()
+        if table in _sweeps:
+            _sweeps[table].update(keys)
+        # レコードは書き換えられずに置き換わるので、参照を渡すだけでよい
+        records = [record for record in map(get_record, keys) if record is not None]
+        if len(records) > 0 or len(entity_changes.removed) > 0:
+            batch.append((table, records, list(entity_changes.removed)))
+    if len(batch) > 0:
+        _executor.submit(_write, batch)
+
+def _write(batch):
+    if _db is None:
+        return
+    try:
+        with _db:
+            for table, records, removed in batch:
+                _save(table, records, removed)
+    except sqlite3.Error:
+        traceback.print_exc()
+
+def _save(table, records, removed):
+    field = WATERMARK_FIELDS.get(table)
+    since = _since.get(table)
+    rows = []
+    for record in records:
+        rows.append((record.id, json.dumps(_to_body(record), ensure_ascii=False)))
+        if field is not None:
+            value = getattr(record, field)
+            if value is not None and (since is None or value > since):
+                since = value
+    if len(rows) > 0:
+        _db.executemany(f'INSERT INTO {table} (id, body) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET body = excluded.body', rows)
+    if len(removed) > 0:
+        _db.executemany(f'DELETE FROM {table} WHERE id = ?', [(key,) for key in removed])
+    if field is not None and since is not None and since != _since.get(table):
+        _since[table] = since
+        _db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (f'since_{table}', json.dumps(since)))
+
+def _delete(table, keys):
+    if _db is None or len(keys) == 0:
+        return
+    try:
+        with _db:
+            _db.executemany(f'DELETE FROM {table} WHERE id = ?', [(key,) for key in keys])
+    except sqlite3.Error:
+        traceback.print_exc()
+
+def _put_meta(key, value):
+    if _db is None:
+        return
+    try:
+        with _db:
+            _db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+    except sqlite3.Error:
+        traceback.print_exc()
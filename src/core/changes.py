@@ -0,0 +1,60 @@
+
+class EntityChanges():
+    """ある種類のデータについて、追加・更新・削除されたIDの集合
+    順序を保つためにvalue=Noneのdictを集合として使っている"""
+
+    __slots__ = ('added', 'updated', 'removed')
+
+    def __init__(self):
+        self.added: dict[str, None] = {}
+        self.updated: dict[str, None] = {}
+        self.removed: dict[str, None] = {}
+
+    def add(self, key: str):
+        if key in self.removed:
+            # 同じバッチ内で削除->追加された場合は、購読者から見ると更新になる
+            del self.removed[key]
+            self.updated[key] = None
+        elif key not in self.updated:
+            self.added[key] = None
+
+    def update(self, key: str):
+        if key not in self.added:
+            self.updated[key] = None
+
+    def remove(self, key: str):
+        if key in self.added:
+            # 同じバッチ内で追加->削除された場合は、購読者には何も通知しない
+            del self.added[key]
+            return
+        self.updated.pop(key, None)
+        self.removed[key] = None
+
+    def changed(self) -> list[str]:
+        """追加または更新されたID"""
+        return [*self.added, *self.updated]
+
+    def is_empty(self) -> bool:
+        return len(self.added) == 0 and len(self.updated) == 0 and len(self.removed) == 0
+
+
+class ChangeSet():
+    """registryに対する一連の変更をまとめたもの"""
+
+    __slots__ = ('emojis', 'deleted', 'users', 'risks', 'reasons')
+
+    def __init__(self):
+        self.emojis = EntityChanges()
+        self.deleted = EntityChanges()
+        self.users = EntityChanges()
+        self.risks = EntityChanges()
+        self.reasons = EntityChanges()
+
+    def is_empty(self) -> bool:
+        return (
+            self.emojis.is_empty()
+            and self.deleted.is_empty()
+            and self.users.is_empty()
+            and self.risks.is_empty()
+            and self.reasons.is_empty()
+        )
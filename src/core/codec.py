@@ -0,0 +1,219 @@
+import os
+import json
+import typing
+
+# websocketでやり取りするJSONの変換
+#
+# msgspec、orjsonの順に、インストールされていれば速い方を使い、どちらも無ければ標準のjsonを使う
+# 環境変数COTONESTRUM_JSONに 'msgspec' / 'orjson' / 'json' を指定すると使うものを固定できる
+#
+# msgspecを使う場合、絵文字・ユーザー・リスク・理由区分のレコードはdictを作らずに型付きの構造体へ直接読み込む
+# 構造体もdictと同じくrecord['id']で読めるので、受け取る側はどちらでも同じように扱える
+
+# opごとの、本文に入っているレコードの種類と、それが配列かどうか
+RECORD_OPS = {
+    'user_update': ('user', False),
+    'users_update': ('user', True),
+    'emoji_update': ('emoji', False),
+    'emojis_update': ('emoji', True),
+    'deleted_emoji_update': ('deleted_emoji', False),
+    'deleted_emojis_update': ('deleted_emoji', True),
+    'risk_update': ('risk', False),
+    'risks_update': ('risk', True),
+    'reason_update': ('reason', False),
+    'reasons_update': ('reason', True),
+}
+
+class Message():
+    """受信したメッセージ"""
+
+    __slots__ = ('op', 'reqid', 'body')
+
+    def __init__(self, op: str, reqid: str | None, body: typing.Any):
+        self.op = op
+        self.reqid = reqid
+        self.body = body
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Message':
+        return cls(data['op'], data.get('reqid'), data.get('body'))
+
+    def to_dict(self) -> dict:
+        """dictとlistだけで表した内容を返します (本文の構造体もdictにする)"""
+        data = {'op': self.op}
+        if self.reqid is not None:
+            data['reqid'] = self.reqid
+        data['body'] = codec.to_builtins(self.body)
+        return data
+
+class Codec():
+    """decode_body(op, data): opのメッセージの本文を読み込みます 大きなフレームの配列を区切って読むときにも使う
+    to_builtins(obj): 読み込んだ構造体をdictに戻します"""
+
+    __slots__ = ('name', 'loads', 'dumps', 'decode_message', 'decode_body', 'to_builtins')
+
+    def __init__(self, name, loads, dumps, decode_message=None, decode_body=None, to_builtins=None):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        if decode_message is None:
+            def decode_message(frame):
+                return Message.from_dict(loads(frame))
+        self.decode_message = decode_message
+        if decode_body is None:
+            def decode_body(op, data):
+                return loads(data)
+        self.decode_body = decode_body
+        self.to_builtins = to_builtins if to_builtins is not None else _identity
+
+def _identity(obj):
+    return obj
+
+
+def _json_codec() -> Codec:
+    return Codec('json', json.loads, json.dumps)
+
+def _orjson_codec() -> Codec | None:
+    try:
+        import orjson
+    except ImportError:
+        return None
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+    return Codec('orjson', orjson.loads, dumps)
+
+def _msgspec_codec() -> Codec | None:
+    try:
+        import msgspec
+    except ImportError:
+        return None
+
+    class MessageStruct(msgspec.Struct):
+        op: str
+        reqid: str | None = None
+        # 本文はopが分かってから読む
+        body: msgspec.Raw = msgspec.Raw()
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+    message_decoder = msgspec.json.Decoder(MessageStruct)
+    record_types = _record_types(msgspec)
+    body_decoders = {}
+    for op, (kind, is_list) in RECORD_OPS.items():
+        record_type = record_types[kind]
+        body_decoders[op] = msgspec.json.Decoder(list[record_type] if is_list else record_type)
+
+    def dumps(obj) -> str:
+        return encoder.encode(obj).decode('utf-8')
+    def decode_body(op, data):
+        d = body_decoders.get(op)
+        if d is not None:
+            try:
+                return d.decode(data)
+            except msgspec.ValidationError:
+                # 想定と違う形のレコードは、型を付けずに読む
+                pass
+        return decoder.decode(data)
+    def decode_message(frame) -> Message:
+        # 外側はdictを作らずに直接読み取る
+        m = message_decoder.decode(frame)
+        body = decode_body(m.op, m.body) if len(m.body) > 0 else None
+        return Message(m.op, m.reqid, body)
+    return Codec('msgspec', decoder.decode, dumps, decode_message, decode_body, msgspec.to_builtins)
+
+def _record_types(msgspec) -> dict[str, type]:
+    """レコードの種類 -> 構造体の型
+    registryが使うフィールドだけを読み込む(他のフィールドは読み飛ばす)
+    レコード同士が参照し合うことは無いので、GCの追跡の対象にしない"""
+    class Record(msgspec.Struct, gc=False):
+        def __getitem__(self, key):
+            return getattr(self, key)
+
+    class UserRecord(Record, gc=False):
+        id: str
+        misskey_id: str | None
+        username: str | None
+
+    class EmojiRecord(Record, gc=False):
+        id: str
+        misskey_id: str | None
+        name: str | None
+        category: str | None
+        tags: list[str]
+        url: str | None
+        is_self_made: bool | None
+        license: str | None
+        owner_id: str | None
+        risk_id: str | None
+        created_at: str | None
+        updated_at: str | None
+
+    class DeletedEmojiRecord(Record, gc=False):
+        id: str
+        misskey_id: str | None
+        name: str | None
+        category: str | None
+        tags: list[str]
+        url: str | None
+        image_backup: str | None
+        is_self_made: bool | None
+        license: str | None
+        owner_id: str | None
+        risk_id: str | None
+        info: str | None
+        deleted_at: str | None
+
+    class RiskRecord(Record, gc=False):
+        id: str
+        checked: int | None
+        level: int | None
+        reason_genre: str | None
+        remark: str | None
+        created_at: str | None
+        updated_at: str | None
+
+    class ReasonRecord(Record, gc=False):
+        id: str
+        text: str | None
+        created_at: str | None
+        updated_at: str | None
+
+    return {
+        'user': UserRecord,
+        'emoji': EmojiRecord,
+        'deleted_emoji': DeletedEmojiRecord,
+        'risk': RiskRecord,
+        'reason': ReasonRecord,
+    }
+
+def available_codecs() -> dict[str, Codec]:
+    """使える変換方法を、速いと思われる順に返します"""
+    ret = {}
+    for factory in [_msgspec_codec, _orjson_codec, _json_codec]:
+        c = factory()
+        if c is not None:
+            ret[c.name] = c
+    return ret
+
+def _select() -> Codec:
+    codecs = available_codecs()
+    name = os.environ.get('COTONESTRUM_JSON')
+    if name is not None:
+        if name in codecs:
+            return codecs[name]
+        print(f"json codec '{name}' is not available")
+    return next(iter(codecs.values()))
+
+codec = _select()
+
+def loads(data):
+    return codec.loads(data)
+
+def dumps(obj) -> str:
+    return codec.dumps(obj)
+
+def decode_message(frame) -> Message:
+    return codec.decode_message(frame)
+
+def decode_body(op: str | None, data):
+    return codec.decode_body(op, data)
@@ -1,5 +1,7 @@
 
 class EmojiData():
+    __slots__ = ('id', 'misskey_id', 'name', 'category', 'tags', 'url', 'is_self_made', 'license', 'owner_id', 'risk_id', 'created_at', 'updated_at')
+
     def __init__(self, eid, misskey_id, name, category, tags, url, is_self_made, license, owner_id, risk_id, created_at, updated_at):
         self.id = eid
 
@@ -18,6 +20,8 @@ class EmojiData():
         self.updated_at = updated_at
 
 class DeletedEmojiData():
+    __slots__ = ('id', 'misskey_id', 'name', 'category', 'tags', 'url', 'image_backup', 'is_self_made', 'license', 'owner_id', 'risk_id', 'info', 'deleted_at')
+
     def __init__(self, eid, misskey_id, name, category, tags, url, image_backup, is_self_made, license, owner_id, risk_id, info, deleted_at):
         self.id = eid
 
@@ -26,6 +30,7 @@ class DeletedEmojiData():
         self.category = category
         self.tags = tags
         self.url = url
+        # バックアップ画像のキー (画像そのものはblobstoreに保存されている)
         self.image_backup = image_backup
         self.is_self_made = is_self_made
         self.license = license
@@ -38,6 +43,8 @@ class DeletedEmojiData():
         self.deleted_at = deleted_at
 
 class UserData():
+    __slots__ = ('id', 'misskey_id', 'username')
+
     def __init__(self, uid, misskey_id, username):
         self.id = uid
 
@@ -45,6 +52,8 @@ class UserData():
         self.username = username
 
 class RiskData():
+    __slots__ = ('id', 'checked', 'level', 'reason_genre', 'remark', 'created_at', 'updated_at')
+
     def __init__(self, rid, checked, level, reason_genre, remark, created_at, updated_at):
         self.id = rid
 
@@ -57,6 +66,8 @@ class RiskData():
         self.updated_at = updated_at
 
 class ReasonData():
+    __slots__ = ('id', 'text', 'created_at', 'updated_at')
+
     def __init__(self, rsid, text, created_at, updated_at):
         self.id = rsid
 
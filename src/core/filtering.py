@@ -1,5 +1,47 @@
 
 from core import registry
+from core.changes import ChangeSet
+
+def _accept_all(e) -> bool:
+    return True
+
+def _reject_all(e) -> bool:
+    return False
+
+def _normalize_reason(target: str | None) -> str | None:
+    return target if target not in ['', None] else None
+
+def _search_terms(filtering: str | None) -> list[str] | None:
+    """インデックスで絞り込める文字列の条件なら検索語を返します"""
+    if filtering is None:
+        return None
+    terms = filtering.split()
+    if len(terms) == 0:
+        return None
+    return terms
+
+def _lookup(index: dict[str, set[str]], keys) -> set[str]:
+    """逆引きインデックスを使ってキーの集合を絵文字IDの集合に変換します"""
+    ret = set()
+    for key in keys:
+        if key in index:
+            ret |= index[key]
+    return ret
+
+def _compile_str(filtering: str | None):
+    """文字列の条件を判定関数にします 常に真になる場合はNone"""
+    if filtering is None:
+        # 空の項目のみを検索
+        return lambda t: t in ['', None]
+    if filtering == '':
+        return None
+    terms = filtering.split()
+    if len(terms) == 0:
+        return lambda t: t is not None
+    if len(terms) == 1:
+        term = terms[0]
+        return lambda t: t is not None and term in t
+    return lambda t: t is not None and all(i in t for i in terms)
 
 class SelectionIsSelfMade():
     def __init__(self, no: bool, yes: bool):
@@ -35,6 +77,12 @@ class SelectionRiskLevel():
             case _:
                 return False
 
+    def _allowed(self) -> set:
+        return {
+            v for v, enabled in [(None, self.notset), (0, self.low), (1, self.medium), (2, self.high), (3, self.danger)]
+            if enabled
+        }
+
 class SelectionReasonGenre():
     def __init__(self, mapping: dict[str | None, bool]):
         self.mapping = mapping
@@ -47,6 +95,9 @@ class SelectionReasonGenre():
 
         return self.mapping[target0]
 
+    def _allowed(self) -> set:
+        return {rsid for rsid, enabled in self.mapping.items() if enabled}
+
 class SelectionCheckStatus():
     def __init__(self, need_check: bool, checked: bool, need_recheck: bool):
         self.need_check = need_check
@@ -64,6 +115,12 @@ class SelectionCheckStatus():
             case _:
                 return False
 
+    def _allowed(self) -> set:
+        return {
+            v for v, enabled in [(0, self.need_check), (1, self.checked), (2, self.need_recheck)]
+            if enabled
+        }
+
 class EmojiFilter():
 
     @classmethod
@@ -134,95 +191,196 @@ class EmojiFilter():
         self.empty_username = empty_username
         self.empty_remark = empty_remark
 
-    def filter_all(self, emojis: list[str]) -> list[str]:
-        return [eid for eid in emojis if self.filter(eid)]
-
-    def filter(self, eid: str) -> bool:
-        emoji = registry.get_emoji(eid)
-        if emoji is None:
-            return False
-
-        name = emoji.name
-        category = emoji.category
-        tags = ' '.join(emoji.tags)
-        is_self_made = emoji.is_self_made
-        licence = emoji.license
-
-        uid = emoji.owner_id
-        user = registry.get_user(uid)
-        if user is not None:
-            username = user.username
-        else:
-            username = ''
-
-        rid = emoji.risk_id
-        risk = registry.get_risk(rid)
-        if risk is not None:
-            risk_level = risk.level
-            remark = risk.remark
-            status = risk.checked
-
-            rsid = risk.reason_genre
-        else:
-            risk_level = None
-            remark = None
-            status = 0
-            rsid = None
-
-        return (
-            (not (self.enabled and self.enabled_name) or self._filter_name(name))
-            and (not (self.enabled and self.enabled_category) or self._filter_category(category))
-            and (not (self.enabled and self.enabled_tags) or self._filter_tags(tags))
-            and (not (self.enabled and self.enabled_is_self_made) or self._filter_is_self_made(is_self_made))
-            and (not (self.enabled and self.enabled_licence) or self._filter_licence(licence))
-            and (not (self.enabled and self.enabled_username) or self._filter_username(username))
-            and (not (self.enabled and self.enabled_risk_level) or self._filter_risk_level(risk_level))
-            and (not (self.enabled and self.enabled_remark) or self._filter_remark(remark))
-            and (not (self.enabled and self.enabled_status) or self._filter_status(status))
-            and (not (self.enabled and self.enabled_reason_genre) or self._filter_reason_genre(rsid))
-        )
+        self._plan = None
 
-    def _filter_str(self, target: str | None, filtering: str | None) -> bool:
-        if filtering is not None:
-            if filtering == '':
-                return True
+    def _records(self) -> dict:
+        return registry.emojis
 
-            if target is None:
-                return False
-
-            return all([i in target for i in filtering.split()])
-        else:
-            return target in ['', None]
+    def _texts(self) -> dict:
+        return registry.emoji_texts
 
-    def _filter_name(self, name: str | None) -> bool:
-        return self._filter_str(name, self.name)
+    def _by_owner(self) -> dict:
+        return registry.emojis_by_owner
 
-    def _filter_category(self, category: str | None) -> bool:
-        return self._filter_str(category, self.category)
+    def _by_risk(self) -> dict:
+        return registry.emojis_by_risk
 
-    def _filter_tags(self, tags: str | None) -> bool:
-        return self._filter_str(tags, self.tags)
-
-    def _filter_licence(self, licence: str | None) -> bool:
-        return self._filter_str(licence, self.licence)
-
-    def _filter_username(self, username: str | None) -> bool:
-        return self._filter_str(username, self.username)
-
-    def _filter_remark(self, remark: str | None) -> bool:
-        return self._filter_str(remark, self.remark)
-
-    def _filter_is_self_made(self, is_self_made: bool) -> bool:
-        return self.is_self_made._filter(is_self_made)
-
-    def _filter_risk_level(self, risk_level: int | None) -> bool:
-        return self.risk_level._filter(risk_level)
-
-    def _filter_reason_genre(self, reason_genre: str | None) -> bool:
-        return self.reason_genre._filter(reason_genre)
+    def filter_all(self, emojis: list[str]) -> list[str]:
+        plan = self.compile()
+        records = self._records()
+        candidates = self.candidates()
+        if candidates is not None:
+            # 候補に無いものは確認するまでもなく一致しない
+            emojis = [eid for eid in emojis if eid in candidates]
+        ret = []
+        for eid in emojis:
+            emoji = records.get(eid)
+            if emoji is not None and plan(emoji):
+                ret.append(eid)
+        return ret
+
+    def candidates(self) -> set[str] | None:
+        """文字列の条件をN-gramインデックスで引き、一致する可能性がある絵文字IDの集合を返します
+        絞り込めない場合はNone 結果は上位集合なので、compileした判定関数での確認が必要"""
+        if not self.enabled:
+            return None
+
+        sets = []
+        texts = self._texts()
+        for enabled, field, filtering in [
+            (self.enabled_name, 'name', self.name),
+            (self.enabled_category, 'category', self.category),
+            (self.enabled_tags, 'tags', self.tags),
+            (self.enabled_licence, 'license', self.licence),
+        ]:
+            terms = _search_terms(filtering) if enabled else None
+            if terms is not None:
+                found = texts[field].search(terms)
+                if found is not None:
+                    sets.append(found)
+
+        terms = _search_terms(self.username) if self.enabled_username else None
+        if terms is not None:
+            found = registry.username_index.search(terms)
+            if found is not None:
+                sets.append(_lookup(self._by_owner(), found))
+
+        terms = _search_terms(self.remark) if self.enabled_remark else None
+        if terms is not None:
+            found = registry.remark_index.search(terms)
+            if found is not None:
+                sets.append(_lookup(self._by_risk(), found))
+
+        if len(sets) == 0:
+            return None
+        sets.sort(key=len)
+        ret = sets[0]
+        for found in sets[1:]:
+            ret = ret & found
+            if len(ret) == 0:
+                break
+        return ret
 
-    def _filter_status(self, status: bool) -> bool:
-        return self.status._filter(status)
+    def filter(self, eid: str) -> bool:
+        emoji = self._records().get(eid)
+        if emoji is None:
+            return False
+        return self.compile()(emoji)
+
+    def compile(self):
+        """有効な条件だけを含む判定関数を生成します
+        生成結果はキャッシュされます(フィルターは生成後に変更されない前提)"""
+        if self._plan is None:
+            self._plan = self._compile()
+        return self._plan
+
+    def _compile(self):
+        if not self.enabled:
+            return _accept_all
+
+        # (コスト, 判定関数) 安く、絞り込みやすいものから評価する
+        # 各lambdaは生成時の値を使うようにデフォルト引数で束縛している
+        clauses = []
+        risk_clauses = []
+
+        if self.enabled_is_self_made:
+            yes, no = bool(self.is_self_made.yes), bool(self.is_self_made.no)
+            if not yes and not no:
+                return _reject_all
+            if yes != no:
+                clauses.append((1, lambda e, yes=yes: bool(e.is_self_made) == yes))
+
+        if self.enabled_risk_level:
+            allowed = self.risk_level._allowed()
+            if len(allowed) == 0:
+                return _reject_all
+            risk_clauses.append((len(allowed), lambda r, allowed=allowed: (r.level if r is not None else None) in allowed))
+
+        if self.enabled_status:
+            allowed = self.status._allowed()
+            if len(allowed) == 0:
+                return _reject_all
+            # リスクのデータが無い場合は要チェック扱い
+            risk_clauses.append((len(allowed), lambda r, allowed=allowed: (r.checked if r is not None else 0) in allowed))
+
+        if self.enabled_reason_genre:
+            allowed = self.reason_genre._allowed()
+            if len(allowed) == 0:
+                return _reject_all
+            risk_clauses.append((len(allowed), lambda r, allowed=allowed: _normalize_reason(r.reason_genre if r is not None else None) in allowed))
+
+        if self.enabled_remark:
+            test = _compile_str(self.remark)
+            if test is not None:
+                risk_clauses.append((10, lambda r, test=test: test(r.remark if r is not None else None)))
+
+        if len(risk_clauses) > 0:
+            risk_tests = [f for _, f in sorted(risk_clauses, key=lambda x: x[0])]
+            risks = registry.risks
+            if len(risk_tests) == 1:
+                risk_test = risk_tests[0]
+                clauses.append((2, lambda e, risk_test=risk_test: risk_test(risks.get(e.risk_id))))
+            else:
+                def test_risk(e):
+                    r = risks.get(e.risk_id)
+                    for f in risk_tests:
+                        if not f(r):
+                            return False
+                    return True
+                clauses.append((2, test_risk))
+
+        if self.enabled_name:
+            test = _compile_str(self.name)
+            if test is not None:
+                clauses.append((3, lambda e, test=test: test(e.name)))
+
+        if self.enabled_category:
+            test = _compile_str(self.category)
+            if test is not None:
+                clauses.append((3, lambda e, test=test: test(e.category)))
+
+        if self.enabled_licence:
+            test = _compile_str(self.licence)
+            if test is not None:
+                clauses.append((3, lambda e, test=test: test(e.license)))
+
+        if self.enabled_tags:
+            test = _compile_str(self.tags)
+            if test is not None:
+                clauses.append((4, lambda e, test=test: test(' '.join(e.tags))))
+
+        if self.enabled_username:
+            test = _compile_str(self.username)
+            if test is not None:
+                users = registry.users
+                def test_username(e):
+                    user = users.get(e.owner_id)
+                    return test(user.username if user is not None else '')
+                clauses.append((5, test_username))
+
+        tests = [f for _, f in sorted(clauses, key=lambda x: x[0])]
+        if len(tests) == 0:
+            return _accept_all
+        if len(tests) == 1:
+            return tests[0]
+
+        def plan(e):
+            for f in tests:
+                if not f(e):
+                    return False
+            return True
+        return plan
+
+    def affected_by(self, changes: ChangeSet) -> set[str]:
+        """リスクやユーザーの変更によって判定結果が変わり得る絵文字IDの集合を返します"""
+        ret = set()
+        if not self.enabled:
+            return ret
+        if self.enabled_risk_level or self.enabled_reason_genre or self.enabled_remark or self.enabled_status:
+            ret |= _lookup(self._by_risk(), changes.risks.changed())
+        if self.enabled_username:
+            ret |= _lookup(self._by_owner(), changes.users.changed())
+        return ret
 
     def get_filter_status(self):
         return (
@@ -282,47 +440,14 @@ class DeletedEmojiFilter(EmojiFilter):
     ):
         super().__init__(enabled, enabled_name, enabled_category, enabled_tags, enabled_is_self_made, enabled_licence, enabled_username, enabled_risk_level, enabled_reason_genre, enabled_remark, enabled_status, name, category, tags, is_self_made, licence, username, risk_level, reason_genre, remark, status, empty_category, empty_tags, empty_licence, empty_username, empty_remark)
 
-    def filter(self, eid: str) -> bool:
-        emoji = registry.get_deleted_emoji(eid)
-        if emoji is None:
-            return False
+    def _records(self) -> dict:
+        return registry.deleted
 
-        name = emoji.name
-        category = emoji.category
-        tags = ' '.join(emoji.tags)
-        is_self_made = emoji.is_self_made
-        licence = emoji.license
-
-        uid = emoji.owner_id
-        user = registry.get_user(uid)
-        if user is not None:
-            username = user.username
-        else:
-            username = ''
+    def _texts(self) -> dict:
+        return registry.deleted_texts
 
-        rid = emoji.risk_id
-        risk = registry.get_risk(rid)
-        if risk is not None:
-            risk_level = risk.level
-            remark = risk.remark
-            status = risk.checked
+    def _by_owner(self) -> dict:
+        return registry.deleted_by_owner
 
-            rsid = risk.reason_genre
-        else:
-            risk_level = None
-            remark = None
-            status = 0
-            rsid = None
-
-        return (
-            (not (self.enabled and self.enabled_name) or self._filter_name(name))
-            and (not (self.enabled and self.enabled_category) or self._filter_category(category))
-            and (not (self.enabled and self.enabled_tags) or self._filter_tags(tags))
-            and (not (self.enabled and self.enabled_is_self_made) or self._filter_is_self_made(is_self_made))
-            and (not (self.enabled and self.enabled_licence) or self._filter_licence(licence))
-            and (not (self.enabled and self.enabled_username) or self._filter_username(username))
-            and (not (self.enabled and self.enabled_risk_level) or self._filter_risk_level(risk_level))
-            and (not (self.enabled and self.enabled_remark) or self._filter_remark(remark))
-            and (not (self.enabled and self.enabled_status) or self._filter_status(status))
-            and (not (self.enabled and self.enabled_reason_genre) or self._filter_reason_genre(rsid))
-        )
+    def _by_risk(self) -> dict:
+        return registry.deleted_by_risk
@@ -0,0 +1,423 @@
+import os
+import os.path as osp
+import json
+import time
+import hmac
+import hashlib
+import secrets
+import threading
+import contextlib
+import traceback
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from core import cache
+from core import blobstore
+from core.prefetch import Prefetcher
+from core.imaging import make_thumbnail, THUMBNAIL_SIZE, THUMBNAIL_SCALE
+
+# 絵文字の画像を中継するローカルのHTTPサーバー
+#
+# 画面の画像はこのサーバーを通して読み込み、取得した画像はディスクにキャッシュする
+# キャッシュはMAX_CACHE_BYTESを超えると、最後に使ってから長いものから消す
+# REVALIDATE_AFTER秒より古いものは、ETag/Last-Modifiedで変わっていないか確かめてから返す
+# Pillowがインストールされていれば、一覧用の縮小画像も作ってキャッシュする(任意)
+# 削除された絵文字のバックアップ画像(blobstoreに保存したもの)もここから返す
+# 他のプロセスやブラウザのページから任意のURLを取りに行かせられないよう、
+# 起動するたびに作る合言葉(token)をパスの先頭に含まないリクエストは断る
+#
+# 環境変数COTONESTRUM_IMAGE_PROXYに '0' を指定すると使わない
+
+IMAGE_PROXY_ENV = 'COTONESTRUM_IMAGE_PROXY'
+
+IMAGE_CACHE_DIR = osp.join(cache.CACHE_DIR, 'images')
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+REVALIDATE_AFTER = 60 * 60.
+# 取得に失敗したURLを、再び取りに行かずに失敗として扱う時間(秒)
+NEGATIVE_TTL = 10 * 60.
+FETCH_TIMEOUT = 15.
+# バックアップ画像が書き出されるのを待つ時間(秒)
+BLOB_WAIT_TIMEOUT = 30.
+# 縮小画像の大きさ 画面が使う大きさだけを作り、それ以外を指定されたらこの中の近いものにする
+THUMBNAIL_SIZES = (THUMBNAIL_SIZE * THUMBNAIL_SCALE,)
+# 画面側にキャッシュしてもらう時間(秒)
+CLIENT_MAX_AGE = 24 * 60 * 60
+
+USER_AGENT = 'Cotonestrum'
+
+
+class ImageCache():
+    """ディスク上の画像キャッシュ
+    1つの画像は、内容のファイル(.bin)と、ヘッダーなどを書いたファイル(.json)で保存する"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = 0
+        # key -> 大きさ 最後に使ったものが末尾
+        self._index: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._indexed = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # ファイルが多いと時間がかかるので、既存のキャッシュの一覧は別スレッドで作る
+        threading.Thread(target=self._load_index, name='image-cache-index', daemon=True).start()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = osp.join(self.directory, key[:2], key)
+        return f'{base}.bin', f'{base}.json'
+
+    def _load_index(self):
+        entries = []
+        try:
+            for sub in os.scandir(self.directory):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith('.bin'):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+        except OSError:
+            traceback.print_exc()
+        entries.sort()
+        with self._lock:
+            # 一覧を作っている間に追加・使用されたものは、新しいものとして後ろに残す
+            index = collections.OrderedDict((key, size) for _, key, size in entries if key not in self._index)
+            index.update(self._index)
+            self._index = index
+            self.total = sum(index.values())
+            self._indexed = True
+        self._evict()
+
+    def get(self, key: str) -> tuple[dict, bytes] | None:
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'rt', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            os.utime(data_path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            else:
+                self._index[key] = len(data)
+                self.total += len(data)
+        return meta, data
+
+    def put(self, key: str, meta: dict, data: bytes):
+        data_path, meta_path = self._paths(key)
+        try:
+            os.makedirs(osp.dirname(data_path), exist_ok=True)
+            with open(f'{data_path}.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(f'{data_path}.tmp', data_path)
+            self.put_meta(key, meta)
+        except OSError:
+            traceback.print_exc()
+            return
+        with self._lock:
+            self.total -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self.total += len(data)
+        self._evict()
+
+    def put_meta(self, key: str, meta: dict):
+        _, meta_path = self._paths(key)
+        with open(f'{meta_path}.tmp', 'wt', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f'{meta_path}.tmp', meta_path)
+
+    def _evict(self):
+        removed = []
+        with self._lock:
+            if not self._indexed:
+                return
+            while self.total > self.max_bytes and len(self._index) > 0:
+                key, size = self._index.popitem(last=False)
+                self.total -= size
+                removed.append(key)
+        for key in removed:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+_cache: ImageCache | None = None
+_server: ThreadingHTTPServer | None = None
+# http://127.0.0.1:<port>/<token>
+base_url: str | None = None
+_token: str | None = None
+
+# 同じ画像を同時に取りに行かないためのロック
+# key -> [ロック, 使っているスレッドの数] 使い終わったら取り除く
+_fetch_locks: dict[str, list] = {}
+_fetch_locks_lock = threading.Lock()
+# url -> 取得に失敗した時刻 古いものが先頭
+_failed: collections.OrderedDict[str, float] = collections.OrderedDict()
+_failed_lock = threading.Lock()
+# 縮小しない(できない)画像の内容のハッシュ 古いものが先頭
+_no_thumbnail: collections.OrderedDict[str, None] = collections.OrderedDict()
+_no_thumbnail_lock = threading.Lock()
+MAX_NO_THUMBNAIL = 4096
+
+def _key(url: str, size: int | None = None) -> str:
+    return hashlib.sha256(f'{url}#{size or ""}'.encode('utf-8')).hexdigest()
+
+@contextlib.contextmanager
+def _fetch_lock(key: str):
+    with _fetch_locks_lock:
+        entry = _fetch_locks.get(key)
+        if entry is None:
+            entry = _fetch_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _fetch_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _fetch_locks[key]
+
+def _recently_failed(url: str) -> bool:
+    with _failed_lock:
+        failed_at = _failed.get(url)
+        return failed_at is not None and time.time() - failed_at < NEGATIVE_TTL
+
+def _set_failed(url: str, failed: bool):
+    now = time.time()
+    with _failed_lock:
+        _failed.pop(url, None)
+        if failed:
+            _failed[url] = now
+        # NEGATIVE_TTLを過ぎたものは取り除く
+        while len(_failed) > 0:
+            oldest, failed_at = next(iter(_failed.items()))
+            if now - failed_at < NEGATIVE_TTL:
+                break
+            del _failed[oldest]
+
+def _fetch(url: str, meta: dict | None) -> tuple[dict, bytes] | None:
+    """画像を取得します metaがあれば条件付きで取得し、変わっていなければ (meta, b'') を返します"""
+    headers = {'User-Agent': USER_AGENT}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=FETCH_TIMEOUT) as res:
+            data = res.read()
+            new_meta = {
+                'url': url,
+                'content_type': res.headers.get('Content-Type', 'application/octet-stream'),
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'digest': hashlib.sha256(data).hexdigest(),
+                'checked_at': time.time(),
+            }
+            return new_meta, data
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and meta is not None:
+            return dict(meta, checked_at=time.time()), b''
+        print(f'image could not fetched: {url} ({e.code})')
+    except (OSError, ValueError) as e:
+        print(f'image could not fetched: {url} ({e})')
+    return None
+
+def get_original(url: str) -> tuple[dict, bytes] | None:
+    """画像を (meta, 内容) で返します キャッシュが古ければ確かめ直し、取得できなければ古いキャッシュを返します"""
+    key = _key(url)
+    entry = _cache.get(key)
+    if entry is not None and time.time() - entry[0].get('checked_at', 0) < REVALIDATE_AFTER:
+        return entry
+    if entry is None and _recently_failed(url):
+        return None
+    with _fetch_lock(key):
+        # 待っている間に他のスレッドが取得していれば、それを使う
+        latest = _cache.get(key)
+        if latest is not None and time.time() - latest[0].get('checked_at', 0) < REVALIDATE_AFTER:
+            return latest
+        fetched = _fetch(url, entry[0] if entry is not None else None)
+        if fetched is None:
+            if entry is None:
+                _set_failed(url, True)
+            return entry
+        _set_failed(url, False)
+        meta, data = fetched
+        if data == b'' and entry is not None:
+            _cache.put_meta(key, meta)
+            return meta, entry[1]
+        _cache.put(key, meta, data)
+        return meta, data
+
+def _clamp_size(size: int) -> int | None:
+    """指定された大きさ以上で一番小さいTHUMBNAIL_SIZESの大きさを返します 無ければ元の画像(None)"""
+    for allowed in sorted(THUMBNAIL_SIZES):
+        if size <= allowed:
+            return allowed
+    return None
+
+def get_image(url: str, size: int | None = None) -> tuple[str, bytes] | None:
+    """画像を (Content-Type, 内容) で返します sizeを指定すると、できればその大きさに縮小したものを返します"""
+    original = get_original(url)
+    if original is None:
+        return None
+    meta, data = original
+    if size is None or meta['digest'] in _no_thumbnail:
+        return meta['content_type'], data
+
+    key = _key(url, size)
+    entry = _cache.get(key)
+    if entry is not None and entry[0].get('source') == meta['digest']:
+        return entry[0]['content_type'], entry[1]
+    thumbnail = make_thumbnail(data, size)
+    if thumbnail is None:
+        with _no_thumbnail_lock:
+            _no_thumbnail[meta['digest']] = None
+            if len(_no_thumbnail) > MAX_NO_THUMBNAIL:
+                _no_thumbnail.popitem(last=False)
+        return meta['content_type'], data
+    _cache.put(key, {'url': url, 'content_type': 'image/png', 'source': meta['digest']}, thumbnail)
+    return 'image/png', thumbnail
+
+
+# これから表示される画像を先読みしておき、ここから返す
+prefetcher = Prefetcher(lambda key: get_image(*key))
+
+def prefetch(urls, size: int | None = None, urgent: bool = False):
+    """画像を先読みします urlsは表示に使うのと同じ(override_url後の)URL
+    urgentでなければ、前回頼んだ分のうちまだ読み始めていないものは取りやめます"""
+    if base_url is None:
+        return
+    prefetcher.request([(url, size) for url in urls if url is not None and url.startswith(('http://', 'https://'))], urgent)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """GET /<token>/image?url=<画像のURL>&size=<大きさ>
+    GET /<token>/blob/<バックアップ画像のキー>?thumbnail=1"""
+
+    def do_GET(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        token, _, path = parsed.path[1:].partition('/')
+        if _token is None or not hmac.compare_digest(token, _token):
+            self.send_error(403)
+            return
+        path = f'/{path}'
+        if path.startswith('/blob/'):
+            self.get_blob(path[len('/blob/'):], 'thumbnail=1' in parsed.query)
+            return
+        if path != '/image':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(parsed.query)
+        url = query.get('url', [''])[0]
+        if not url.startswith(('http://', 'https://')):
+            self.send_error(400)
+            return
+        try:
+            size = _clamp_size(int(query['size'][0])) if 'size' in query else None
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            result = prefetcher.get((url, size))
+            if result is None:
+                result = get_image(url, size)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        if result is None:
+            self.send_error(502)
+            return
+        self.send_image(*result)
+
+    def get_blob(self, key: str, thumbnail: bool):
+        if not blobstore.is_key(key):
+            self.send_error(400)
+            return
+        try:
+            result = blobstore.read(key, thumbnail, BLOB_WAIT_TIMEOUT)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        if result is None:
+            self.send_error(404)
+            return
+        self.send_image(*result)
+
+    def send_image(self, content_type: str, data: bytes):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', f'max-age={CLIENT_MAX_AGE}')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port: int = 0) -> str | None:
+    """中継サーバーを起動し、そのURLを返します 起動できなければNone"""
+    global _cache, _server, base_url, _token
+    if _server is not None:
+        return base_url
+    if os.environ.get(IMAGE_PROXY_ENV) == '0':
+        return None
+    try:
+        _cache = ImageCache(IMAGE_CACHE_DIR, MAX_CACHE_BYTES)
+        _server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    except OSError:
+        traceback.print_exc()
+        print('image proxy could not started')
+        return None
+    _server.daemon_threads = True
+    _token = secrets.token_urlsafe(16)
+    threading.Thread(target=_server.serve_forever, name='image-proxy', daemon=True).start()
+    base_url = f'http://127.0.0.1:{_server.server_address[1]}/{_token}'
+    print(f'image proxy started at http://127.0.0.1:{_server.server_address[1]}')
+    return base_url
+
+def stop():
+    global _server, base_url, _token
+    if _server is None:
+        return
+    _server.shutdown()
+    _server.server_close()
+    _server = None
+    base_url = None
+    _token = None
+
+def proxy_url(url: str | None, size: int | None = None) -> str | None:
+    """画像のURLを、中継サーバーを通すURLに書き換えます 中継サーバーが無ければそのまま返します"""
+    if base_url is None or url is None or not url.startswith(('http://', 'https://')):
+        return url
+    query = {'url': url}
+    if size is not None:
+        query['size'] = str(size)
+    return f'{base_url}/image?{urllib.parse.urlencode(query)}'
+
+def thumbnail_url(url: str | None) -> str | None:
+    """一覧用の縮小画像のURLを返します"""
+    return proxy_url(url, THUMBNAIL_SIZE * THUMBNAIL_SCALE)
+
+def prefetch_thumbnails(urls):
+    """一覧用の縮小画像を先読みします"""
+    prefetch(urls, THUMBNAIL_SIZE * THUMBNAIL_SCALE)
+
+def blob_url(key: str | None, thumbnail: bool = False) -> str | None:
+    """バックアップ画像のURLを返します 中継サーバーが無ければファイルのパスを返します"""
+    if key is None:
+        return None
+    if base_url is None:
+        return blobstore.path(key, thumbnail)
+    return f'{base_url}/blob/{key}' + ('?thumbnail=1' if thumbnail else '')
@@ -0,0 +1,53 @@
+import io
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 画像の扱い
+# 縮小にはPillowを使う インストールされていなければ縮小せずにそのまま使う(任意)
+
+# 一覧の画像の大きさ 高解像度の画面でもぼやけないよう、縮小画像はTHUMBNAIL_SCALE倍で作る
+THUMBNAIL_SIZE = 46
+THUMBNAIL_SCALE = 2
+
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+]
+
+def guess_content_type(data: bytes) -> str:
+    """画像の先頭のバイト列から種類を推測します"""
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'image/avif'
+    if data.lstrip()[:5] in (b'<svg ', b'<?xml'):
+        return 'image/svg+xml'
+    return 'application/octet-stream'
+
+def make_thumbnail(data: bytes, size: int) -> bytes | None:
+    """縮小したPNGを返します Pillowが無い、アニメーションする、既に小さいなどの場合はNone"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            # アニメーションは縮小すると止まってしまうので、そのまま使う
+            if getattr(im, 'is_animated', False):
+                return None
+            if max(im.size) <= size:
+                return None
+            im.thumbnail((size, size), Image.LANCZOS)
+            if im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                im = im.convert('RGBA')
+            out = io.BytesIO()
+            im.save(out, 'PNG', optimize=True)
+            return out.getvalue()
+    except Exception:
+        return None
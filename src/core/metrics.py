@@ -0,0 +1,209 @@
+import os
+import math
+import json
+import time
+import asyncio
+import traceback
+
+# websocketの送受信の計測
+#
+# 送信した操作: 送信数・完了数・失敗数と、応答までの時間のヒストグラム (opごと)
+# 受信したメッセージ: 受信数・受信量・1秒あたりの受信数と、反映にかかった時間のヒストグラム (opごと)
+# 受信量はフレームのバイト数 (受信したときにUTF-8のまま数える)
+#
+# 環境変数COTONESTRUM_METRICSにファイル名を指定すると、COTONESTRUM_METRICS_INTERVAL秒(既定10秒)ごとに
+# snapshot()の内容をJSONで書き出す
+
+METRICS_ENV = 'COTONESTRUM_METRICS'
+METRICS_INTERVAL_ENV = 'COTONESTRUM_METRICS_INTERVAL'
+
+# ヒストグラムの区切り(ミリ秒)
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+# 受信レートを平均する時間(秒)
+RATE_WINDOW = 10.
+
+
+class Histogram():
+    """ミリ秒単位の時間のヒストグラム"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, ms: float):
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p: float) -> float:
+        """p(0-100)パーセンタイルを、区切りの上端で近似して返します"""
+        if self.count == 0:
+            return 0.
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        buckets = {}
+        for i, n in enumerate(self.counts):
+            if n > 0:
+                key = f'<={BUCKETS_MS[i]}' if i < len(BUCKETS_MS) else f'>{BUCKETS_MS[-1]}'
+                buckets[key] = n
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count if self.count > 0 else 0.,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'max_ms': self.max,
+            'buckets': buckets,
+        }
+
+class RateMeter():
+    """指数移動平均による1秒あたりの件数"""
+
+    __slots__ = ('rate', 'updated')
+
+    def __init__(self):
+        self.rate = 0.
+        self.updated = time.monotonic()
+
+    def _decay(self, now: float):
+        dt = now - self.updated
+        if dt > 0:
+            self.rate *= math.exp(-dt / RATE_WINDOW)
+            self.updated = now
+
+    def add(self, n: int = 1):
+        self._decay(time.monotonic())
+        self.rate += n / RATE_WINDOW
+
+    def value(self) -> float:
+        self._decay(time.monotonic())
+        return self.rate
+
+class RequestMetrics():
+    __slots__ = ('sent', 'completed', 'failed', 'failures', 'latency')
+
+    def __init__(self):
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        # 失敗の種類 ('denied', 'timeout' など) ごとの件数
+        self.failures: dict[str, int] = {}
+        self.latency = Histogram()
+
+class InboundMetrics():
+    __slots__ = ('received', 'bytes', 'rate', 'handler')
+
+    def __init__(self):
+        self.received = 0
+        self.bytes = 0
+        self.rate = RateMeter()
+        self.handler = Histogram()
+
+
+started_at = time.time()
+requests: dict[str, RequestMetrics] = {}
+inbound: dict[str, InboundMetrics] = {}
+inbound_total = InboundMetrics()
+
+def _request(op: str) -> RequestMetrics:
+    if op not in requests:
+        requests[op] = RequestMetrics()
+    return requests[op]
+
+def _inbound(op: str) -> InboundMetrics:
+    if op not in inbound:
+        inbound[op] = InboundMetrics()
+    return inbound[op]
+
+def request_sent(op: str):
+    _request(op).sent += 1
+
+def request_done(op: str, elapsed: float, reply: str = 'ok'):
+    """操作の応答を受け取った(または失敗した)ときに呼びます elapsedは送信からの秒数"""
+    m = _request(op)
+    m.latency.record(elapsed * 1000)
+    if reply == 'ok':
+        m.completed += 1
+    else:
+        m.failed += 1
+        m.failures[reply] = m.failures.get(reply, 0) + 1
+
+def message_handled(op: str, size: int, elapsed: float):
+    """受信したメッセージを反映したときに呼びます sizeはフレームのバイト数、elapsedは反映にかかった秒数"""
+    for m in (_inbound(op), inbound_total):
+        m.received += 1
+        m.bytes += size
+        m.rate.add()
+        m.handler.record(elapsed * 1000)
+
+def reset():
+    global started_at
+    started_at = time.time()
+    requests.clear()
+    inbound.clear()
+    inbound_total.__init__()
+
+def snapshot() -> dict:
+    return {
+        'started_at': started_at,
+        'uptime': time.time() - started_at,
+        'requests': {
+            op: {
+                'sent': m.sent,
+                'completed': m.completed,
+                'failed': m.failed,
+                'failures': dict(m.failures),
+                'latency': m.latency.as_dict(),
+            }
+            for op, m in requests.items()
+        },
+        'inbound': {
+            op: {
+                'received': m.received,
+                'bytes': m.bytes,
+                'rate': m.rate.value(),
+                'handler': m.handler.as_dict(),
+            }
+            for op, m in [*inbound.items(), ('*', inbound_total)]
+        },
+    }
+
+def dump(path: str, extra: dict | None = None):
+    data = snapshot()
+    if extra is not None:
+        data.update(extra)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+async def dump_periodically(path: str | None = None, interval: float | None = None, extra=None):
+    """snapshot()を定期的にファイルへ書き出します
+    extraを渡すと、呼び出した結果(dict)も一緒に書き出します"""
+    if path is None:
+        path = os.environ.get(METRICS_ENV)
+        if not path:
+            return
+    if interval is None:
+        interval = float(os.environ.get(METRICS_INTERVAL_ENV, '10'))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(dump, path, extra() if extra is not None else None)
+        except OSError:
+            traceback.print_exc()
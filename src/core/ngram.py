@@ -0,0 +1,76 @@
+import functools
+
+# 部分一致検索用のN-gram転置インデックス
+#
+# ASCII文字だけからなる部分は3-gram、日本語など非ASCII文字を含む部分は2-gramで索引する
+# どちらを作るかはgram自身の文字だけで決まるので、検索語が本文の部分文字列なら
+# 検索語から作ったgramは必ず本文のgramにも含まれる
+# 検索結果は候補の集合(上位集合)なので、呼び出し側で実際の条件による確認が必要
+
+@functools.lru_cache(maxsize=4096)
+def grams(text: str | None) -> frozenset[str]:
+    # カテゴリーやライセンスなど同じ文字列が何度も現れるので結果をキャッシュする
+    if not text:
+        return frozenset()
+    n = len(text)
+    if text.isascii():
+        return frozenset([text[i:i + 3] for i in range(n - 2)])
+    ret = set()
+    for i in range(n - 1):
+        if text[i] >= '\x80' or text[i + 1] >= '\x80':
+            ret.add(text[i:i + 2])
+        elif i + 2 < n and text[i + 2] < '\x80':
+            ret.add(text[i:i + 3])
+    return frozenset(ret)
+
+class NgramIndex():
+    """gram -> キーの集合 の転置インデックス"""
+
+    __slots__ = ('postings',)
+
+    def __init__(self):
+        self.postings: dict[str, set[str]] = {}
+
+    def add(self, key: str, text: str | None):
+        postings = self.postings
+        for gram in grams(text):
+            if gram in postings:
+                postings[gram].add(key)
+            else:
+                postings[gram] = {key}
+
+    def discard(self, key: str, text: str | None):
+        postings = self.postings
+        for gram in grams(text):
+            if gram in postings:
+                keys = postings[gram]
+                keys.discard(key)
+                if len(keys) == 0:
+                    del postings[gram]
+
+    def clear(self):
+        self.postings.clear()
+
+    def search(self, terms: list[str]) -> set[str] | None:
+        """すべての検索語を含む可能性があるキーの集合を返します
+        検索語が短すぎて絞り込めない場合はNone"""
+        needed = set()
+        for term in terms:
+            needed |= grams(term)
+        if len(needed) == 0:
+            return None
+
+        postings = self.postings
+        lists = []
+        for gram in needed:
+            if gram not in postings:
+                return set()
+            lists.append(postings[gram])
+        lists.sort(key=len)
+
+        ret = set(lists[0])
+        for keys in lists[1:]:
+            ret &= keys
+            if len(ret) == 0:
+                break
+        return ret
@@ -0,0 +1,144 @@
+import math
+import time
+import threading
+import traceback
+import collections
+
+# 画像の先読み
+#
+# これから表示される画像を、ワーカースレッドで先に読み込んでメモリに置いておく
+# 置いておく量はMAX_BYTESまでで、超えると最後に使ってから長いものから捨てる
+#
+# 先読みする件数と同時に読み込む数は、読み込みにかかった時間から決める
+#   件数: 読み込みが遅いほど先まで読む (ただし同時に読み込める数でHORIZON秒以内に終わる分まで)
+#   同時に読み込む数: 先読みする件数をHORIZON秒で読み終えられる数
+
+MAX_BYTES = 32 * 1024 * 1024
+MIN_WORKERS = 1
+MAX_WORKERS = 8
+MIN_DEPTH = 10
+MAX_DEPTH = 200
+# 先読みした分を読み終えたい時間(秒)
+HORIZON = 2.
+# 読み込みにかかる時間がこれくらいのとき、BASE_DEPTH件先まで読む
+BASE_LATENCY = 0.1
+BASE_DEPTH = 30
+# 読み込みにかかった時間の平均に、新しい値を混ぜる割合
+LATENCY_SMOOTHING = 0.2
+
+
+class Prefetcher():
+    """load(key)で読み込んだ値を先読みして置いておきます
+    値は (Content-Type, 内容) で、大きさは内容の長さで数えます"""
+
+    def __init__(self, load, max_bytes: int = MAX_BYTES):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.latency = BASE_LATENCY
+        self.hits = 0
+        self.loaded = 0
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        # 先に読む(カーソルの下の画像など)ものと、順に読むもの
+        self._urgent = collections.deque()
+        self._queue = collections.deque()
+        self._loading = set()
+        self._running = 0
+        self._workers = 0
+        self._cond = threading.Condition()
+
+    @property
+    def depth(self) -> int:
+        """先読みする件数"""
+        depth = BASE_DEPTH * (1 + self.latency / BASE_LATENCY) / 2
+        depth = min(depth, MAX_WORKERS * HORIZON / max(self.latency, 1e-3))
+        return int(min(MAX_DEPTH, max(MIN_DEPTH, depth)))
+
+    @property
+    def concurrency(self) -> int:
+        """同時に読み込む数"""
+        n = math.ceil(self.depth * self.latency / HORIZON)
+        return min(MAX_WORKERS, max(MIN_WORKERS, n))
+
+    def request(self, keys, urgent: bool = False):
+        """keysを先読みします
+        順に読むものは、呼ぶたびにまだ読み始めていない分を入れ替えます"""
+        with self._cond:
+            keys = [key for key in keys if key not in self._cache and key not in self._loading]
+            if urgent:
+                self._urgent.extendleft(reversed(keys))
+            else:
+                self._queue.clear()
+                self._queue.extend(keys)
+            self._start_workers()
+            self._cond.notify_all()
+
+    def get(self, key):
+        """先読みした値を返します 無ければNone"""
+        with self._cond:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'entries': len(self._cache),
+                'bytes': self.total,
+                'latency_ms': self.latency * 1000,
+                'depth': self.depth,
+                'concurrency': self.concurrency,
+                'hits': self.hits,
+                'loaded': self.loaded,
+                'queued': len(self._urgent) + len(self._queue),
+            }
+
+    def _start_workers(self):
+        while self._workers < MAX_WORKERS and self._workers < len(self._urgent) + len(self._queue):
+            self._workers += 1
+            threading.Thread(target=self._work, name=f'prefetch-{self._workers}', daemon=True).start()
+
+    def _next(self):
+        """次に読むものを返します 同時に読み込む数を超えている間は待ちます"""
+        with self._cond:
+            while True:
+                if len(self._urgent) + len(self._queue) > 0 and self._running < self.concurrency:
+                    queue = self._urgent if len(self._urgent) > 0 else self._queue
+                    key = queue.popleft()
+                    if key in self._cache or key in self._loading:
+                        continue
+                    self._loading.add(key)
+                    self._running += 1
+                    return key
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            key = self._next()
+            started = time.perf_counter()
+            value = None
+            try:
+                value = self.load(key)
+            except Exception:
+                traceback.print_exc()
+            elapsed = time.perf_counter() - started
+            with self._cond:
+                self._running -= 1
+                self._loading.discard(key)
+                self.latency += (elapsed - self.latency) * LATENCY_SMOOTHING
+                if value is not None:
+                    self._put(key, value)
+                self._cond.notify_all()
+
+    def _put(self, key, value):
+        size = len(value[1])
+        if size > self.max_bytes:
+            return
+        self.loaded += 1
+        self._cache[key] = value
+        self.total += size
+        while self.total > self.max_bytes:
+            _, old = self._cache.popitem(last=False)
+            self.total -= len(old[1])
@@ -0,0 +1,150 @@
+import os
+import os.path as osp
+import gzip
+import json
+import time
+import queue
+import asyncio
+import threading
+import traceback
+
+import websockets
+
+# 通信内容の記録と再生
+#
+# 環境変数COTONESTRUM_RECORDにファイル名を指定すると、送受信したフレームを時刻付きで記録する
+# 記録はgzipで圧縮したJSONLで、1行に {"t": 記録開始からの秒数, "dir": "in" または "out", "frame": フレーム} を書く
+# ファイル名が.gzで終わらなければ.gzを付ける
+# 時刻は接続ごとに0から数えるので、1回の接続を1つのファイルに記録する
+# 同じ名前のファイルがあれば上書きせず、名前に番号を付けたファイル(recorded-1.jsonl.gz など)に記録する
+# 書き込みは別スレッドで行うので、受信処理を待たせない
+#
+# 記録したファイルはReplaySocketで受信処理に流し込み、サーバー無しで同じ負荷を再現できる
+
+RECORD_ENV = 'COTONESTRUM_RECORD'
+REPLAY_ENV = 'COTONESTRUM_REPLAY'
+REPLAY_SPEED_ENV = 'COTONESTRUM_REPLAY_SPEED'
+
+
+class Recorder():
+    """送受信したフレームをファイルに記録します"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started = time.perf_counter()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, name='recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, direction: str, frame):
+        self._queue.put((time.perf_counter() - self.started, direction, frame))
+
+    def close(self):
+        """溜まっている分を書き終えるまで待ちます"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        try:
+            with gzip.open(self.path, 'xt', encoding='utf-8') as f:
+                while True:
+                    item = self._queue.get()
+                    if item is None:
+                        break
+                    t, direction, frame = item
+                    if isinstance(frame, bytes):
+                        frame = frame.decode('utf-8', errors='replace')
+                    f.write(json.dumps({'t': round(t, 6), 'dir': direction, 'frame': frame}, ensure_ascii=False))
+                    f.write('\n')
+        except OSError:
+            traceback.print_exc()
+            print('recording could not written')
+
+
+_recorder: Recorder | None = None
+
+def start_recording(path: str | None = None):
+    """記録を始めます pathを省略すると環境変数COTONESTRUM_RECORDのファイルに記録します"""
+    global _recorder
+    if _recorder is not None:
+        return
+    if path is None:
+        path = os.environ.get(RECORD_ENV)
+        if not path:
+            return
+    path = _session_path(path)
+    _recorder = Recorder(path)
+    print(f'recording websocket frames to {path}')
+
+async def stop_recording():
+    """記録を終えます 書き終えるのは別スレッドで待つので、イベントループを止めません"""
+    global _recorder
+    if _recorder is None:
+        return
+    recorder = _recorder
+    _recorder = None
+    await asyncio.to_thread(recorder.close)
+
+def _session_path(path: str) -> str:
+    """この接続を記録するファイル名を返します 既にあるファイルは使いません"""
+    if not path.endswith('.gz'):
+        path += '.gz'
+    root, ext = osp.splitext(path[:-len('.gz')])
+    n = 0
+    while osp.exists(path):
+        n += 1
+        path = f'{root}-{n}{ext}.gz'
+    return path
+
+def record(direction: str, frame):
+    if _recorder is not None:
+        _recorder.record(direction, frame)
+
+
+def load_recording(path: str) -> list[tuple[float, str, str]]:
+    """記録を (秒数, 向き, フレーム) のリストとして読み込みます"""
+    opener = gzip.open if path.endswith('.gz') else open
+    ret = []
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            item = json.loads(line)
+            ret.append((item['t'], item['dir'], item['frame']))
+    return ret
+
+class ReplaySocket():
+    """記録した受信フレームを順に返す、websocketの代わり
+    speedが1なら記録した時と同じ間隔で、2なら倍の速さで返す Noneなら待たずに返す
+    送信されたフレームはsentに溜めるだけで、どこにも送らない"""
+
+    def __init__(self, recording: list[tuple[float, str, str]], speed: float | None = 1.):
+        self.frames = [(t, frame) for t, direction, frame in recording if direction == 'in']
+        self.speed = speed
+        self.sent = []
+        self._index = 0
+        self._started = None
+
+    async def recv(self, decode: bool | None = None):
+        if self._index >= len(self.frames):
+            raise websockets.ConnectionClosed(None, None)
+        t, frame = self.frames[self._index]
+        self._index += 1
+        if self.speed is not None and self.speed > 0:
+            now = time.perf_counter()
+            if self._started is None:
+                self._started = now - t / self.speed
+            delay = self._started + t / self.speed - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # 他の処理が進められるように、1フレームごとにイベントループへ処理を返す
+            await asyncio.sleep(0)
+        # websocketと同じく、decode=FalseならUTF-8のbytesで返す
+        return frame.encode('utf-8') if decode is False else frame
+
+    async def send(self, msg):
+        self.sent.append(msg)
+
+    async def close(self):
+        self._index = len(self.frames)
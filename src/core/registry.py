@@ -1,3 +1,10 @@
+import sys
+import asyncio
+import traceback
+
+from core import aggregates
+from core.changes import ChangeSet
+from core.ngram import NgramIndex
 from core.datatypes import EmojiData, DeletedEmojiData, UserData, RiskData, ReasonData
 
 emojis: dict[str, EmojiData] = {}
@@ -6,8 +13,173 @@ users: dict[str, UserData] = {}
 risks: dict[str, RiskData] = {}
 reasons: dict[str, ReasonData] = {}
 
+# 逆引き用のインデックス (put/popのたびに更新される)
+emojis_by_risk: dict[str, set[str]] = {}
+emojis_by_owner: dict[str | None, set[str]] = {}
+deleted_by_risk: dict[str, set[str]] = {}
+deleted_by_owner: dict[str | None, set[str]] = {}
+risks_by_reason: dict[str | None, set[str]] = {}
+
+# 部分一致検索用のインデックス (put/popのたびに更新される)
+EMOJI_TEXT_FIELDS = ('name', 'category', 'tags', 'license')
+emoji_texts: dict[str, NgramIndex] = {field: NgramIndex() for field in EMOJI_TEXT_FIELDS}
+deleted_texts: dict[str, NgramIndex] = {field: NgramIndex() for field in EMOJI_TEXT_FIELDS}
+username_index = NgramIndex()
+remark_index = NgramIndex()
+
+# 変更通知
+# 変更はFLUSH_INTERVAL秒の間まとめられ、購読者には1回だけ通知される
+FLUSH_INTERVAL = 0.05
+
+_subscribers = []
+_changes = ChangeSet()
+_flush_handle = None
+
+# まだ届いていないユーザー・リスクを待っているコールバック
+# 変更通知のときに、届いたIDの分だけ1回呼ばれて取り除かれる
+_user_waiters: dict[str, set] = {}
+_risk_waiters: dict[str, set] = {}
+
+def subscribe(callback):
+    """変更通知を購読します callbackはChangeSetを1つ受け取ります"""
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+def flush_changes():
+    """溜まっている変更を購読者に通知します"""
+    global _changes, _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if _changes.is_empty():
+        return
+    changes = _changes
+    _changes = ChangeSet()
+    _resolve_waiters(_user_waiters, changes.users, users)
+    _resolve_waiters(_risk_waiters, changes.risks, risks)
+    for callback in list(_subscribers):
+        try:
+            callback(changes)
+        except Exception:
+            traceback.print_exc()
+
+def _resolve_waiters(waiters, entity_changes, records):
+    if len(waiters) == 0:
+        return
+    for key in entity_changes.changed():
+        if key in waiters and key in records:
+            for callback in waiters.pop(key):
+                try:
+                    callback(records[key])
+                except Exception:
+                    traceback.print_exc()
+
+def _wait(waiters, key, callback):
+    if key in waiters:
+        waiters[key].add(callback)
+    else:
+        waiters[key] = {callback}
+
+def _cancel_wait(waiters, key, callback):
+    if key in waiters:
+        callbacks = waiters[key]
+        callbacks.discard(callback)
+        if len(callbacks) == 0:
+            del waiters[key]
+
+def wait_user(uid, callback):
+    """ユーザーが届いたときにcallback(UserData)を1回だけ呼びます
+    既に存在するかどうかは呼び出し側で確認してください"""
+    _wait(_user_waiters, uid, callback)
+
+def cancel_wait_user(uid, callback):
+    _cancel_wait(_user_waiters, uid, callback)
+
+def wait_risk(rid, callback):
+    """リスクが届いたときにcallback(RiskData)を1回だけ呼びます
+    既に存在するかどうかは呼び出し側で確認してください"""
+    _wait(_risk_waiters, rid, callback)
+
+def cancel_wait_risk(rid, callback):
+    _cancel_wait(_risk_waiters, rid, callback)
+
+def _schedule_flush():
+    global _flush_handle
+    if _flush_handle is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # イベントループ外での変更は、呼び出し側がflush_changesを呼ぶまで溜めておく
+        return
+    _flush_handle = loop.call_later(FLUSH_INTERVAL, flush_changes)
+
+# IDやカテゴリーなど、多くのレコードで同じ値が繰り返される文字列はinternして共有する
+def _intern(s):
+    if type(s) is str:
+        return sys.intern(s)
+    return s
+
+def _intern_list(ls):
+    if type(ls) is list:
+        return [_intern(s) for s in ls]
+    return ls
+
+def _index_add(index, key, value):
+    if key in index:
+        index[key].add(value)
+    else:
+        index[key] = {value}
+
+def _index_discard(index, key, value):
+    if key in index:
+        values = index[key]
+        values.discard(value)
+        if len(values) == 0:
+            del index[key]
+
+def _index_get(index, key) -> set:
+    if key in index:
+        return set(index[key])
+    else:
+        return set()
+
+def _emoji_text(emoji, field) -> str | None:
+    if field == 'tags':
+        return ' '.join(emoji.tags) if emoji.tags is not None else None
+    return getattr(emoji, field)
+
+def _texts_add(texts, emoji):
+    for field, index in texts.items():
+        index.add(emoji.id, _emoji_text(emoji, field))
+
+def _texts_discard(texts, emoji):
+    for field, index in texts.items():
+        index.discard(emoji.id, _emoji_text(emoji, field))
+
 def put_emoji(eid, misskey_id, name, category, tags, url, is_self_made, license, owner_id, risk_id, created_at, updated_at):
-    emojis[eid] = EmojiData(eid, misskey_id, name, category, tags, url, is_self_made, license, owner_id, risk_id, created_at, updated_at)
+    eid = _intern(eid)
+    old = emojis.get(eid)
+    if old is not None:
+        _index_discard(emojis_by_risk, old.risk_id, eid)
+        _index_discard(emojis_by_owner, old.owner_id, eid)
+        _texts_discard(emoji_texts, old)
+        aggregates.apply_emoji(old.owner_id, risks.get(old.risk_id), -1)
+    emoji = EmojiData(eid, misskey_id, name, _intern(category), _intern_list(tags), url, is_self_made, _intern(license), _intern(owner_id), _intern(risk_id), created_at, updated_at)
+    emojis[eid] = emoji
+    _index_add(emojis_by_risk, emoji.risk_id, eid)
+    _index_add(emojis_by_owner, emoji.owner_id, eid)
+    _texts_add(emoji_texts, emoji)
+    aggregates.apply_emoji(emoji.owner_id, risks.get(emoji.risk_id), 1)
+    if old is None:
+        _changes.emojis.add(eid)
+    else:
+        _changes.emojis.update(eid)
+    _schedule_flush()
 
 def get_emoji(eid):
     if eid in emojis:
@@ -17,12 +189,49 @@ def get_emoji(eid):
 
 def pop_emoji(eid):
     if eid in emojis:
-        return emojis.pop(eid)
+        emoji = emojis.pop(eid)
+        _index_discard(emojis_by_risk, emoji.risk_id, emoji.id)
+        _index_discard(emojis_by_owner, emoji.owner_id, emoji.id)
+        _texts_discard(emoji_texts, emoji)
+        aggregates.apply_emoji(emoji.owner_id, risks.get(emoji.risk_id), -1)
+        _changes.emojis.remove(emoji.id)
+        _schedule_flush()
+        return emoji
     else:
         return None
 
+def get_emojis_by_risk(rid) -> set[str]:
+    return _index_get(emojis_by_risk, rid)
+
+def get_emojis_by_owner(uid) -> set[str]:
+    return _index_get(emojis_by_owner, uid)
+
 def put_deleted_emoji(eid, misskey_id, name, category, tags, url, image_backup, is_self_made, license, owner_id, risk_id, info, deleted_at):
-    deleted[eid] = DeletedEmojiData(eid, misskey_id, name, category, tags, url, image_backup, is_self_made, license, owner_id, risk_id, info, deleted_at)
+    eid = _intern(eid)
+    old = deleted.get(eid)
+    if old is not None:
+        _index_discard(deleted_by_risk, old.risk_id, eid)
+        _index_discard(deleted_by_owner, old.owner_id, eid)
+        _texts_discard(deleted_texts, old)
+    emoji = DeletedEmojiData(eid, misskey_id, name, _intern(category), _intern_list(tags), url, image_backup, is_self_made, _intern(license), _intern(owner_id), _intern(risk_id), info, deleted_at)
+    deleted[eid] = emoji
+    _index_add(deleted_by_risk, emoji.risk_id, eid)
+    _index_add(deleted_by_owner, emoji.owner_id, eid)
+    _texts_add(deleted_texts, emoji)
+    if old is None:
+        _changes.deleted.add(eid)
+    else:
+        _changes.deleted.update(eid)
+    _schedule_flush()
+
+def set_deleted_image_backup(eid, image_backup):
+    """削除された絵文字のバックアップ画像のキーだけを差し替えます"""
+    old = deleted.get(eid)
+    if old is None or old.image_backup == image_backup:
+        return
+    deleted[eid] = DeletedEmojiData(old.id, old.misskey_id, old.name, old.category, old.tags, old.url, image_backup, old.is_self_made, old.license, old.owner_id, old.risk_id, old.info, old.deleted_at)
+    _changes.deleted.update(eid)
+    _schedule_flush()
 
 def get_deleted_emoji(eid):
     if eid in deleted:
@@ -32,12 +241,33 @@ def get_deleted_emoji(eid):
 
 def pop_deleted_emoji(eid):
     if eid in deleted:
-        return deleted.pop(eid)
+        emoji = deleted.pop(eid)
+        _index_discard(deleted_by_risk, emoji.risk_id, emoji.id)
+        _index_discard(deleted_by_owner, emoji.owner_id, emoji.id)
+        _texts_discard(deleted_texts, emoji)
+        _changes.deleted.remove(emoji.id)
+        _schedule_flush()
+        return emoji
     else:
         return None
 
+def get_deleted_by_risk(rid) -> set[str]:
+    return _index_get(deleted_by_risk, rid)
+
+def get_deleted_by_owner(uid) -> set[str]:
+    return _index_get(deleted_by_owner, uid)
+
 def put_user(uid, misskey_id, username):
+    uid = _intern(uid)
+    old = users.get(uid)
+    if old is not None:
+        username_index.discard(uid, old.username)
+        _changes.users.update(uid)
+    else:
+        _changes.users.add(uid)
     users[uid] = UserData(uid, misskey_id, username)
+    username_index.add(uid, username)
+    _schedule_flush()
 
 def get_user(uid):
     if uid in users:
@@ -46,7 +276,31 @@ def get_user(uid):
         return None
 
 def put_risk(rid, checked, level, reason_genre, remark, created_at, updated_at):
-    risks[rid] = RiskData(rid, checked, level, reason_genre, remark, created_at, updated_at)
+    rid = _intern(rid)
+    risk = RiskData(rid, checked, level, _intern(reason_genre), remark, created_at, updated_at)
+    if rid in _risk_pending:
+        # 送信中の変更があれば、届いた値を確定した値として、その上に送信中の変更を重ねて表示する
+        _risk_confirmed[rid] = risk
+        risk = _overlay_risk(risk, _risk_pending[rid].values())
+    _replace_risk(risk)
+
+def _replace_risk(risk: RiskData):
+    rid = risk.id
+    old = risks.get(rid)
+    if old is not None:
+        _index_discard(risks_by_reason, old.reason_genre, rid)
+        remark_index.discard(rid, old.remark)
+    risks[rid] = risk
+    _index_add(risks_by_reason, risk.reason_genre, rid)
+    remark_index.add(rid, risk.remark)
+    n = len(emojis_by_risk[rid]) if rid in emojis_by_risk else 0
+    aggregates.apply_risk(old, -n)
+    aggregates.apply_risk(risk, n)
+    if old is None:
+        _changes.risks.add(rid)
+    else:
+        _changes.risks.update(rid)
+    _schedule_flush()
 
 def get_risk(rid):
     if rid in risks:
@@ -54,12 +308,92 @@ def get_risk(rid):
     else:
         return None
 
+def get_risks_by_reason(rsid) -> set[str]:
+    return _index_get(risks_by_reason, rsid)
+
+# 送信中のリスクの変更 (応答を待たずに表示へ反映する)
+# risksには送信中の変更を反映した値が入り、サーバーが確定した値は_risk_confirmedに残しておく
+# 変更はchange_risk_localが返す番号で区別し、応答がokならconfirm_risk_change、
+# 拒否されたらrollback_risk_changeで取り消す
+_risk_confirmed: dict[str, RiskData] = {}
+_risk_pending: dict[str, dict[int, dict]] = {}
+_risk_change_serial = 0
+
+def _overlay_risk(risk: RiskData, changes) -> RiskData:
+    """riskにchanges(wsmsg.build_risk_propsの形式)を順に重ねた値を返します"""
+    checked, level, reason_genre, remark = risk.checked, risk.level, risk.reason_genre, risk.remark
+    for props in changes:
+        checked = props.get('checked', checked)
+        level = props.get('level', level)
+        reason_genre = _intern(props.get('reason_id', reason_genre))
+        remark = props.get('remark', remark)
+    return RiskData(risk.id, checked, level, reason_genre, remark, risk.created_at, risk.updated_at)
+
+def change_risk_local(rid, props: dict) -> int | None:
+    """リスクの変更を送信中として、すぐにrisksへ反映します
+    変更の番号を返します リスクが無ければ何もせずNoneを返します"""
+    global _risk_change_serial
+    if rid not in risks or len(props) == 0:
+        return None
+    rid = risks[rid].id
+    if rid not in _risk_pending:
+        _risk_confirmed[rid] = risks[rid]
+        _risk_pending[rid] = {}
+    _risk_change_serial += 1
+    _risk_pending[rid][_risk_change_serial] = props
+    _replace_risk(_overlay_risk(risks[rid], [props]))
+    return _risk_change_serial
+
+def _end_risk_change(rid, serial, accepted: bool):
+    if rid not in _risk_pending or serial not in _risk_pending[rid]:
+        return
+    changes = _risk_pending[rid]
+    props = changes.pop(serial)
+    confirmed = _risk_confirmed[rid]
+    if accepted:
+        # 変更を知らせる通知がまだ届いていなくても表示が戻らないよう、確定した値に重ねておく
+        confirmed = _overlay_risk(confirmed, [props])
+    if len(changes) == 0:
+        del _risk_pending[rid]
+        del _risk_confirmed[rid]
+        _replace_risk(confirmed)
+    else:
+        _risk_confirmed[rid] = confirmed
+        _replace_risk(_overlay_risk(confirmed, changes.values()))
+
+def confirm_risk_change(rid, serial):
+    """送信中の変更が受け入れられたときに呼びます"""
+    _end_risk_change(rid, serial, True)
+
+def rollback_risk_change(rid, serial):
+    """送信中の変更が拒否されたときに呼びます 表示は確定した値と残りの送信中の変更に戻ります"""
+    _end_risk_change(rid, serial, False)
+
+def get_confirmed_risk(rid):
+    """サーバーが確定したリスクの値を返します 送信中の変更があっても、それを含まない値を返します"""
+    if rid in _risk_confirmed:
+        return _risk_confirmed[rid]
+    return get_risk(rid)
+
+def is_risk_pending(rid) -> bool:
+    """応答を待っている変更があるかどうかを返します"""
+    return rid in _risk_pending
+
 def put_reason(rsid, text, created_at, updated_at):
+    rsid = _intern(rsid)
+    if rsid in reasons:
+        _changes.reasons.update(rsid)
+    else:
+        _changes.reasons.add(rsid)
     reasons[rsid] = ReasonData(rsid, text, created_at, updated_at)
+    _schedule_flush()
 
 def pop_reason(rsid):
     if rsid in reasons:
-        return reasons.pop(rsid)
+        reason = reasons.pop(rsid)
+        _changes.reasons.remove(reason.id)
+        _schedule_flush()
+        return reason
     else:
         return None
 
@@ -68,3 +402,46 @@ def get_reason(rsid):
         return reasons[rsid]
     else:
         return None
+
+
+def _sizeof(obj, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        for i in obj:
+            size += _sizeof(i, seen)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, seen)
+        for v in obj.__dict__.values():
+            size += _sizeof(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += _sizeof(getattr(obj, name, None), seen)
+    return size
+
+def measure_records(records) -> dict:
+    """レコード群が保持しているメモリ量を計測します
+    共有されている(internされた)文字列は一度だけ数えます"""
+    seen = set()
+    count = 0
+    nbytes = 0
+    for record in records:
+        count += 1
+        nbytes += _sizeof(record, seen)
+    return {
+        'count': count,
+        'bytes': nbytes,
+        'bytes_per_record': nbytes / count if count > 0 else 0,
+    }
+
+def memory_report() -> dict[str, dict]:
+    """レジストリの種類ごとのメモリ使用量を返します"""
+    return {
+        'emojis': measure_records(emojis.values()),
+        'deleted': measure_records(deleted.values()),
+        'users': measure_records(users.values()),
+        'risks': measure_records(risks.values()),
+        'reasons': measure_records(reasons.values()),
+    }
@@ -0,0 +1,82 @@
+class Selection():
+    """一覧(universe)のうち選択されているIDの集合
+
+    選択されているIDか、選択されていないIDのどちらか少ない方だけを持つ
+    全選択と反転は持つ側を切り替えるだけなので、一覧の件数によらずすぐに終わる
+    universeには一覧の並びを保ったdict(値はNone)を渡す 一覧から外れたIDはforgetで取り除く"""
+
+    __slots__ = ('universe', '_ids', '_inverted')
+
+    def __init__(self, universe: dict | None = None):
+        self.universe = universe if universe is not None else {}
+        # _invertedがFalseなら選択されているID、Trueなら選択されていないID
+        self._ids: set[str] = set()
+        self._inverted = False
+
+    def __contains__(self, eid) -> bool:
+        return eid in self.universe and (eid in self._ids) != self._inverted
+
+    def __len__(self) -> int:
+        if self._inverted:
+            return len(self.universe) - len(self._ids)
+        return len(self._ids)
+
+    def __iter__(self):
+        if self._inverted:
+            return (eid for eid in self.universe if eid not in self._ids)
+        return iter(list(self._ids))
+
+    @property
+    def is_all(self) -> bool:
+        return self._inverted and len(self._ids) == 0
+
+    def reset(self, universe: dict | None = None):
+        """選択を解除します universeを渡すと対象の一覧も入れ替えます"""
+        if universe is not None:
+            self.universe = universe
+        self.clear()
+
+    def clear(self):
+        self._ids = set()
+        self._inverted = False
+
+    def select_all(self):
+        self._ids = set()
+        self._inverted = True
+
+    def invert(self):
+        self._inverted = not self._inverted
+
+    def add(self, eid):
+        if self._inverted:
+            self._ids.discard(eid)
+        elif eid in self.universe:
+            self._ids.add(eid)
+
+    def discard(self, eid):
+        if self._inverted:
+            if eid in self.universe:
+                self._ids.add(eid)
+        else:
+            self._ids.discard(eid)
+
+    def update(self, eids):
+        for eid in eids:
+            self.add(eid)
+
+    def forget(self, eids) -> bool:
+        """一覧から外れたIDを取り除きます 選択されていたものがあればTrueを返します"""
+        changed = False
+        for eid in eids:
+            if eid in self._ids:
+                self._ids.discard(eid)
+                changed = changed or not self._inverted
+            elif self._inverted:
+                changed = True
+        return changed
+
+    def ordered(self) -> list[str]:
+        """選択されているIDを一覧の並びで返します"""
+        if not self._inverted and len(self._ids) == 0:
+            return []
+        return [eid for eid in self.universe if (eid in self._ids) != self._inverted]
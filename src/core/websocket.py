@@ -1,320 +1,859 @@
+import gc
+import re
+import random
+import time
 import traceback
 
 import json
 
 import asyncio
+import collections
 import websockets
 import websockets.exceptions
 
 from app.panels.dashboard import PanelDashboard
 from core import wsmsg
 from core import registry
-from app.views import Views
+from core import cache
+from core import codec
+from core import recording
+from core import metrics
+from core import blobstore
+from core.codec import Message
 
 ws = None
 task = None
+
+# 接続が切れたときの再接続
+# 待ち時間はRECONNECT_BASE_DELAY秒から倍々に増え(最大RECONNECT_MAX_DELAY秒)、ばらつきを持たせる
+RECONNECT_BASE_DELAY = 1.
+RECONNECT_MAX_DELAY = 60.
+# 再接続を待っている間に行われた変更は、つながった後に送る
+MAX_OUTBOX = 10000
+
+reconnecting = False
+_uri: str | None = None
+_token: str | None = None
+_closing = False
+_outbox: collections.deque = collections.deque(maxlen=MAX_OUTBOX)
+# reqid -> 応答を待っている操作
 pending = {}
+# create_send_taskで送信を始め、まだ書き出していない操作
+_sending = set()
+# reqid -> 応答が無く失敗として扱った操作
+_expired: collections.OrderedDict = collections.OrderedDict()
+
+# 応答を待つ時間(秒) これを過ぎた操作は失敗として扱う
+REQUEST_TIMEOUT = 30.
+# 全件取得はデータが多いと応答までに時間がかかるので、長く待つ
+FETCH_TIMEOUT = 600.
+# 応答が無く失敗として扱った操作のうち、最近のものは遅れて届いた応答のために覚えておく
+MAX_EXPIRED = 1024
+# 同時に応答を待てる操作の数
+MAX_PENDING = 1024
+
+_pending_freed = asyncio.Event()
+# 認証が済み、操作を送れる状態 (切断されると解除される)
+ready = asyncio.Event()
+
+
+class RequestError(Exception):
+    """操作が失敗したときの例外
+    reply: サーバーの応答の種類 ('denied', 'internal_error' など)
+           応答が無かった場合は 'timeout'、接続が切れた場合は 'closed'、あふれた場合は 'overflow'"""
+
+    def __init__(self, op: str, reply: str, message: str | None = None, body: dict | None = None):
+        super().__init__(f'{op}: {reply}' + (f' ({message})' if message else ''))
+        self.op = op
+        self.reply = reply
+        self.message = message
+        self.body = body
 
 async def connect(server_host, page):
-    global ws, task
-    if ws is not None:
+    global ws, task, bulk_supported, reconnecting, _uri, _closing
+    if ws is not None or reconnecting:
         return
     page.data['settings'].set_connect_state(1)
     if ':' not in server_host:
         server_host += ':3005'
+    # 接続する前に、前回受信したデータで画面を埋めておく
+    # (差分取得で届いた新しいデータを、古いキャッシュで上書きしないよう読み込み終えてから接続する)
+    await cache.open_server(server_host)
     try:
         uri = f'ws://{server_host}/'
         ws = await websockets.connect(uri, max_size=None)
+        bulk_supported = None
     except (OSError, TimeoutError, websockets.exceptions.InvalidURI, websockets.exceptions.InvalidHandshake):
         traceback.print_exc()
         print('websocket connection could not opened')
         page.data['settings'].set_connect_state(0)
     else:
-        task = page.run_task(reception, ws, page)
+        _uri = uri
+        _closing = False
+        reconnecting = False
+        _outbox.clear()
+        recording.start_recording()
+        task = page.run_task(supervise, page)
         print('websocket connection opened')
         page.data['settings'].set_connect_state(2)
 
 async def disconnect(page):
-    global ws, task
-    if ws is None:
+    global ws, task, reconnecting, _closing
+    if task is None:
         return
-    await ws.close()
+    _closing = True
+    ready.clear()
+    # まとめている途中の変更を送ってから切断する
+    _flush_risk_changes()
+    await _drain_sends()
+    if ws is not None:
+        await ws.close()
     task.cancel()
     print('websocket connection closed')
     ws = None
+    task = None
+    reconnecting = False
+    _discard_outbox(page)
+    await recording.stop_recording()
     page.data['settings'].set_connect_state(0)
 
-def create_send_task(op, page, callback = None, error_callback = None):
+async def supervise(page):
+    """接続を見張り、切れた場合は再接続します
+    再接続できたら保存されているトークンで認証し直し、切れている間の差分だけを取得します
+    新しい接続は認証し直すまで公開せず、それまでに行われた変更は溜めておきます"""
+    global ws, reconnecting, bulk_supported
+    receiving = asyncio.create_task(reception(ws, page))
+    while True:
+        await receiving
+        ws = None
+        ready.clear()
+        if _closing:
+            break
+        reconnecting = True
+        print('websocket connection lost')
+        page.data['settings'].set_connect_state(1)
+
+        attempt = 0
+        while True:
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.))
+            attempt += 1
+            try:
+                sock = await websockets.connect(_uri, max_size=None)
+            except (OSError, TimeoutError, websockets.exceptions.InvalidHandshake):
+                print(f'websocket connection could not reopened (attempt {attempt})')
+                continue
+            receiving = asyncio.create_task(reception(sock, page))
+            if _token is None:
+                reply = None
+                break
+            try:
+                reply = await _reauth(sock, page)
+            except asyncio.CancelledError:
+                await sock.close()
+                raise
+            if reply is None or reply == 'denied':
+                break
+            # 応答が無い、または途中で切れた場合は、つなぎ直して認証し直す
+            print(f'websocket re-authentication failed: {reply} (attempt {attempt})')
+            await sock.close()
+            await receiving
+        ws = sock
+        reconnecting = False
+        bulk_supported = None
+        print('websocket connection reopened')
+        page.data['settings'].set_connect_state(2)
+        if reply is None:
+            if _token is not None:
+                _replay_outbox(page)
+                ready.set()
+                _fetch_updates(page)
+        else:
+            # トークンが使えなくなった 溜めておいた変更は捨てずに、認証し直したときに送る
+            page.data['settings'].set_auth_state(0)
+            page.data['logs'].write_log(
+                '再接続後の認証に失敗しました',
+                f'送信待ちの操作: {len(_outbox)}件\n追記: 認証し直すと、溜めておいた操作を送信します。',
+                {'op': reply, 'reqid': None, 'body': {'op': 'auth'}},
+                True
+            )
+
+async def _reauth(sock, page) -> str | None:
+    """公開する前の新しい接続で、保存されているトークンを使って認証し直します
+    成功したらNone、失敗したらサーバーの応答の種類 ('denied', 'timeout' など) を返します"""
+    op = wsmsg.Auth(_token)
+    future = asyncio.get_running_loop().create_future()
+    msg = op.build()
+    _register(op, page, REQUEST_TIMEOUT, {'msg': msg, 'future': future})
+    try:
+        recording.record('out', msg)
+        await sock.send(msg)
+        body = await future
+    except websockets.ConnectionClosed:
+        _pop_pending(op.reqid)
+        return 'closed'
+    except RequestError as e:
+        return e.reply
+    if not _on_auth(body, page):
+        return 'denied'
+    return None
+
+async def replay(path: str, page, speed: float | None = 1.):
+    """記録した通信を受信処理に流し込みます サーバーには接続しません
+    speedがNoneか0なら記録した時の間隔を無視して、できるだけ速く流し込みます"""
+    global ws
+    if ws is not None or reconnecting:
+        return
+    frames = await asyncio.to_thread(recording.load_recording, path)
+    print(f'replaying {path} ({len(frames)} frames)')
+    ws = recording.ReplaySocket(frames, speed)
+    page.data['settings'].set_connect_state(2)
+    started = time.perf_counter()
+    try:
+        await reception(ws, page)
+    finally:
+        ws = None
+        page.data['settings'].set_connect_state(0)
+    print(f'replay finished in {time.perf_counter() - started:.2f} s')
+
+def _send(op, page, callback = None, error_callback = None):
+    """変更の操作を送信します
+    再接続を待っている間(と、再接続後の認証に失敗して溜めた操作が残っている間)は溜めておき、認証し直した後に送ります
+    接続されていなければerror_callbackを 'closed' で呼びます"""
+    if ws is not None and (ready.is_set() or len(_outbox) == 0):
+        create_send_task(op, page, callback, error_callback)
+    elif reconnecting or len(_outbox) > 0:
+        if len(_outbox) == _outbox.maxlen:
+            # あふれて捨てられる一番古い操作は失敗として扱う
+            dropped, _, dropped_error = _outbox[0]
+            if dropped_error is not None:
+                dropped_error({'op': dropped.op, 'message': '送信待ちの操作が多すぎます。'}, 'overflow', page)
+        _outbox.append((op, callback, error_callback))
+    elif error_callback is not None:
+        error_callback({'op': op.op, 'message': '接続されていません。'}, 'closed', page)
+
+def _discard_outbox(page):
+    """送らずに捨てる操作を失敗として扱います"""
+    ops = list(_outbox)
+    _outbox.clear()
+    for op, _, error_callback in ops:
+        if error_callback is not None:
+            try:
+                error_callback({'op': op.op, 'message': '接続が切れました。'}, 'closed', page)
+            except Exception:
+                traceback.print_exc()
+
+def _replay_outbox(page):
+    ops = list(_outbox)
+    _outbox.clear()
+    if len(ops) > 0:
+        print(f'replaying {len(ops)} operations')
+    for op, callback, error_callback in ops:
+        create_send_task(op, page, callback, error_callback)
+
+def _register(op, page, timeout, operation: dict):
+    if len(pending) >= MAX_PENDING:
+        # 一番古い操作をあきらめて場所を空ける
+        _fail_pending(next(iter(pending)), 'overflow', '応答待ちの操作が多すぎます。')
+    loop = asyncio.get_running_loop()
+    operation['op'] = op.op
+    operation['page'] = page
+    operation['sent_at'] = time.perf_counter()
+    operation['timer'] = loop.call_later(timeout, _fail_pending, op.reqid, 'timeout', '応答がありませんでした。')
+    pending[op.reqid] = operation
+    metrics.request_sent(op.op)
+
+def _pop_pending(reqid):
+    operation = pending.pop(reqid, None)
+    if operation is not None:
+        operation['timer'].cancel()
+        _pending_freed.set()
+    return operation
+
+def _fail_pending(reqid, reply: str, message: str):
+    """応答を待たずに操作を失敗させます"""
+    operation = _pop_pending(reqid)
+    if operation is None:
+        return
+    metrics.request_done(operation['op'], time.perf_counter() - operation['sent_at'], reply)
+    if reply == 'timeout':
+        _expired[reqid] = operation
+        if len(_expired) > MAX_EXPIRED:
+            _expired.popitem(last=False)
+    body = {'op': operation['op'], 'message': message}
+    if 'future' in operation:
+        future: asyncio.Future = operation['future']
+        if not future.done():
+            future.set_exception(RequestError(operation['op'], reply, message, body))
+        return
+    page = operation['page']
+    try:
+        log_subject = '操作は失敗しました'
+        log_text = f"操作: {operation['op']}\n追記: {message}"
+        if 'error' in operation:
+            ret = operation['error'](body, reply, page)
+            if ret is not None:
+                log_subject, log_text = ret
+        page.data['logs'].write_log(log_subject, log_text, {'op': reply, 'reqid': reqid, 'body': body}, True)
+    except Exception:
+        traceback.print_exc()
+
+def _fail_all_pending(reply: str, message: str):
+    for reqid in list(pending):
+        _fail_pending(reqid, reply, message)
+
+def create_send_task(op, page, callback = None, error_callback = None, timeout: float = REQUEST_TIMEOUT):
+    """操作を送信し、応答をcallback(またはerror_callback)で受け取ります
+    timeout秒以内に応答が無ければerror_callbackが 'timeout' で呼ばれます
+    画面のイベントを処理するスレッドからも呼べます (送信はイベントループで行います)"""
+    future = page.run_task(_send_operation, op, page, callback, error_callback, timeout)
+    _sending.add(future)
+    future.add_done_callback(_sending.discard)
+
+async def _send_operation(op, page, callback, error_callback, timeout):
     msg = op.build()
     operation = {'msg': msg}
     if callback is not None:
         operation['callback'] = callback
     if error_callback is not None:
         operation['error'] = error_callback
-    pending[op.reqid] = operation
-    page.run_task(ws.send, msg)
+    _register(op, page, timeout, operation)
+    if ws is None:
+        _fail_pending(op.reqid, 'closed', '接続されていません。')
+        return
+    recording.record('out', msg)
+    try:
+        await ws.send(msg)
+    except websockets.ConnectionClosed:
+        _fail_pending(op.reqid, 'closed', '接続が切れました。')
+
+async def _drain_sends():
+    """送信を始めた操作が書き出されるまで待ちます"""
+    if len(_sending) > 0:
+        await asyncio.gather(*[asyncio.wrap_future(f) for f in list(_sending)], return_exceptions=True)
+
+async def request(op, page, timeout: float = REQUEST_TIMEOUT) -> dict:
+    """操作を送信し、応答の本文を返します
+    失敗した場合はRequestErrorを送出します
+    応答待ちの操作がMAX_PENDING件ある間は、空きができるまで送信を待ちます"""
+    while len(pending) >= MAX_PENDING:
+        _pending_freed.clear()
+        await _pending_freed.wait()
+    if ws is None:
+        raise RequestError(op.op, 'closed', '接続されていません。')
+
+    future = asyncio.get_running_loop().create_future()
+    msg = op.build()
+    _register(op, page, timeout, {'msg': msg, 'future': future})
+    try:
+        recording.record('out', msg)
+        await ws.send(msg)
+        return await future
+    except websockets.ConnectionClosed as e:
+        raise RequestError(op.op, 'closed', '接続が切れました。') from e
+    finally:
+        # キャンセルされた場合も含め、待ち状態を残さない
+        if op.reqid in pending:
+            _pop_pending(op.reqid)
+
+# 受信処理は3段に分かれている
+#   reader:  フレームを受け取ってframesキューに積むだけ (キューが埋まると受信を待たせる)
+#   decoder: JSONを解析してmessagesキューに積む 大きなフレームは少しずつ解析する
+#   applier: registryへの反映と画面の更新を行う 1回に使う時間をAPPLY_BUDGET秒までに抑え、
+#            超えたらイベントループに処理を返す
+# 画面への反映はregistryの変更通知でまとめて行われる
+FRAME_QUEUE_SIZE = 256
+MESSAGE_QUEUE_SIZE = 64
+# この大きさ(バイト数)以上のフレームは少しずつ解析する
+LARGE_FRAME_SIZE = 64 * 1024
+# 大きなフレームの配列は、この文字数ほどずつ区切ってまとめて解析する
+DECODE_CHUNK_SIZE = 256 * 1024
+# 区切りの候補が要素の途中だった場合に、次の候補を試す回数
+DECODE_MAX_RETRIES = 8
+APPLY_BUDGET = 0.016
+# 時間を確認する間隔(件数)
+APPLY_CHECK_EVERY = 64
+
+class StageStats():
+    """受信処理の各段にかかった時間"""
+
+    __slots__ = ('count', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self) -> dict:
+        avg = self.total / self.count if self.count > 0 else 0.
+        return {
+            'count': self.count,
+            'avg_ms': avg * 1000,
+            'max_ms': self.max * 1000,
+            'last_ms': self.last * 1000,
+        }
+
+# queue: 受信してから解析を始めるまで, decode: 解析, wait: 解析後に反映を始めるまで, apply: 反映
+# rtt: 操作を送信してから応答を受け取るまで
+stage_stats: dict[str, StageStats] = {name: StageStats() for name in ['queue', 'decode', 'wait', 'apply', 'rtt']}
+_frames: asyncio.Queue | None = None
+_messages: asyncio.Queue | None = None
+_max_depths = {'frames': 0, 'messages': 0}
+
+def get_pipeline_stats() -> dict:
+    """キューの長さと各段の処理時間を返します"""
+    return {
+        'frames': _frames.qsize() if _frames is not None else 0,
+        'messages': _messages.qsize() if _messages is not None else 0,
+        'frames_max': _max_depths['frames'],
+        'messages_max': _max_depths['messages'],
+        'stages': {name: stats.as_dict() for name, stats in stage_stats.items()},
+    }
+
+async def _put(queue, name, item):
+    await queue.put(item)
+    depth = queue.qsize()
+    if depth > _max_depths[name]:
+        _max_depths[name] = depth
 
 async def reception(ws, page):
-    from app.panels.emojis import PanelEmojis
-    from app.panels.deleted import PanelDeletedEmojis
-    from app.panels.logs import PanelLogs
-    panel_emojis: PanelEmojis = page.data['emojis']
-    panel_deleted: PanelDeletedEmojis = page.data['deleted']
-    panel_logs: PanelLogs = page.data['logs']
+    global _frames, _messages
+    _frames = asyncio.Queue(FRAME_QUEUE_SIZE)
+    _messages = asyncio.Queue(MESSAGE_QUEUE_SIZE)
+    decoder = asyncio.create_task(_decode(_frames, _messages))
+    applier = asyncio.create_task(_apply(_messages, page))
+    try:
+        while True:
+            try:
+                # テキストのフレームもUTF-8のまま受け取り、受信量(バイト数)をそのまま数える
+                # 小さなフレームはそのままcodecで解析する (どの変換方法もbytesを読める)
+                frame = await ws.recv(decode=False)
+            except websockets.ConnectionClosed:
+                break
+            recording.record('in', frame)
+            await _put(_frames, 'frames', (frame, time.perf_counter(), len(frame)))
+        # 切断時は受信済みの分を反映し終えてから止まる
+        await _frames.put(None)
+        await asyncio.gather(decoder, applier)
+    except asyncio.exceptions.CancelledError:
+        pass
+    finally:
+        decoder.cancel()
+        applier.cancel()
+        _fail_all_pending('closed', '接続が切れました。')
+
+async def _decode(frames: asyncio.Queue, messages: asyncio.Queue):
     while True:
+        item = await frames.get()
+        if item is None:
+            await messages.put(None)
+            break
+        frame, received_at, size = item
+        started = time.perf_counter()
+        stage_stats['queue'].record(started - received_at)
+        large = len(frame) >= LARGE_FRAME_SIZE
         try:
-            data = json.loads(await ws.recv())
-            op = data['op']
-            reqid = data['reqid'] if 'reqid' in data else None
-            body = data['body']
-            if reqid in pending:
-                operation = pending.pop(reqid)
-                if op == 'ok':
-                    log_subject = '操作は完了しました'
-                    log_text = f"操作: {body['op']}"
-                    is_error = False
-                    if 'callback' in operation:
-                        ret = operation['callback'](body, page)
-                        if ret is not None:
-                            log_subject, log_text = ret
-                elif op == 'denied':
-                    log_subject = '操作が拒否されました'
-                    log_text = f"操作: {body['op']}\n追記: {body['message']}\n必要な権限が不足している可能性があります。"
-                    is_error = True
-                    if 'error' in operation:
-                        ret = operation['error'](body, data['op'], page)
-                        if ret is not None:
-                            log_subject, log_text = ret
-                elif op == 'internal_error':
-                    log_subject = '内部エラーが発生しました'
-                    log_text = f"操作: {body['op']}\n追記: {body['message']}\nこれはサーバー側の問題です。直らない場合報告してください。"
-                    is_error = True
-                    if 'error' in operation:
-                        ret = operation['error'](body, data['op'], page)
-                        if ret is not None:
-                            log_subject, log_text = ret
+            if large:
+                if isinstance(frame, bytes):
+                    frame = frame.decode('utf-8')
+                message = Message.from_dict(await _decode_large(frame))
+            else:
+                message = codec.decode_message(frame)
+        except Exception:
+            traceback.print_exc()
+            continue
+        decoded = time.perf_counter()
+        stage_stats['decode'].record(decoded - started)
+        await _put(messages, 'messages', (message, decoded, size))
+
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+# 大きなフレームの配列で、要素の終わり(次の要素の前か、配列の終わり)の候補 要素の最初の文字ごと
+_element_ends = {
+    '{': (re.compile(r'\}[ \t\n\r]*,'), re.compile(r'\}[ \t\n\r]*\]')),
+    '"': (re.compile(r'"[ \t\n\r]*,'), re.compile(r'"[ \t\n\r]*\]')),
+}
+
+class _Slicer():
+    """解析をAPPLY_BUDGET秒ごとに区切り、その間にイベントループへ処理を返します
+    GCを止める場合は、解析している間だけ止め、処理を返している間(画面の処理などが動く間)は元に戻す"""
+
+    __slots__ = ('gc_paused', 'deadline')
+
+    def __init__(self, pause_gc: bool):
+        self.gc_paused = pause_gc and gc.isenabled()
+        self.deadline = time.perf_counter() + APPLY_BUDGET
+
+    def pause(self):
+        if self.gc_paused:
+            gc.disable()
+
+    def resume(self):
+        if self.gc_paused:
+            gc.enable()
+
+    async def check(self):
+        if time.perf_counter() <= self.deadline:
+            return
+        self.resume()
+        try:
+            await asyncio.sleep(0)
+        finally:
+            self.pause()
+        self.deadline = time.perf_counter() + APPLY_BUDGET
+
+async def _decode_large(frame: str, pause_gc: bool = True):
+    """大きなフレームを少しずつ解析します
+    json.loadsなどは解析中にGILを手放さないため、別スレッドで解析しても画面が止まってしまう
+    そのためトップレベルのオブジェクトにある配列は、DECODE_CHUNK_SIZE文字ほどずつ要素の切れ目で区切り、
+    選んだ変換方法(codec)でまとめて解析する 区切りごとに、APPLY_BUDGET秒を過ぎていればイベントループへ処理を返す
+
+    解析中は増え続けるオブジェクトを何度も走査するので、pause_gcなら解析している間だけGCを止める"""
+    pos = _whitespace.match(frame, 0).end()
+    if frame[pos:pos + 1] != '{':
+        return codec.loads(frame)
+    slicer = _Slicer(pause_gc)
+    slicer.pause()
+    try:
+        return await _decode_object(frame, pos, slicer)
+    finally:
+        slicer.resume()
+
+async def _decode_object(frame: str, pos: int, slicer: _Slicer) -> dict:
+    """frame[pos]の'{'から始まるトップレベルのオブジェクトを解析します"""
+    scan = _json_decoder.raw_decode
+    skip = _whitespace.match
+    data = {}
+    pos = skip(frame, pos + 1).end()
+    if frame[pos:pos + 1] == '}':
+        pos += 1
+    else:
+        while True:
+            key, pos = scan(frame, pos)
+            pos = skip(frame, pos).end()
+            if frame[pos:pos + 1] != ':':
+                raise json.JSONDecodeError("Expecting ':' delimiter", frame, pos)
+            pos = skip(frame, pos + 1).end()
+            if frame[pos:pos + 1] == '[':
+                # opより後にある配列なら、opに合った形(msgspecなら型付きの構造体)で読み込む
+                value, pos = await _decode_array(frame, pos, data.get('op'), slicer)
+            else:
+                value, pos = scan(frame, pos)
+            data[key] = value
+
+            pos = skip(frame, pos).end()
+            c = frame[pos:pos + 1]
+            pos += 1
+            if c == '}':
+                break
+            if c != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", frame, pos - 1)
+            pos = skip(frame, pos).end()
+    pos = skip(frame, pos).end()
+    if pos != len(frame):
+        raise json.JSONDecodeError('Extra data', frame, pos)
+    return data
+
+async def _decode_array(frame: str, pos: int, op: str | None, slicer: _Slicer) -> tuple[list, int]:
+    """frame[pos]の'['から始まる配列を解析し、(配列, 配列の次の位置) を返します
+
+    要素の終わりの候補で区切った部分を '[' と ']' で囲み、codecでまとめて解析する
+    候補が文字列の中などにあった場合は、囲んだものがJSONとして正しくならず解析に失敗するので、次の候補を試す
+    DECODE_MAX_RETRIES回を超えて失敗した場合や、候補が見つからない場合は、残りを標準のjsonで1要素ずつ解析する"""
+    skip = _whitespace.match
+    value = []
+    pos = skip(frame, pos + 1).end()
+    if frame[pos:pos + 1] == ']':
+        return value, pos + 1
+
+    ends = _element_ends.get(frame[pos:pos + 1])
+    retries = 0
+    m_close = None
+    while ends is not None:
+        next_element, array_end = ends
+        if m_close is None or m_close.start() < pos:
+            m_close = array_end.search(frame, pos)
+        m_next = next_element.search(frame, pos + DECODE_CHUNK_SIZE)
+        while True:
+            if m_next is not None and (m_close is None or m_next.start() < m_close.start()):
+                m = m_next
+            elif m_close is not None:
+                m = m_close
+            else:
+                m = None
+                break
+            try:
+                items = codec.decode_body(op, '[' + frame[pos:m.start() + 1] + ']')
+            except ValueError:
+                retries += 1
+                if retries > DECODE_MAX_RETRIES:
+                    m = None
+                    break
+                if m is m_next:
+                    m_next = next_element.search(frame, m.end())
                 else:
-                    log_subject = 'エラーが発生しました'
-                    log_text = f"操作: {body['op']}\n追記: {body['message']}"
-                    is_error = True
-                    if 'error' in operation:
-                        ret = operation['error'](body, data['op'], page)
-                        if ret is not None:
-                            log_subject, log_text = ret
-                panel_logs.write_log(log_subject, log_text, data, is_error)
-            elif reqid is None:
-                match op:
-                    case 'user_update':
-                        registry.put_user(body['id'], body['misskey_id'], body['username'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_users()
-
-                        log_subject = 'ユーザーのデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'users_update':
-                        for i in body:
-                            registry.put_user(i['id'], i['misskey_id'], i['username'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_users()
-
-                        log_subject = '複数のユーザーのデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'emoji_update':
-                        registry.put_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['created_at'], body['updated_at'])
-                        panel_emojis.add_emoji(body['id'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '絵文字のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'emojis_update':
-                        for i in body:
-                            registry.put_emoji(i['id'], i['misskey_id'], i['name'], i['category'], i['tags'], i['url'], i['is_self_made'], i['license'], i['owner_id'], i['risk_id'], i['created_at'], i['updated_at'])
-                        panel_emojis.add_emojis([i['id'] for i in body])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '絵文字のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'deleted_emoji_update':
-                        registry.put_deleted_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], body['image_backup'], body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['info'], body['deleted_at'])
-                        panel_deleted.add_emoji(body['id'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '削除済み絵文字のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'deleted_emojis_update':
-                        for i in body:
-                            registry.put_deleted_emoji(i['id'], i['misskey_id'], i['name'], i['category'], i['tags'], i['url'], i['image_backup'], i['is_self_made'], i['license'], i['owner_id'], i['risk_id'], i['info'], i['deleted_at'])
-                        panel_deleted.add_emojis([i['id'] for i in body])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '削除済み絵文字のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'emoji_delete':
-                        registry.pop_emoji(body['id'])
-                        panel_emojis.remove_emoji(body['id'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '絵文字のデータが削除されました'
-                        log_text = ''
-                        is_error = False
-                    case 'emojis_delete':
-                        for i in body['ids']:
-                            registry.pop_emoji(i)
-                        panel_emojis.remove_emojis([i for i in body['ids']])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_all()
-
-                        log_subject = '絵文字のデータが削除されました'
-                        log_text = ''
-                        is_error = False
-                    case 'risk_update':
-                        rid = body['id']
-                        rr = False
-                        if rid in registry.risks:
-                            rr = True
-                        registry.put_risk(rid, body['checked'], body['level'], body['reason_genre'], body['remark'], body['created_at'], body['updated_at'])
-                        if rr:
-                            page.data['emojis'].list_emoji.reload_risk(rid)
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_risks()
-
-                        log_subject = 'リスクのデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'risks_update':
-                        for i in body:
-                            registry.put_risk(i['id'], i['checked'], i['level'], i['reason_genre'], i['remark'], i['created_at'], i['updated_at'])
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_risks()
-
-                        log_subject = 'リスクのデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'reason_update':
-                        registry.put_reason(body['id'], body['text'], body['created_at'], body['updated_at'])
-                        page.data['reasons'].update_reason(body['id'], body['text'])
-                        page.data['emojis'].reload_reasons()
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_reasons()
-
-                        log_subject = '理由区分のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'reasons_update':
-                        for i in body:
-                            registry.put_reason(i['id'], i['text'], i['created_at'], i['updated_at'])
-                            page.data['reasons'].update_reason(i['id'], i['text'])
-                        page.data['emojis'].reload_reasons()
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_reasons()
-
-                        log_subject = '理由区分のデータを取得しました'
-                        log_text = ''
-                        is_error = False
-                    case 'reason_delete':
-                        registry.pop_reason(body['id'])
-                        page.data['reasons'].remove_reason(body['id'])
-                        page.data['emojis'].reload_reasons()
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_reasons()
-
-                        log_subject = '理由区分のデータが削除されました'
-                        log_text = ''
-                        is_error = False
-                    case 'reasons_delete':
-                        for i in body['ids']:
-                            registry.pop_reason(i)
-                            page.data['reasons'].remove_reason(i)
-                        page.data['emojis'].reload_reasons()
-
-                        if page.data['root'].current_view == Views.DASHBOARD:
-                            page.data['dashboard'].reload_reasons()
-
-                        log_subject = '理由区分のデータが削除されました'
-                        log_text = ''
-                        is_error = False
-                    case 'misskey_api_error':
-                        log_subject = 'サーバー側の処理でエラーが発生しました'
-                        log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
-                        is_error = True
-                    case 'misskey_unknown_error':
-                        log_subject = 'サーバー側の処理でエラーが発生しました'
-                        log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
-                        is_error = True
-                    case 'error':
-                        log_subject = 'サーバー側の処理でエラーが発生しました'
-                        log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
-                        is_error = True
-                    case 'internal_error':
-                        log_subject = 'サーバー側の処理で内部エラーが発生しました'
-                        log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
-                        is_error = True
-                    case _:
-                        log_subject = f'<{op}>'
-                        log_text = ''
-                page.data['logs'].write_log(log_subject, log_text, data, is_error)
-        except asyncio.exceptions.CancelledError:
+                    m_close = array_end.search(frame, m.end())
+                continue
+            break
+        if m is None:
             break
-        except websockets.ConnectionClosed:
+        value.extend(items)
+        if m is m_close:
+            return value, m.end()
+        pos = skip(frame, m.end()).end()
+        await slicer.check()
+
+    # 区切れなかった残りは1要素ずつ解析する
+    scan = _json_decoder.raw_decode
+    while True:
+        item, pos = scan(frame, pos)
+        value.append(item)
+        pos = skip(frame, pos).end()
+        c = frame[pos:pos + 1]
+        pos += 1
+        if c == ']':
+            return value, pos
+        if c != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", frame, pos - 1)
+        pos = skip(frame, pos).end()
+        await slicer.check()
+
+async def _apply(messages: asyncio.Queue, page):
+    while True:
+        item = await messages.get()
+        if item is None:
             break
+        message, decoded_at, size = item
+        started = time.perf_counter()
+        stage_stats['wait'].record(started - decoded_at)
+        try:
+            await apply_message(message, page)
         except Exception:
             traceback.print_exc()
+        elapsed = time.perf_counter() - started
+        stage_stats['apply'].record(elapsed)
+        metrics.message_handled(message.op, size, elapsed)
+
+async def _apply_each(items, func):
+    """itemsを1件ずつfuncに渡します
+    APPLY_BUDGET秒を超えたらイベントループに処理を返し、画面の操作を止めないようにします"""
+    deadline = time.perf_counter() + APPLY_BUDGET
+    for n, item in enumerate(items, 1):
+        func(item)
+        if n % APPLY_CHECK_EVERY == 0 and time.perf_counter() > deadline:
+            await asyncio.sleep(0)
+            deadline = time.perf_counter() + APPLY_BUDGET
+
+def _put_user(body):
+    registry.put_user(body['id'], body['misskey_id'], body['username'])
+
+def _put_emoji(body):
+    registry.put_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['created_at'], body['updated_at'])
+
+def _put_deleted_emoji(body):
+    registry.put_deleted_emoji(body['id'], body['misskey_id'], body['name'], body['category'], body['tags'], body['url'], blobstore.put_deleted_backup(body['id'], body['image_backup']), body['is_self_made'], body['license'], body['owner_id'], body['risk_id'], body['info'], body['deleted_at'])
+
+def _put_risk(body):
+    registry.put_risk(body['id'], body['checked'], body['level'], body['reason_genre'], body['remark'], body['created_at'], body['updated_at'])
+
+def _put_reason(body):
+    registry.put_reason(body['id'], body['text'], body['created_at'], body['updated_at'])
+
+async def apply_message(message: Message, page):
+    """受信したメッセージを1件反映します"""
+    from app.panels.logs import PanelLogs
+    panel_logs: PanelLogs = page.data['logs']
+    op = message.op
+    reqid = message.reqid
+    body = message.body
+    if reqid in pending:
+        operation = _pop_pending(reqid)
+        elapsed = time.perf_counter() - operation['sent_at']
+        stage_stats['rtt'].record(elapsed)
+        metrics.request_done(operation['op'], elapsed, op)
+        if 'future' in operation:
+            future: asyncio.Future = operation['future']
+            if not future.done():
+                if op == 'ok':
+                    future.set_result(body)
+                else:
+                    future.set_exception(RequestError(body.get('op', operation['op']), op, body.get('message'), body))
+        if op == 'ok':
+            log_subject = '操作は完了しました'
+            log_text = f"操作: {body['op']}"
+            is_error = False
+            if 'callback' in operation:
+                ret = operation['callback'](body, page)
+                if ret is not None:
+                    log_subject, log_text = ret
+        elif op == 'denied':
+            log_subject = '操作が拒否されました'
+            log_text = f"操作: {body['op']}\n追記: {body['message']}\n必要な権限が不足している可能性があります。"
+            is_error = True
+            if 'error' in operation:
+                ret = operation['error'](body, op, page)
+                if ret is not None:
+                    log_subject, log_text = ret
+        elif op == 'internal_error':
+            log_subject = '内部エラーが発生しました'
+            log_text = f"操作: {body['op']}\n追記: {body['message']}\nこれはサーバー側の問題です。直らない場合報告してください。"
+            is_error = True
+            if 'error' in operation:
+                ret = operation['error'](body, op, page)
+                if ret is not None:
+                    log_subject, log_text = ret
+        else:
+            log_subject = 'エラーが発生しました'
+            log_text = f"操作: {body['op']}\n追記: {body['message']}"
+            is_error = True
+            if 'error' in operation:
+                ret = operation['error'](body, op, page)
+                if ret is not None:
+                    log_subject, log_text = ret
+        panel_logs.write_log(log_subject, log_text, message.to_dict(), is_error)
+    elif reqid in _expired:
+        # 応答が無いため失敗として扱った後に届いた応答 成功していれば反映し直す
+        operation = _expired.pop(reqid)
+        if op == 'ok' and 'callback' in operation:
+            operation['callback'](body, page)
+        log_subject = '失敗として扱った操作の応答が遅れて届きました'
+        log_text = f"操作: {operation['op']}\n応答: {op}\n経過: {time.perf_counter() - operation['sent_at']:.1f}秒"
+        panel_logs.write_log(log_subject, log_text, message.to_dict(), True)
+    elif reqid is None:
+        match op:
+            case 'user_update':
+                _put_user(body)
+
+                log_subject = 'ユーザーのデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'users_update':
+                await _apply_each(body, _put_user)
+
+                log_subject = '複数のユーザーのデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'emoji_update':
+                _put_emoji(body)
+
+                log_subject = '絵文字のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'emojis_update':
+                await _apply_each(body, _put_emoji)
+
+                log_subject = '絵文字のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'deleted_emoji_update':
+                _put_deleted_emoji(body)
+
+                log_subject = '削除済み絵文字のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'deleted_emojis_update':
+                await _apply_each(body, _put_deleted_emoji)
+
+                log_subject = '削除済み絵文字のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'emoji_delete':
+                registry.pop_emoji(body['id'])
+
+                log_subject = '絵文字のデータが削除されました'
+                log_text = ''
+                is_error = False
+            case 'emojis_delete':
+                await _apply_each(body['ids'], registry.pop_emoji)
+
+                log_subject = '絵文字のデータが削除されました'
+                log_text = ''
+                is_error = False
+            case 'risk_update':
+                _put_risk(body)
+
+                log_subject = 'リスクのデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'risks_update':
+                await _apply_each(body, _put_risk)
+
+                log_subject = 'リスクのデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'reason_update':
+                _put_reason(body)
+
+                log_subject = '理由区分のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'reasons_update':
+                await _apply_each(body, _put_reason)
+
+                log_subject = '理由区分のデータを取得しました'
+                log_text = ''
+                is_error = False
+            case 'reason_delete':
+                registry.pop_reason(body['id'])
+
+                log_subject = '理由区分のデータが削除されました'
+                log_text = ''
+                is_error = False
+            case 'reasons_delete':
+                for i in body['ids']:
+                    registry.pop_reason(i)
+
+                log_subject = '理由区分のデータが削除されました'
+                log_text = ''
+                is_error = False
+            case 'misskey_api_error':
+                log_subject = 'サーバー側の処理でエラーが発生しました'
+                log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
+                is_error = True
+            case 'misskey_unknown_error':
+                log_subject = 'サーバー側の処理でエラーが発生しました'
+                log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
+                is_error = True
+            case 'error':
+                log_subject = 'サーバー側の処理でエラーが発生しました'
+                log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
+                is_error = True
+            case 'internal_error':
+                log_subject = 'サーバー側の処理で内部エラーが発生しました'
+                log_text = 'これはサーバー側のプログラムのバグか設定ミスが原因である可能性が極めて高いです。報告してください。'
+                is_error = True
+            case _:
+                log_subject = f'<{op}>'
+                log_text = ''
+                is_error = False
+        panel_logs.write_log(log_subject, log_text, message.to_dict(), is_error)
+    elif not isinstance(ws, recording.ReplaySocket):
+        # 覚えていないほど前に失敗として扱った操作か、送っていない操作への応答
+        # (記録の再生中は操作を送っていないので、記録された応答はすべてここに来る 記録しない)
+        panel_logs.write_log('不明な操作への応答が届きました', f'応答: {op}', message.to_dict(), True)
 
 
 def auth(token, page):
-    global ws
+    global ws, _token
     if ws is None:
         return
+    _token = token
     page.data['settings'].set_auth_state(1)
 
     def callback_auth(body, page):
-        permitted = False
-        bashboard: PanelDashboard = page.data['dashboard']
-
-        permissions = [
-            ("You logged in as 'User'.", 2, False),
-            ("You logged in as 'Emoji moderator'.", 3, True),
-            ("You logged in as 'Moderator'.", 4, True),
-            ("You logged in as 'Administrator'.", 5, True),
-        ]
-        msg = body['message']
-        for p in permissions:
-            if msg.startswith(p[0]):
-                page.data['settings'].set_auth_state(p[1])
-                permitted = p[2]
-                username = msg[len(f'{p[0]} (Username: '):-1]
-                break
-        if permitted:
-            bashboard.main_frame.welcome_text.update_to_authed_text(username)
-            create_send_task(wsmsg.FetchAllEmojis(), page)
-            create_send_task(wsmsg.FetchAllUsers(), page)
-            create_send_task(wsmsg.FetchAllRisks(), page)
-            create_send_task(wsmsg.FetchAllReasons(), page)
-            create_send_task(wsmsg.FetchAllDeletedEmojis(), page)
+        if _on_auth(body, page):
+            # 切れている間の変更は、最新のデータを要求する前に送る
+            _replay_outbox(page)
+            ready.set()
+            _fetch_updates(page)
 
     def error_auth(body, err, page):
         page.data['settings'].set_auth_state(0)
@@ -322,62 +861,179 @@ def auth(token, page):
     op = wsmsg.Auth(token)
     create_send_task(op, page, callback_auth, error_auth)
 
+def _on_auth(body, page) -> bool:
+    """認証の応答を画面へ反映します 操作できる権限があればTrueを返します"""
+    permitted = False
+    bashboard: PanelDashboard = page.data['dashboard']
 
-def change_risk_level(rid, level, page):
-    global ws
-    if ws is None:
+    permissions = [
+        ("You logged in as 'User'.", 2, False),
+        ("You logged in as 'Emoji moderator'.", 3, True),
+        ("You logged in as 'Moderator'.", 4, True),
+        ("You logged in as 'Administrator'.", 5, True),
+    ]
+    msg = body['message']
+    for p in permissions:
+        if msg.startswith(p[0]):
+            page.data['settings'].set_auth_state(p[1])
+            permitted = p[2]
+            username = msg[len(f'{p[0]} (Username: '):-1]
+            break
+    if permitted:
+        bashboard.main_frame.welcome_text.update_to_authed_text(username)
+    return permitted
+
+def _fetch_updates(page):
+    """キャッシュ済みのデータより新しいものだけを要求します"""
+    _fetch_all(wsmsg.FetchAllEmojis(cache.get_since('emojis')), 'emojis', page)
+    _fetch_all(wsmsg.FetchAllUsers(), 'users', page)
+    _fetch_all(wsmsg.FetchAllRisks(cache.get_since('risks')), 'risks', page)
+    _fetch_all(wsmsg.FetchAllReasons(cache.get_since('reasons')), 'reasons', page)
+    _fetch_all(wsmsg.FetchAllDeletedEmojis(cache.get_since('deleted')), 'deleted', page)
+
+def _fetch_all(op, table, page):
+    """全件(sinceがあれば差分)を取得します
+    全件取得の場合は、届かなかったデータをサーバー側で削除されたものとしてキャッシュから取り除きます"""
+    if getattr(op, 'since', None) is None:
+        cache.begin_sweep(table)
+
+    def callback(body, page):
+        cache.end_sweep(table)
+
+    def error_callback(body, reply, page):
+        cache.cancel_sweep(table)
+
+    create_send_task(op, page, callback, error_callback, FETCH_TIMEOUT)
+
+
+def _in_loop(page, func, *args):
+    """funcをイベントループで呼びます
+    画面のイベントは別のスレッドで処理されるので、registryや応答待ちの操作に触る処理はこれを通す"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        async def call():
+            func(*args)
+        page.run_task(call)
+    else:
+        func(*args)
+
+# 同じリスクへの変更は、最初の変更からCOALESCE_DELAY秒の間まとめ、1回の操作で送る
+COALESCE_DELAY = 0.3
+# rid -> まとめている変更 (props, 送信中の変更の番号, page, タイマー)
+_coalesced: dict[str, dict] = {}
+
+def _change_risk(rid, page, **props):
+    """リスクの変更を送信します
+    応答を待たずにregistryへ送信中として反映し、okなら確定、失敗したら取り消します"""
+    _in_loop(page, _queue_risk_change, rid, page, wsmsg.build_risk_props(**props))
+
+def _queue_risk_change(rid, page, props: dict):
+    if len(props) == 0:
         return
-    op = wsmsg.SetRiskProp(rid, level=level)
-    create_send_task(op, page)
+    serial = registry.change_risk_local(rid, props)
+    entry = _coalesced.get(rid)
+    if entry is None:
+        loop = asyncio.get_running_loop()
+        entry = {'props': {}, 'serials': [], 'page': page, 'timer': loop.call_later(COALESCE_DELAY, _flush_risk_change, rid)}
+        _coalesced[rid] = entry
+    entry['props'].update(props)
+    if serial is not None:
+        entry['serials'].append(serial)
 
-def change_reason(rid, rsid, page):
-    global ws
-    if ws is None:
+def _flush_risk_change(rid):
+    entry = _coalesced.pop(rid, None)
+    if entry is None:
         return
+    entry['timer'].cancel()
+    op = wsmsg.SetRiskProp(rid)
+    op.props = entry['props']
+    serials = entry['serials']
+
+    def callback(body, page):
+        for serial in serials:
+            registry.confirm_risk_change(rid, serial)
+
+    def error_callback(body, reply, page):
+        for serial in serials:
+            registry.rollback_risk_change(rid, serial)
+
+    _send(op, entry['page'], callback, error_callback)
+
+def _flush_risk_changes():
+    for rid in list(_coalesced):
+        _flush_risk_change(rid)
+
+def flush_risk_changes(page):
+    """まとめている途中のリスクの変更をすぐに送信します 画面を移動するときに呼ばれます"""
+    _in_loop(page, _flush_risk_changes)
+
+def change_risk_level(rid, level, page):
+    _change_risk(rid, page, level=level)
+
+def change_reason(rid, rsid, page):
     if rsid == '':
         rsid = None
-    op = wsmsg.SetRiskProp(rid, rsid=rsid)
-    create_send_task(op, page)
+    _change_risk(rid, page, rsid=rsid)
 
 def change_remark(rid, text, page):
-    global ws
-    if ws is None:
-        return
-    op = wsmsg.SetRiskProp(rid, remark=text)
-    create_send_task(op, page)
+    _change_risk(rid, page, remark=text)
 
 def change_status(rid, status, page):
-    global ws
+    _change_risk(rid, page, checked=status)
+
+# 一括変更で1回に送るリスクの数
+BULK_CHUNK_SIZE = 200
+# サーバーが一括変更に対応しているか (未確認ならNone)
+bulk_supported: bool | None = None
+
+async def change_risks_chunk(rids, page, checked=-1, level=-1, rsid=-1, remark=-1) -> list[str]:
+    """複数のリスクに同じ変更を1回分まとめて送信し、失敗したリスクのIDを返します
+    サーバーが一括変更に対応していない場合は、1件ずつの操作を応答を待たずに続けて送信します
+    接続されていない、または送信中に切れた場合はRequestError('closed')を送出します
+    どこまで届いたかは分からないので、送り直すかどうかは呼び出し側で決めます"""
+    global bulk_supported
+    if rsid == '':
+        rsid = None
+    props = {'checked': checked, 'level': level, 'rsid': rsid, 'remark': remark}
+    # 先に行った個別の変更が後から届いて上書きしないよう、まとめている途中の分は先に送る
+    for rid in rids:
+        if rid in _coalesced:
+            _flush_risk_change(rid)
     if ws is None:
-        return
-    op = wsmsg.SetRiskProp(rid, checked=status)
-    create_send_task(op, page)
+        raise RequestError('set_risk_props_bulk', 'closed', '接続されていません。')
+    if bulk_supported is not False:
+        try:
+            await request(wsmsg.SetRiskPropsBulk(rids, **props), page)
+            bulk_supported = True
+            return []
+        except RequestError as e:
+            if e.reply == 'closed':
+                raise
+            if e.reply != 'error' or bulk_supported is not None:
+                return list(rids)
+            # 未対応の操作として扱われたので、以降は1件ずつ送る
+            bulk_supported = False
+    results = await asyncio.gather(*[request(wsmsg.SetRiskProp(rid, **props), page) for rid in rids], return_exceptions=True)
+    failed = []
+    for rid, result in zip(rids, results, strict=True):
+        if isinstance(result, BaseException):
+            failed.append(rid)
+    return failed
 
 def change_info(eid, text, page):
-    global ws
-    if ws is None:
-        return
     op = wsmsg.SetDeletedReason(eid, text)
-    create_send_task(op, page)
+    _send(op, page)
 
 
 def create_reason(text, page):
-    global ws
-    if ws is None:
-        return
     op = wsmsg.CreateReason(text)
-    create_send_task(op, page)
+    _send(op, page)
 
 def delete_reason(rsid, page):
-    global ws
-    if ws is None:
-        return
     op = wsmsg.DeleteReason(rsid)
-    create_send_task(op, page)
+    _send(op, page)
 
 def change_reason_text(rsid, text, page):
-    global ws
-    if ws is None:
-        return
     op = wsmsg.SetReasonText(rsid, text)
-    create_send_task(op, page)
+    _send(op, page)
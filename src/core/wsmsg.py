@@ -1,7 +1,7 @@
 import abc
 import uuid
 
-import json
+from core import codec
 
 class IWSMessage(metaclass=abc.ABCMeta):
 
@@ -10,7 +10,7 @@ class IWSMessage(metaclass=abc.ABCMeta):
         raise NotImplementedError()
 
     def build(self) -> str:
-        return json.dumps(self._build_json())
+        return codec.dumps(self._build_json())
 
 class IWSOperation(IWSMessage):
     def __init__(self, op) -> None:
@@ -49,27 +49,35 @@ class FetchEmoji(IWSOperation):
             }
 
 class FetchAllEmojis(IWSOperation):
-    def __init__(self) -> None:
+    def __init__(self, since=None) -> None:
         super().__init__('fetch_all_emojis')
+        self.since = since
 
     def _build_json(self) -> dict:
+        body = {}
+        if self.since is not None:
+            body['since'] = self.since
         return \
             {
                 'op': self.op,
                 'reqid': self.reqid,
-                'body': {}
+                'body': body
             }
 
 class FetchAllDeletedEmojis(IWSOperation):
-    def __init__(self) -> None:
+    def __init__(self, since=None) -> None:
         super().__init__('fetch_all_deleted_emojis')
+        self.since = since
 
     def _build_json(self) -> dict:
+        body = {}
+        if self.since is not None:
+            body['since'] = self.since
         return \
             {
                 'op': self.op,
                 'reqid': self.reqid,
-                'body': {}
+                'body': body
             }
 
 class FetchUser(IWSOperation):
@@ -115,15 +123,19 @@ class FetchRisk(IWSOperation):
             }
 
 class FetchAllRisks(IWSOperation):
-    def __init__(self) -> None:
+    def __init__(self, since=None) -> None:
         super().__init__('fetch_all_risks')
+        self.since = since
 
     def _build_json(self) -> dict:
+        body = {}
+        if self.since is not None:
+            body['since'] = self.since
         return \
             {
                 'op': self.op,
                 'reqid': self.reqid,
-                'body': {}
+                'body': body
             }
 
 class FetchReason(IWSOperation):
@@ -142,32 +154,40 @@ class FetchReason(IWSOperation):
             }
 
 class FetchAllReasons(IWSOperation):
-    def __init__(self) -> None:
+    def __init__(self, since=None) -> None:
         super().__init__('fetch_all_reasons')
+        self.since = since
 
     def _build_json(self) -> dict:
+        body = {}
+        if self.since is not None:
+            body['since'] = self.since
         return \
             {
                 'op': self.op,
                 'reqid': self.reqid,
-                'body': {}
+                'body': body
             }
 
 
+def build_risk_props(checked=-1, level=-1, rsid=-1, remark=-1) -> dict:
+    """リスクの変更内容を組み立てます 値が-1の項目は変更しません"""
+    props = {}
+    if checked in [0, 1]:
+        props['checked'] = checked
+    if level in [None, 0, 1, 2, 3]:
+        props['level'] = level
+    if rsid != -1:
+        props['reason_id'] = rsid
+    if remark != -1:
+        props['remark'] = remark
+    return props
+
 class SetRiskProp(IWSOperation):
     def __init__(self, rid, checked=-1, level=-1, rsid=-1, remark=-1) -> None:
         super().__init__('set_risk_prop')
         self.id = rid
-        props = {}
-        if checked in [0, 1]:
-            props['checked'] = checked
-        if level in [None, 0, 1, 2, 3]:
-            props['level'] = level
-        if rsid != -1:
-            props['reason_id'] = rsid
-        if remark != -1:
-            props['remark'] = remark
-        self.props = props
+        self.props = build_risk_props(checked, level, rsid, remark)
 
     def _build_json(self) -> dict:
         return \
@@ -180,6 +200,24 @@ class SetRiskProp(IWSOperation):
                 }
             }
 
+class SetRiskPropsBulk(IWSOperation):
+    """複数のリスクに同じ変更をまとめて行います"""
+    def __init__(self, rids, checked=-1, level=-1, rsid=-1, remark=-1) -> None:
+        super().__init__('set_risk_props_bulk')
+        self.ids = list(rids)
+        self.props = build_risk_props(checked, level, rsid, remark)
+
+    def _build_json(self) -> dict:
+        return \
+            {
+                'op': self.op,
+                'reqid': self.reqid,
+                'body': {
+                    'ids': self.ids,
+                    'props': self.props
+                }
+            }
+
 class SetDeletedReason(IWSOperation):
     def __init__(self, eid, text) -> None:
         super().__init__('set_deleted_reason')
@@ -1,13 +1,20 @@
+import os
+
 import flet as ft
 
 from app.root import Root
 from app.utils.data import KeyboardBehaviorData
+from core import websocket
+from core import recording
+from core import metrics
+from core import imageproxy
 
 async def main(page: ft.Page):
     keyboard_behavior_data = KeyboardBehaviorData()
 
     def window_event_handler(e):
         if e.data == 'close':
+            imageproxy.stop()
             page.window.destroy()
 
     page.title = 'Cotonestrum'
@@ -31,6 +38,9 @@ async def main(page: ft.Page):
 
     page.data = {}
 
+    # 絵文字の画像はローカルの中継サーバーを通して読み込み、ディスクにキャッシュする
+    imageproxy.start()
+
     keyboard_behavior_data.start_keyboard_event()
     page.data['keyboard_behavior'] = keyboard_behavior_data
 
@@ -49,6 +59,16 @@ async def main(page: ft.Page):
     )
     page.update()
 
+    # 環境変数COTONESTRUM_METRICSが指定されていれば、通信の計測を定期的に書き出す
+    if os.environ.get(metrics.METRICS_ENV):
+        page.run_task(metrics.dump_periodically, None, None, lambda: {'pipeline': websocket.get_pipeline_stats()})
+
+    # 記録した通信を再生する (サーバーには接続しない)
+    replay_path = os.environ.get(recording.REPLAY_ENV)
+    if replay_path:
+        speed = float(os.environ.get(recording.REPLAY_SPEED_ENV, '1'))
+        page.run_task(websocket.replay, replay_path, page, speed)
+
 if __name__ == '__main__':
     ft.app(target=main, view=ft.AppView.FLET_APP)
 
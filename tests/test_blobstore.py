@@ -0,0 +1,58 @@
+import base64
+import asyncio
+import os.path as osp
+
+from core import registry
+from core import blobstore
+
+
+def _put(eid, backup):
+    registry.put_deleted_emoji(eid, 'm', 'name', 'category', [], 'url', blobstore.put_deleted_backup(eid, backup), False, '', None, 'r', '', None)
+
+async def _wait_backup(eid):
+    for _ in range(200):
+        emoji = registry.get_deleted_emoji(eid)
+        if emoji is not None and emoji.image_backup is not None:
+            return emoji.image_backup
+        await asyncio.sleep(0.01)
+    raise AssertionError('image backup key was not set')
+
+async def _scenario():
+    small = base64.b64encode(b'small image').decode('ascii')
+    large = base64.b64encode(bytes(range(256)) * 1024).decode('ascii')
+    assert len(large) > blobstore.INLINE_HASH_LIMIT
+
+    # 小さな画像はすぐにキーが決まる
+    _put('d1', small)
+    key = registry.get_deleted_emoji('d1').image_backup
+    assert blobstore.is_key(key)
+
+    # 大きな画像はワーカースレッドでキーを求め、求まってからregistryのキーを差し替える
+    _put('d2', large)
+    key = await _wait_backup('d2')
+    blobstore.wait(key)
+    with open(blobstore.path(key), 'rb') as f:
+        assert f.read() == base64.b64decode(large)
+    assert key == blobstore.put_base64(large)
+
+    # キーを求めている間に別の画像に変わった場合は、後の画像のキーのままにする
+    _put('d2', base64.b64encode(bytes(range(255, -1, -1)) * 1024).decode('ascii'))
+    _put('d2', small)
+    await asyncio.sleep(0.2)
+    assert registry.get_deleted_emoji('d2').image_backup == registry.get_deleted_emoji('d1').image_backup
+
+    # キーを求めている間に取り除かれた場合は、書き出した画像を消す
+    other = base64.b64encode(bytes(range(0, 256, 2)) * 2048).decode('ascii')
+    _put('d3', other)
+    registry.pop_deleted_emoji('d3')
+    await asyncio.sleep(0.2)
+    assert not osp.isfile(blobstore.path(blobstore._hash(other)))
+
+def test_put_deleted_backup(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobstore, 'BLOB_DIR', str(tmp_path / 'blobs'))
+    try:
+        asyncio.run(_scenario())
+    finally:
+        for eid in ['d1', 'd2', 'd3']:
+            registry.pop_deleted_emoji(eid)
+        registry.flush_changes()
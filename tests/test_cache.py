@@ -0,0 +1,163 @@
+import os.path as osp
+import sqlite3
+import asyncio
+import argparse
+
+import websockets
+
+import dummy_server
+from core import cache
+from core import registry
+from core import blobstore
+from core import websocket
+
+
+class _Logs():
+    def write_log(self, subject, text, data=None, error=False):
+        pass
+
+class _Settings():
+    def set_connect_state(self, state):
+        pass
+
+    def set_auth_state(self, state):
+        pass
+
+class _WelcomeText():
+    def update_to_authed_text(self, username):
+        pass
+
+class _MainFrame():
+    def __init__(self):
+        self.welcome_text = _WelcomeText()
+
+class _Dashboard():
+    def __init__(self):
+        self.main_frame = _MainFrame()
+
+class _Page():
+    """画面無しでwebsocketを動かすためのpage"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.data = {'logs': _Logs(), 'settings': _Settings(), 'dashboard': _Dashboard()}
+
+    def run_task(self, func, *args):
+        return asyncio.run_coroutine_threadsafe(func(*args), self.loop)
+
+
+def _clear_registry():
+    for records in [registry.emojis, registry.deleted, registry.users, registry.risks, registry.reasons,
+                    registry.emojis_by_risk, registry.emojis_by_owner, registry.deleted_by_risk, registry.deleted_by_owner, registry.risks_by_reason,
+                    *registry.emoji_texts.values(), *registry.deleted_texts.values(), registry.username_index, registry.remark_index]:
+        records.clear()
+    registry.flush_changes()
+
+def _count(host, table, eid=None) -> int:
+    with sqlite3.connect(cache.get_cache_path(host)) as db:
+        if eid is None:
+            return db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        return db.execute(f'SELECT COUNT(*) FROM {table} WHERE id = ?', (eid,)).fetchone()[0]
+
+async def _wait_idle():
+    """認証と全件(差分)取得が終わり、キャッシュへ書き終えるまで待ちます"""
+    for _ in range(200):
+        await asyncio.sleep(0.05)
+        if websocket.ready.is_set() and len(websocket.pending) == 0 and len(websocket._sending) == 0:
+            break
+    else:
+        raise AssertionError('fetch did not finish')
+    registry.flush_changes()
+    await cache.drain()
+
+async def _sync(host, page):
+    await websocket.connect(host, page)
+    websocket.auth('token', page)
+    await _wait_idle()
+
+async def _disconnect(page):
+    await websocket.disconnect(page)
+    cache.close()
+    await cache.drain()
+    _clear_registry()
+
+
+async def _scenario(monkeypatch):
+    page = _Page(asyncio.get_running_loop())
+    data = dummy_server.Dataset(200, 20, 10)
+    args = argparse.Namespace(role='moderator', username='test', chunk=50, no_bulk=False)
+    server = dummy_server.Server(data, args)
+    fetches = []
+    handle = server.handle
+
+    async def record(ws, op, body, reqid):
+        if op.startswith('fetch_all_'):
+            fetches.append((op, body.get('since')))
+        return await handle(ws, op, body, reqid)
+
+    server.handle = record
+
+    async with websockets.serve(server.handler, '127.0.0.1', 0, max_size=None) as srv:
+        host = f"127.0.0.1:{srv.sockets[0].getsockname()[1]}"
+
+        # 1回目: キャッシュが無いので全件を取得し、キャッシュへ書き込む
+        await _sync(host, page)
+        assert all(since is None for _, since in fetches)
+        assert len(registry.emojis) == 200
+        assert _count(host, 'emojis') == 200
+        assert _count(host, 'deleted') == 10
+        removed_deleted = next(iter(data.deleted))
+        backup = registry.deleted[removed_deleted].image_backup
+        blobstore.wait(backup)
+        assert osp.isfile(blobstore.path(backup))
+        await _disconnect(page)
+
+        # 切断している間にサーバー側で変更・削除・追加が行われる
+        changed = next(iter(data.risks))
+        data.set_risk_props(changed, {'level': 3, 'remark': 'changed'})
+        removed = next(iter(data.emojis))
+        data.emojis.pop(removed)
+        data.deleted.pop(removed_deleted)
+        added = data.add_emoji()
+        added['updated_at'] = dummy_server.now()
+
+        # 2回目: 接続する前にキャッシュから画面を埋め、差分だけを取得する
+        fetches.clear()
+        await websocket.connect(host, page)
+        assert len(registry.emojis) == 200
+        websocket.auth('token', page)
+        await _wait_idle()
+        assert dict(fetches)['fetch_all_emojis'] is not None
+        assert dict(fetches)['fetch_all_risks'] is not None
+        assert registry.get_risk(changed).remark == 'changed'
+        assert added['id'] in registry.emojis
+        # 差分取得では削除が分からない
+        assert removed in registry.emojis
+        await _disconnect(page)
+
+        # 3回目: 全件を取り直す時期になると、届かなかった絵文字はキャッシュからも取り除かれる
+        monkeypatch.setattr(cache, 'FULL_SYNC_INTERVAL', -1)
+        fetches.clear()
+        await _sync(host, page)
+        assert dict(fetches)['fetch_all_emojis'] is None
+        assert removed not in registry.emojis
+        assert len(registry.emojis) == 200
+        assert _count(host, 'emojis', removed) == 0
+        assert _count(host, 'emojis', added['id']) == 1
+        assert _count(host, 'emojis') == 200
+        # 取り除かれた削除済み絵文字のバックアップ画像も消える
+        assert removed_deleted not in registry.deleted
+        assert _count(host, 'deleted', removed_deleted) == 0
+        for _ in range(100):
+            if not osp.isfile(blobstore.path(backup)):
+                break
+            await asyncio.sleep(0.01)
+        else:
+            raise AssertionError('image backup was not removed')
+        await _disconnect(page)
+
+
+def test_cache_delta_sync(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(blobstore, 'BLOB_DIR', str(tmp_path / 'blobs'))
+    asyncio.run(_scenario(monkeypatch))
@@ -0,0 +1,59 @@
+import json
+import asyncio
+
+import pytest
+
+from core import codec
+from core import websocket
+
+
+def _emojis(n):
+    return [
+        {
+            'id': f'e{i:08d}',
+            'misskey_id': f'9x{i:010d}',
+            'name': f'emoji_{i}',
+            'category': 'カテゴリー',
+            'tags': ['タグ', f't{i % 7}'],
+            'url': f'https://media.example.com/emoji/{i:08d}.webp',
+            'is_self_made': i % 2 == 0,
+            'license': None,
+            'owner_id': 'u0',
+            'risk_id': f'r{i:08d}',
+            'created_at': '2024-01-01T00:00:00.000Z',
+            'updated_at': '2024-01-01T00:00:00.000Z',
+        }
+        for i in range(n)
+    ]
+
+def _frames():
+    emojis = _emojis(2000)
+    # 要素の終わりに見える文字列 (区切りの候補を誤って選んでも、解析し直して正しく読めること)
+    emojis[10]['name'] = 'a},{"x":1'
+    emojis[500]['name'] = 'b}]'
+    emojis[900]['tags'] = ['"],', '\\"},']
+    return [
+        {'op': 'emojis_update', 'body': emojis},
+        {'body': emojis, 'op': 'emojis_update'},
+        {'op': 'emojis_delete', 'body': {'ids': [i['id'] for i in emojis]}},
+        {'op': 'x', 'body': [1, 'a"],', {'a': [{'b': 1}]}, [2, 3]] * 1000, 'extra': [{'a': 'b}]'}], 'n': None},
+        {'op': 'x', 'body': []},
+    ]
+
+@pytest.mark.parametrize('name', list(codec.available_codecs()))
+@pytest.mark.parametrize('chunk', [100, 256 * 1024])
+def test_decode_large(monkeypatch, name, chunk):
+    monkeypatch.setattr(codec, 'codec', codec.available_codecs()[name])
+    monkeypatch.setattr(websocket, 'DECODE_CHUNK_SIZE', chunk)
+    for frame in _frames():
+        for text in [json.dumps(frame, ensure_ascii=False), json.dumps(frame, indent=1)]:
+            data = asyncio.run(websocket._decode_large(text))
+            assert json.loads(codec.dumps(data)) == json.loads(text)
+
+def test_record_access():
+    """msgspecの構造体でも、dictと同じようにレコードを読めること"""
+    for c in codec.available_codecs().values():
+        records = c.decode_body('emojis_update', json.dumps(_emojis(3)))
+        assert [r['id'] for r in records] == ['e00000000', 'e00000001', 'e00000002']
+        assert records[1]['tags'] == ['タグ', 't1']
+        assert c.to_builtins(records) == _emojis(3)